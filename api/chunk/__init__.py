@@ -16,6 +16,9 @@ upload_blueprint.add_url_rule('/upload/<resource_id>/complete', 'complete_direct
 # Pub/Sub push notification endpoint
 upload_blueprint.add_url_rule('/pubsub', 'pubsub_handler', methods=['POST'], view_func=views.pubsub_handler)
 
+# Bulk signed URL endpoint
+upload_blueprint.add_url_rule('/signed-urls', 'get_signed_urls', methods=['POST'], view_func=views.get_signed_urls)
+
 # Adaptive streaming endpoints
 upload_blueprint.add_url_rule('/streaming/<resource_id>/url', 'get_streaming_url', methods=['GET'], view_func=views.get_streaming_url)
 upload_blueprint.add_url_rule('/streaming/<resource_id>/status', 'get_transcoding_status', methods=['GET'], view_func=views.get_transcoding_status)
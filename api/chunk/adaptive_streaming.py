@@ -1,72 +1,143 @@
-"""add adaptive streaming columns to resource table
-
-Revision ID: add_streaming_columns
-Revises: fb43d20f994d
-Create Date: 2025-03-26 11:30:45.982154
-
-"""
-from alembic import op
-import sqlalchemy as sa
-from datetime import datetime
-
-
-# revision identifiers, used by Alembic.
-revision = 'add_streaming_columns'
-down_revision = 'fb43d20f994d'
-branch_labels = None
-depends_on = None
-
-
-def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    with op.batch_alter_table('resource', schema=None) as batch_op:
-        # Streaming URLs
-        batch_op.add_column(sa.Column('hls_url', sa.String(length=500), nullable=True))
-        batch_op.add_column(sa.Column('dash_url', sa.String(length=500), nullable=True))
-        batch_op.add_column(sa.Column('stream_key', sa.String(length=250), nullable=True))
-        
-        # Video metadata
-        batch_op.add_column(sa.Column('video_duration', sa.Float(), nullable=True))
-        batch_op.add_column(sa.Column('video_width', sa.Integer(), nullable=True))
-        batch_op.add_column(sa.Column('video_height', sa.Integer(), nullable=True))
-        batch_op.add_column(sa.Column('video_bitrate', sa.Integer(), nullable=True))
-        batch_op.add_column(sa.Column('video_codec', sa.String(length=50), nullable=True))
-        batch_op.add_column(sa.Column('audio_codec', sa.String(length=50), nullable=True))
-        
-        # Processing tracking
-        batch_op.add_column(sa.Column('processing_started_at', sa.DateTime(), nullable=True))
-        batch_op.add_column(sa.Column('processing_completed_at', sa.DateTime(), nullable=True))
-        batch_op.add_column(sa.Column('processing_error', sa.Text(), nullable=True))
-        batch_op.add_column(sa.Column('processing_progress', sa.Float(), nullable=True, default=0))
-
-    # Add columns to chunks table for better tracking
-    with op.batch_alter_table('resource_chunks', schema=None) as batch_op:
-        batch_op.add_column(sa.Column('chunk_size', sa.BigInteger(), nullable=True))
-        batch_op.add_column(sa.Column('upload_started_at', sa.DateTime(), nullable=True))
-        batch_op.add_column(sa.Column('upload_completed_at', sa.DateTime(), nullable=True))
-
-    # ### end Alembic commands ###
-
-
-def downgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    with op.batch_alter_table('resource_chunks', schema=None) as batch_op:
-        batch_op.drop_column('upload_completed_at')
-        batch_op.drop_column('upload_started_at')
-        batch_op.drop_column('chunk_size')
-
-    with op.batch_alter_table('resource', schema=None) as batch_op:
-        batch_op.drop_column('processing_progress')
-        batch_op.drop_column('processing_error')
-        batch_op.drop_column('processing_completed_at')
-        batch_op.drop_column('processing_started_at')
-        batch_op.drop_column('audio_codec')
-        batch_op.drop_column('video_codec')
-        batch_op.drop_column('video_bitrate')
-        batch_op.drop_column('video_height')
-        batch_op.drop_column('video_width')
-        batch_op.drop_column('video_duration')
-        batch_op.drop_column('stream_key')
-        batch_op.drop_column('dash_url')
-        batch_op.drop_column('hls_url')
-    # ### end Alembic commands ###
\ No newline at end of file
+"""Adaptive streaming (HLS/DASH) helpers used by the streaming endpoints."""
+import re
+import shutil
+import logging
+from flask import current_app
+from extensions import db
+from . import utils
+from . import segment_upload
+
+# chunk_<representation>_<number>.m4s, as named by build_cmaf_command()
+CMAF_SEGMENT_PATTERN = re.compile(r'^chunk_(?P<rendition>\d+)_(?P<index>\d+)\.m4s$')
+CMAF_MANIFESTS = ('manifest.mpd', 'output.m3u8')
+
+def build_cmaf_command(source_file, output_folder, qualities, with_audio=True):
+    """
+    Builds one ffmpeg command encoding the ladder to CMAF fMP4 segments.
+
+    The DASH muxer writes manifest.mpd and, with -hls_playlist, an HLS master
+    playlist (output.m3u8) plus one media playlist per representation, all
+    pointing at the same segment files.
+    """
+    command = utils.build_ladder_encode_command(source_file, qualities, with_audio)
+    command += [
+        '-f', 'dash', '-dash_segment_type', 'mp4',
+        '-seg_duration', '4', '-use_template', '1', '-use_timeline', '1',
+        '-init_seg_name', 'init_$RepresentationID$.m4s',
+        '-media_seg_name', 'chunk_$RepresentationID$_$Number%05d$.m4s',
+        '-adaptation_sets', 'id=0,streams=v id=1,streams=a' if with_audio else 'id=0,streams=v',
+        '-hls_playlist', '1', '-hls_master_name', 'output.m3u8',
+        f"{output_folder}/manifest.mpd"
+    ]
+    return command
+
+def generate_cmaf_streams(source_file, output_folder, resource, qualities, bucket):
+    """
+    Encodes the ladder once and publishes it as both HLS and DASH.
+
+    Segments are uploaded while ffmpeg is encoding, the manifests last. On success
+    the resource's hls_url and dash_url point at output.m3u8 and manifest.mpd.
+
+    Args:
+        source_file: Path or URL of the source video
+        output_folder: Storage prefix for the manifests and segments
+        resource: The Resource database object
+        qualities: List of quality presets, see utils.get_encoding_ladder()
+        bucket: GCS bucket object for uploads
+
+    Returns:
+        The resource, or None if encoding failed
+    """
+    def rendition_complete(representation):
+        # Video representations come first, in ladder order, then the audio
+        index = int(representation)
+        if index < len(qualities):
+            utils.update_resource_quality_status(resource, qualities[index]['name'])
+
+    uploader = segment_upload.create_segment_uploader(
+        bucket,
+        output_folder,
+        on_rendition_complete=rendition_complete,
+        segment_pattern=CMAF_SEGMENT_PATTERN,
+        manifests=CMAF_MANIFESTS
+    )
+    try:
+        # The source was probed already if the ladder came from get_resource_ladder()
+        with_audio = bool(resource.audio_codec) if resource.video_codec else utils.has_audio_stream(source_file)
+        command = build_cmaf_command(source_file, uploader.local_folder, qualities, with_audio=with_audio)
+        returncode, stderr = segment_upload.run_ffmpeg_with_uploads(command, uploader)
+        if returncode != 0:
+            logging.error(f"FFmpeg error for CMAF renditions: {stderr.decode(errors='replace')}")
+            resource.processing_error = stderr.decode(errors='replace')[-2000:]
+            db.session.commit()
+            return None
+
+        uploader.finish()
+
+        base_url = f"https://storage.googleapis.com/{current_app.config['GCS_STORAGE_EINO_BUCKET_NAME']}/{output_folder}"
+        resource.hls_url = f"{base_url}/output.m3u8"
+        resource.dash_url = f"{base_url}/manifest.mpd"
+        resource.processing_error = None
+        db.session.add(resource)
+        db.session.commit()
+
+        utils.save_resource_to_db(resource, need_auth=True)
+        return resource
+    except Exception as ex:
+        logging.error(f"Error generating CMAF streams: {ex}")
+        return None
+    finally:
+        uploader.close()
+        shutil.rmtree(uploader.local_folder, ignore_errors=True)
+
+def generate_streams(source_file, output_folder, resource, qualities, bucket):
+    """Encodes the streaming renditions with the packaging selected by STREAMING_PACKAGING."""
+    if current_app.config.get('STREAMING_PACKAGING', 'hls') == 'cmaf':
+        return generate_cmaf_streams(source_file, output_folder, resource, qualities, bucket)
+    return utils.generate_hls_streams(source_file, output_folder, resource, qualities, bucket)
+
+def get_adaptive_streaming_urls(resource):
+    """Returns the HLS, DASH and storyboard URLs of a resource, and whether it can be streamed yet."""
+    return {
+        'hls': resource.get_hls_master_url(),
+        'dash': resource.dash_url,
+        'storyboard': resource.storyboard_url,
+        'is_ready': resource.is_streaming_ready()
+    }
+
+def monitor_transcoding_progress(resource_id):
+    """Returns the rendition flags and processing state of a resource."""
+    from .models import Resource
+
+    resource = Resource.query.filter_by(id=resource_id, is_deleted=False).first()
+    if resource is None:
+        return {'resource_id': resource_id, 'status': 'NOT_FOUND'}
+
+    return {
+        'resource_id': resource_id,
+        'status': resource.status,
+        'renditions': {
+            quality['name']: utils.is_quality_done(resource, quality['name'])
+            for quality in utils.HLS_QUALITY_LADDER
+        },
+        'hls_url': resource.hls_url,
+        'dash_url': resource.dash_url,
+        'progress': resource.processing_progress,
+        'error': resource.processing_error
+    }
+
+def check_file_compatibility(file_path):
+    """Probes a video and reports whether it can be streamed, with the renditions it would get."""
+    probe = utils.probe_media(file_path)
+    if not probe or not probe['video_codec']:
+        return {'compatible': False, 'reason': 'No video stream found'}
+
+    return {
+        'compatible': True,
+        'duration': probe['duration'],
+        'width': probe['width'],
+        'height': probe['height'],
+        'video_codec': probe['video_codec'],
+        'audio_codec': probe['audio_codec'],
+        'renditions': [quality['name'] for quality in utils.get_encoding_ladder(probe)]
+    }
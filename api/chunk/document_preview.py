@@ -0,0 +1,139 @@
+"""First-page previews of PDF and EPUB documents, rendered in a separate process pool."""
+import os
+import signal
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+
+from preview_worker import start_worker, render_first_page
+
+# Process-wide preview renderer, see get_preview_renderer()
+PREVIEW_RENDERER = None
+PREVIEW_RENDERER_LOCK = threading.Lock()
+
+class PreviewRenderer:
+    """
+    Renders document previews in a pool of worker processes.
+
+    At most max_workers renders run at once, so the time limit only counts the
+    render itself, not the wait for a worker. Each worker may allocate at most
+    max_memory bytes beyond what it started with. A render
+    that overruns its time limit, or a worker that dies, takes the pool down
+    with it: the workers are killed, renders in flight fail, and the next
+    render starts a fresh pool.
+    """
+
+    def __init__(self, max_workers, max_memory, timeout):
+        self.max_workers = max_workers
+        self.max_memory = max_memory
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.lock = threading.Lock()
+        self.executor = None
+        # PIDs the current pool's workers report on start, see restart()
+        self.pids = None
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # Not fork: a child of this multithreaded process could inherit a lock
+                # (logging, requests/SSL) held by another thread and deadlock on it.
+                # Workers are forked from a forkserver that has only preview_worker loaded.
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['preview_worker'])
+                self.pids = context.SimpleQueue()
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=context,
+                    initializer=start_worker,
+                    initargs=(self.max_memory, self.pids)
+                )
+            return self.executor
+
+    def restart(self, executor, kill_workers=True):
+        """
+        Shuts a pool down so the next render starts a fresh one.
+
+        With kill_workers, its workers are killed first, so a stuck render can't
+        hold one forever. They aren't reaped until the pool is shut down, so
+        their PIDs can't have been reused. A broken pool has already killed its
+        own workers.
+        """
+        with self.lock:
+            if self.executor is not executor:
+                # Already restarted by another render
+                return
+            self.executor, pids = None, self.pids
+        while kill_workers and not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, source, filetype, width, image_format='jpeg', quality=80):
+        """Renders page one of a document from its bytes or URL, see render_first_page()."""
+        with self.slots:
+            executor = self.get_executor()
+            future = executor.submit(render_first_page, source, filetype, width, image_format, quality)
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                logging.error(f"Preview render exceeded {self.timeout}s, restarting the preview pool")
+                self.restart(executor)
+                raise
+            except BrokenProcessPool:
+                logging.error("A preview worker died, e.g. past its memory limit, restarting the preview pool")
+                self.restart(executor, kill_workers=False)
+                raise
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def get_preview_renderer():
+    """Returns this process's preview renderer, created from the PREVIEW_* config on first use."""
+    global PREVIEW_RENDERER
+
+    if PREVIEW_RENDERER is None:
+        with PREVIEW_RENDERER_LOCK:
+            if PREVIEW_RENDERER is None:
+                PREVIEW_RENDERER = PreviewRenderer(
+                    current_app.config['PREVIEW_MAX_WORKERS'],
+                    current_app.config['PREVIEW_MAX_MEMORY'],
+                    current_app.config['PREVIEW_TIMEOUT']
+                )
+    return PREVIEW_RENDERER
+
+def render_document_preview(source, filetype):
+    """
+    Renders a document's first page at PREVIEW_WIDTH in PREVIEW_IMAGE_FORMAT.
+
+    Args:
+        source: The document bytes, or a URL the worker fetches them from
+        filetype: 'pdf' or 'epub'
+
+    Returns:
+        The image bytes and their format, 'jpeg' or 'webp'
+    """
+    return get_preview_renderer().render(
+        source,
+        filetype,
+        current_app.config['PREVIEW_WIDTH'],
+        current_app.config['PREVIEW_IMAGE_FORMAT'],
+        current_app.config['PREVIEW_IMAGE_QUALITY']
+    )
+
+def reset_preview_renderer():
+    """Shuts the preview pool down so it's created again from the current config (used by tests)."""
+    global PREVIEW_RENDERER
+
+    with PREVIEW_RENDERER_LOCK:
+        renderer, PREVIEW_RENDERER = PREVIEW_RENDERER, None
+    if renderer is not None:
+        renderer.close()
@@ -0,0 +1,229 @@
+import os
+import time
+import uuid
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from flask import current_app
+from . import utils
+
+# Process-wide source media cache, see get_media_cache()
+MEDIA_CACHE = None
+MEDIA_CACHE_LOCK = threading.Lock()
+
+class MediaCache:
+    """
+    Size-bounded on-disk cache of source media, evicted least recently used first.
+
+    Entries are named after their content (storage key and generation), so a
+    file on disk is always complete and current: downloads go to a temporary
+    name and are renamed into place. Concurrent requests for the same entry in
+    a process share one download.
+
+    The folder is shared by every worker process, so its state lives on disk:
+    the size limit applies to everything in the folder, recency is each file's
+    mtime, set whenever an entry is used, and pins are file locks. An entry in
+    use holds a shared flock, a download holds an exclusive one on its partial
+    file, and nothing is deleted without taking the exclusive lock first.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pins = {}
+        self.loading = {}
+
+        os.makedirs(folder, exist_ok=True)
+        # Drop partial downloads nobody is writing, left by a crashed process
+        for name in os.listdir(folder):
+            if name.endswith('.partial'):
+                self.remove_unlocked(os.path.join(folder, name))
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    @staticmethod
+    def remove_unlocked(path):
+        """
+        Deletes a file unless another process holds a lock on it.
+
+        Returns:
+            True if the file is gone, False if it is in use
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(fd)
+        return True
+
+    @staticmethod
+    def pin_file(path):
+        """
+        Takes a shared lock on a cached file, so no process evicts it while it is read.
+
+        Returns:
+            The locked file descriptor, or None if the file is missing or was
+            evicted before the lock was taken
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+        return None
+
+    @contextmanager
+    def acquire(self, name, fetch):
+        """
+        Yields the local path of an entry, fetching it first if it isn't cached.
+
+        Args:
+            name: Entry file name
+            fetch: Called with a path to download the entry to
+        """
+        with self.lock:
+            self.pins[name] = self.pins.get(name, 0) + 1
+        fd = None
+        try:
+            fd = self.ensure(name, fetch)
+            yield self.path(name)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            with self.lock:
+                self.pins[name] -= 1
+                if self.pins[name] == 0:
+                    del self.pins[name]
+            self.evict()
+
+    def ensure(self, name, fetch):
+        """Makes sure an entry is on disk and returns a file descriptor pinning it, see pin_file()."""
+        path = self.path(name)
+        while True:
+            fd = self.pin_file(path)
+            if fd is not None:
+                # Marks the entry most recently used for every process sharing the folder
+                now = time.time_ns()
+                os.utime(path, ns=(now, now))
+                self.evict()
+                return fd
+
+            with self.lock:
+                event = self.loading.get(name)
+                is_owner = event is None
+                if is_owner:
+                    event = self.loading[name] = threading.Event()
+
+            if not is_owner:
+                # Retry once the other download finished, it may have failed
+                event.wait()
+                continue
+
+            partial = f"{path}.{uuid.uuid4().hex}.partial"
+            partial_fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                # Keeps other processes from treating the partial file as left over from a crash
+                fcntl.flock(partial_fd, fcntl.LOCK_EX)
+                fetch(partial)
+                os.replace(partial, path)
+            finally:
+                os.close(partial_fd)
+                with self.lock:
+                    del self.loading[name]
+                event.set()
+                if os.path.exists(partial):
+                    os.remove(partial)
+
+    def files(self):
+        """Returns the (mtime, name, size) of every file in the folder, and their total size including partial downloads."""
+        files = []
+        total = 0
+        for name in os.listdir(self.folder):
+            try:
+                stat = os.stat(self.path(name))
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            if not name.endswith('.partial'):
+                files.append((stat.st_mtime_ns, name, stat.st_size))
+        return files, total
+
+    def evict(self):
+        """Removes entries no process has pinned, least recently used first, until the folder fits max_bytes."""
+        with self.lock:
+            files, total = self.files()
+            for _, name, size in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if self.pins.get(name):
+                    continue
+                try:
+                    if not self.remove_unlocked(self.path(name)):
+                        continue
+                except OSError as ex:
+                    logging.error(f"Failed to evict {name} from media cache: {ex}")
+                    continue
+                total -= size
+
+    def size(self):
+        return self.files()[1]
+
+def get_media_cache():
+    """Returns this process's media cache, created from MEDIA_CACHE_FOLDER and MEDIA_CACHE_MAX_BYTES on first use."""
+    global MEDIA_CACHE
+
+    if MEDIA_CACHE is None:
+        with MEDIA_CACHE_LOCK:
+            if MEDIA_CACHE is None:
+                MEDIA_CACHE = MediaCache(current_app.config['MEDIA_CACHE_FOLDER'], current_app.config['MEDIA_CACHE_MAX_BYTES'])
+    return MEDIA_CACHE
+
+def reset_media_cache():
+    """Drops the cache index so it's rebuilt from the current config (used by tests)."""
+    global MEDIA_CACHE
+
+    with MEDIA_CACHE_LOCK:
+        MEDIA_CACHE = None
+
+def get_cache_entry_name(resource_key, generation):
+    """Names an entry after the object's content, keeping the extension for ffmpeg's format probing."""
+    digest = hashlib.sha256(f"{resource_key}#{generation}".encode()).hexdigest()
+    return f"{digest}{os.path.splitext(resource_key)[1]}"
+
+@contextmanager
+def cached_source(resource):
+    """
+    Yields a local path to the resource's stored object, shared by every stage processing it.
+
+    The object's generation is part of the cache key, so a replaced object is
+    downloaded again. The entry stays pinned until the with block exits.
+    """
+    bucket = utils.get_bucket(utils.get_eino_storage_bucket_name())
+    resource_key = utils.get_resource_storage_key(resource)
+    blob = bucket.get_blob(resource_key)
+    if blob is None:
+        raise Exception(f"Source object {resource_key} not found")
+
+    name = get_cache_entry_name(resource_key, blob.generation)
+    with get_media_cache().acquire(name, lambda path: utils.download_blob(blob, path)) as path:
+        yield path
@@ -1,6 +1,7 @@
 from extensions import db
 from sqlalchemy.orm import Mapped, mapped_column
 import uuid
+from datetime import datetime
 from flask import Response, current_app
 
 from . import utils
@@ -41,6 +42,7 @@ class Resource(db.Model):
     # Streaming URLs and related fields
     hls_url = db.Column(db.String(500), nullable=True)
     dash_url = db.Column(db.String(500), nullable=True)
+    storyboard_url = db.Column(db.String(500), nullable=True)
     stream_key = db.Column(db.String(250), nullable=True)
     
     # Streaming metadata
@@ -89,8 +91,9 @@ class Resource(db.Model):
         if not is_video_file(self.type):
             return False
             
-        # Resource is ready for streaming if at least the 720p version is done
-        return self.is_720p_done
+        # Resource is ready for streaming once its master playlist is published,
+        # or at least the 720p version is done
+        return bool(self.hls_url) or bool(self.is_720p_done)
 
 
 class Chunk(db.Model):
@@ -113,6 +116,31 @@ class Chunk(db.Model):
         return f"<Chunk {self.id} (index: {self.chunk_index}, resource: {self.resource_id})>"
 
 
+class ResourceOutbox(db.Model):
+    """Pending `save_chunk_resource` callbacks to the Django API, drained by the outbox dispatcher."""
+    __tablename__ = 'resource_outbox'
+    __table_args__ = (db.Index('ix_resource_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    id = db.Column(db.String(100), unique=True, primary_key=True, default=utils.get_random_uuid)
+    resource_id = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+
+    # Identity used to mint the service token for the callback
+    company_user = db.Column(db.String(250), nullable=True)
+    company = db.Column(db.String(250), nullable=True)
+    user = db.Column(db.String(250), nullable=True)
+    department = db.Column(db.String(250), nullable=True)
+
+    status = db.Column(db.String(20), default='PENDING')
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ResourceOutbox {self.id} (resource: {self.resource_id}, status: {self.status})>"
+
+
 # Helper function to properly import inside the model methods
 def is_video_file(file_type):
     """Checks if a file type is a video format."""
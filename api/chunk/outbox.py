@@ -0,0 +1,226 @@
+import json
+import logging
+import threading
+import requests
+from datetime import datetime, timedelta
+from flask import current_app
+from extensions import db
+
+# Wakes the dispatcher as soon as a new entry is committed
+OUTBOX_WAKEUP = threading.Event()
+OUTBOX_DISPATCHER_LOCK = threading.Lock()
+OUTBOX_DISPATCHER = None
+OUTBOX_SESSION = requests.Session()
+
+def enqueue_resource_update(resource, payload):
+    """
+    Records a `save_chunk_resource` callback for the resource in the outbox.
+
+    The entry is committed in the same transaction as any pending changes to the
+    resource, so the Django update can't be lost once the resource is saved.
+    Each payload is a full snapshot, so pending entries for the resource are
+    superseded by the new one.
+    """
+    from .models import ResourceOutbox
+
+    session = db.session.object_session(resource) or db.session
+    session.query(ResourceOutbox).filter(
+        ResourceOutbox.resource_id == resource.id,
+        ResourceOutbox.status == 'PENDING'
+    ).delete(synchronize_session=False)
+
+    entry = ResourceOutbox(
+        resource_id=resource.id,
+        payload=json.dumps(payload),
+        company_user=resource.company_user,
+        company=resource.company,
+        user=resource.created_by,
+        department=resource.department
+    )
+    session.add(entry)
+    session.commit()
+
+    start_outbox_dispatcher(current_app._get_current_object())
+    OUTBOX_WAKEUP.set()
+    return entry
+
+def start_outbox_dispatcher(app):
+    """Starts this process's outbox dispatcher thread if it isn't running yet."""
+    global OUTBOX_DISPATCHER
+
+    if not app.config.get('OUTBOX_DISPATCHER_ENABLED', True):
+        return
+    with OUTBOX_DISPATCHER_LOCK:
+        if OUTBOX_DISPATCHER is None or not OUTBOX_DISPATCHER.is_alive():
+            OUTBOX_DISPATCHER = threading.Thread(target=run_outbox_dispatcher, args=(app,), daemon=True)
+            OUTBOX_DISPATCHER.start()
+
+def run_outbox_dispatcher(app):
+    """Drains the outbox whenever woken up, and at least every OUTBOX_POLL_INTERVAL seconds."""
+    while True:
+        OUTBOX_WAKEUP.wait(app.config['OUTBOX_POLL_INTERVAL'])
+        OUTBOX_WAKEUP.clear()
+
+        with app.app_context():
+            try:
+                while dispatch_outbox_batch() >= app.config['OUTBOX_BATCH_SIZE']:
+                    pass
+            except Exception as ex:
+                logging.error(f"Exception in outbox dispatcher: {ex}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+def claim_outbox_entries():
+    """
+    Claims a batch of due outbox entries for delivery and commits, releasing the row locks.
+
+    A claimed entry is DELIVERING until OUTBOX_CLAIM_TIMEOUT seconds from now,
+    after which another dispatcher may take it over (e.g. this one crashed).
+    Only the newest entry per resource is delivered, since each payload is a
+    full snapshot: older ones are deleted when it is claimed, whether due or
+    still waiting out a retry backoff, so none can be sent after it. A resource
+    whose entry is still being delivered elsewhere waits, so snapshots never
+    reach Django out of order.
+
+    Returns:
+        The number of entries claimed or superseded, and the claimed entries
+    """
+    from .models import ResourceOutbox
+
+    now = datetime.utcnow()
+    entries = ResourceOutbox.query.filter(
+        ResourceOutbox.status.in_(['PENDING', 'DELIVERING']),
+        ResourceOutbox.next_attempt_at <= now
+    ).order_by(
+        ResourceOutbox.created_at
+    ).limit(
+        current_app.config['OUTBOX_BATCH_SIZE']
+    ).with_for_update(skip_locked=True).all()
+    if not entries:
+        db.session.commit()
+        return 0, []
+
+    claimed_ids = {entry.id for entry in entries}
+    others = ResourceOutbox.query.filter(
+        ResourceOutbox.resource_id.in_({entry.resource_id for entry in entries}),
+        ResourceOutbox.status.in_(['PENDING', 'DELIVERING'])
+    ).all()
+
+    claimed = []
+    superseded = 0
+    deleted_ids = set()
+    lease = now + timedelta(seconds=current_app.config['OUTBOX_CLAIM_TIMEOUT'])
+    for entry in entries:
+        related = [other for other in others if other.resource_id == entry.resource_id and other.id != entry.id]
+        if any(other.created_at > entry.created_at for other in related):
+            db.session.delete(entry)
+            deleted_ids.add(entry.id)
+            superseded += 1
+        elif any(other.id not in claimed_ids and other.status == 'DELIVERING' and other.next_attempt_at > now for other in related):
+            continue
+        else:
+            for other in related:
+                if other.id not in deleted_ids and (other.status == 'PENDING' or other.next_attempt_at <= now):
+                    db.session.delete(other)
+                    deleted_ids.add(other.id)
+            entry.status = 'DELIVERING'
+            entry.next_attempt_at = lease
+            claimed.append(entry)
+
+    db.session.commit()
+    return len(claimed) + superseded, claimed
+
+def dispatch_outbox_batch():
+    """
+    Delivers one batch of due outbox entries, see claim_outbox_entries().
+
+    The claim is committed before any network I/O, so no row locks are held
+    while tokens are minted and Django is called. Entries are grouped by the
+    identity their token is minted for.
+
+    Returns:
+        The number of entries claimed or superseded
+    """
+    count, entries = claim_outbox_entries()
+
+    groups = {}
+    for entry in entries:
+        identity = (entry.company_user, entry.company, entry.user, entry.department)
+        groups.setdefault(identity, []).append(entry)
+
+    for identity, group in groups.items():
+        deliver_outbox_entries(identity, group)
+
+    db.session.commit()
+    return count
+
+def deliver_outbox_entries(identity, entries):
+    """Posts the entries for one identity, batched into a single request when Django accepts arrays."""
+    from .utils import get_auth_token_from_company_user
+
+    company_user, company, user, department = identity
+    url = f"{current_app.config['DJANGO_BASE_URL']}/api/v2/resource/save_chunk_resource/"
+    timeout = current_app.config['OUTBOX_REQUEST_TIMEOUT']
+
+    try:
+        user_data = get_auth_token_from_company_user(company_user, company, user) or {}
+        headers = {
+            'Authorization': f"Bearer {user_data.get('access_token')}",
+            'X-Tenant-ID': company,
+            'Department-Id': department
+        }
+    except Exception as ex:
+        for entry in entries:
+            mark_outbox_entry_failed(entry, f"Auth token error: {ex}")
+        return
+
+    if current_app.config['OUTBOX_BATCH_DELIVERY'] and len(entries) > 1:
+        batches = [entries]
+    else:
+        batches = [[entry] for entry in entries]
+
+    for batch in batches:
+        payload = [json.loads(entry.payload) for entry in batch]
+        try:
+            res = OUTBOX_SESSION.post(url, json=payload if len(batch) > 1 else payload[0], headers=headers, timeout=timeout)
+            error = None if res.ok else f"Status: {res.status_code}"
+        except Exception as ex:
+            error = str(ex)
+
+        for entry in batch:
+            if error is None:
+                db.session.delete(entry)
+            else:
+                mark_outbox_entry_failed(entry, error)
+
+def mark_outbox_entry_failed(entry, error):
+    """
+    Schedules a retry with exponential backoff, giving up after OUTBOX_MAX_ATTEMPTS.
+
+    An entry a newer snapshot was queued for while it was being delivered is
+    dropped instead, since retrying it could overwrite the newer one in Django.
+    """
+    from .models import ResourceOutbox
+
+    newer = ResourceOutbox.query.filter(
+        ResourceOutbox.resource_id == entry.resource_id,
+        ResourceOutbox.status.in_(['PENDING', 'DELIVERING']),
+        ResourceOutbox.created_at > entry.created_at
+    ).first()
+    if newer is not None:
+        logging.error(f"Failed to save resource {entry.resource_id} to Django, a newer snapshot is queued: {error}")
+        db.session.delete(entry)
+        return
+
+    entry.attempts = (entry.attempts or 0) + 1
+    entry.last_error = error
+    delay = min(current_app.config['OUTBOX_RETRY_BASE_DELAY'] * 2 ** (entry.attempts - 1), current_app.config['OUTBOX_RETRY_MAX_DELAY'])
+    entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+    entry.status = 'PENDING'
+
+    if entry.attempts >= current_app.config['OUTBOX_MAX_ATTEMPTS']:
+        entry.status = 'FAILED'
+        logging.error(f"Giving up on saving resource {entry.resource_id} to Django after {entry.attempts} attempts: {error}")
+    else:
+        logging.error(f"Failed to save resource {entry.resource_id} to Django (attempt {entry.attempts}): {error}")
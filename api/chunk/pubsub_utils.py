@@ -102,8 +102,8 @@ def publish_thumbnail_generation_task(resource_id, file_path, output_folder, tim
     Args:
         resource_id: ID of the resource to process
         file_path: Path to the source video file
-        output_folder: Output folder for thumbnails
-        timestamps: Optional list of timestamps for thumbnail extraction
+        output_folder: Output folder for the storyboard
+        timestamps: Optional storyboard frame times, one every STORYBOARD_INTERVAL seconds by default
         
     Returns:
         Message ID if successful
@@ -113,7 +113,7 @@ def publish_thumbnail_generation_task(resource_id, file_path, output_folder, tim
         'resource_id': resource_id,
         'file_path': file_path,
         'output_folder': output_folder,
-        'timestamps': timestamps or [0],  # Default to first frame
+        'timestamps': timestamps,
         'task_type': 'generate_thumbnails'
     }
     return publish_message(topic_name, message_data)
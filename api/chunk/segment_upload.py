@@ -0,0 +1,201 @@
+import os
+import re
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+from . import transcoding
+
+STREAMING_CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.mpd': 'application/dash+xml'
+}
+
+# output_<rendition>_<index>.ts (or .m4s), as written by the HLS muxer
+SEGMENT_PATTERN = re.compile(r'^output_(?P<rendition>.+)_(?P<index>\d+)\.(ts|m4s)$')
+
+def get_streaming_content_type(filename):
+    return STREAMING_CONTENT_TYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+
+class SegmentUploader:
+    """
+    Uploads HLS output from a local scratch folder while ffmpeg is still writing it.
+
+    A segment is picked up once the muxer has moved on to the rendition's next
+    segment, uploaded public with its content type in one request, and deleted
+    locally. Files that only complete when ffmpeg exits (single-file renditions,
+    fMP4 init segments) are uploaded by finish(). A rendition's playlist goes up
+    only after all of its media, and the manifests (the master playlist by
+    default) go up last, so players never see a playlist that points at missing
+    objects.
+    """
+
+    def __init__(self, bucket, local_folder, remote_folder, on_rendition_complete=None, max_workers=8,
+                 segment_pattern=SEGMENT_PATTERN, manifests=('output.m3u8',)):
+        self.bucket = bucket
+        self.local_folder = local_folder
+        self.remote_folder = remote_folder
+        self.on_rendition_complete = on_rendition_complete
+        self.segment_pattern = segment_pattern
+        self.manifests = manifests
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='segment-upload')
+        self.lock = threading.Lock()
+        self.submitted = set()
+        self.futures = {}
+        self.completed = set()
+
+    def upload(self, filename):
+        path = os.path.join(self.local_folder, filename)
+        blob = self.bucket.blob(f"{self.remote_folder}/{filename}")
+        blob.upload_from_filename(path, content_type=get_streaming_content_type(filename), predefined_acl='publicRead')
+        os.remove(path)
+
+    def scan(self, final=False):
+        """
+        Queues every finished segment that isn't uploading yet.
+
+        Unless final is set, each rendition's newest segment is assumed to still
+        be open in ffmpeg and is left for a later scan.
+        """
+        renditions = {}
+        for filename in os.listdir(self.local_folder):
+            match = self.segment_pattern.match(filename)
+            if match:
+                renditions.setdefault(match.group('rendition'), []).append((int(match.group('index')), filename))
+
+        for rendition, segments in renditions.items():
+            segments.sort()
+            if not final:
+                segments = segments[:-1]
+            for _, filename in segments:
+                self.queue(rendition, filename)
+
+    def queue(self, rendition, filename):
+        if filename in self.submitted:
+            return
+        self.submitted.add(filename)
+        future = self.executor.submit(self.upload, filename)
+        with self.lock:
+            self.futures.setdefault(rendition, []).append(future)
+
+    def queue_remaining(self, rendition):
+        """Queues the rendition's media that isn't a numbered segment, e.g. a single-file rendition or init segment."""
+        playlist = f"output_{rendition}.m3u8"
+        for filename in os.listdir(self.local_folder):
+            if filename == playlist or not filename.startswith(f"output_{rendition}"):
+                continue
+            if os.path.splitext(filename)[0] in (f"output_{rendition}", f"output_{rendition}_init"):
+                self.queue(rendition, filename)
+
+    def backlog(self):
+        """Returns the number of segments queued or uploading."""
+        with self.lock:
+            return sum(not future.done() for futures in self.futures.values() for future in futures)
+
+    def complete_rendition(self, rendition):
+        """Waits for the rendition's segments, then uploads its playlist and reports it done."""
+        self.queue_remaining(rendition)
+        with self.lock:
+            futures = list(self.futures.get(rendition, []))
+        done, _ = wait(futures)
+        for future in done:
+            # Re-raises the first failed segment upload
+            future.result()
+
+        playlist = f"output_{rendition}.m3u8"
+        if os.path.exists(os.path.join(self.local_folder, playlist)):
+            self.upload(playlist)
+        self.completed.add(rendition)
+        if self.on_rendition_complete:
+            self.on_rendition_complete(rendition)
+
+    def finish(self):
+        """Uploads everything left after ffmpeg exited, finishing with the master playlist."""
+        self.scan(final=True)
+        renditions = set(self.futures) | {
+            filename[len('output_'):-len('.m3u8')] for filename in os.listdir(self.local_folder)
+            if filename.startswith('output_') and filename.endswith('.m3u8') and filename not in self.manifests
+        }
+        pending = sorted(renditions - self.completed)
+        # Queue everything up front so large single-file renditions upload in parallel
+        for rendition in pending:
+            self.queue_remaining(rendition)
+        for rendition in pending:
+            self.complete_rendition(rendition)
+
+        # Anything else, e.g. per-representation playlists that aren't named after a rendition
+        others = [f for f in os.listdir(self.local_folder) if f not in self.manifests and f not in self.submitted]
+        for future in [self.executor.submit(self.upload, filename) for filename in others]:
+            future.result()
+
+        for manifest in self.manifests:
+            if os.path.exists(os.path.join(self.local_folder, manifest)):
+                self.upload(manifest)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def create_segment_uploader(bucket, remote_folder, on_rendition_complete=None, **options):
+    """Creates an uploader over a fresh scratch folder, outside the watchdog folder."""
+    local_folder = tempfile.mkdtemp(prefix='hls-')
+    return SegmentUploader(
+        bucket,
+        local_folder,
+        remote_folder,
+        on_rendition_complete=on_rendition_complete,
+        max_workers=current_app.config['HLS_UPLOAD_WORKERS'],
+        **options
+    )
+
+def run_ffmpeg_with_uploads(command, uploader=None):
+    """
+    Runs an ffmpeg HLS encode in a transcode slot, uploading segments as they are finished.
+
+    If the upload backlog reaches HLS_UPLOAD_MAX_PENDING segments, ffmpeg is
+    paused until it drains to half of that, which bounds the scratch disk used.
+
+    Returns:
+        The ffmpeg return code and its stderr output
+    """
+    poll_interval = current_app.config['HLS_UPLOAD_POLL_INTERVAL']
+    max_pending = current_app.config['HLS_UPLOAD_MAX_PENDING']
+
+    with transcoding.transcode_slot(), tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            transcoding.with_thread_budget(command),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr
+        )
+        paused = False
+        try:
+            while process.poll() is None:
+                time.sleep(poll_interval)
+                if uploader is None:
+                    continue
+                uploader.scan()
+                backlog = uploader.backlog()
+                if not paused and backlog >= max_pending:
+                    logging.info(f"Pausing ffmpeg with {backlog} segments waiting for upload")
+                    process.send_signal(signal.SIGSTOP)
+                    paused = True
+                elif paused and backlog <= max_pending // 2:
+                    process.send_signal(signal.SIGCONT)
+                    paused = False
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
+        stderr.seek(0)
+        output = stderr.read()
+
+    transcoding.record_transcode_result(process.returncode)
+    return process.returncode, output
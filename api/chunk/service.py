@@ -1,20 +1,21 @@
 import os
 import time
-import io
 import json
 import uuid
 import shutil
+import tempfile
 import requests
 import logging
 from flask import request, jsonify, current_app
 from . import utils
 from . import pubsub_utils
+from . import transcoding
 from .models import Resource, Chunk
 from extensions import db
 from sqlalchemy import asc
 import threading
 
-def start_chunk_upload(auth_data, company_id, meta: str, department_id: str, need_processing: bool = False, file_upload_from_chat: bool = False, direct_upload: bool = False):
+def start_chunk_upload(auth_data, company_id, meta: str, department_id: str, need_processing: bool = False, file_upload_from_chat: bool = False, direct_upload: bool = False, is_partial: bool = False):
   length = request.headers.get('Upload-Length')
   metadata = utils.get_metadata(meta or '')
   is_multipart = True
@@ -32,7 +33,8 @@ def start_chunk_upload(auth_data, company_id, meta: str, department_id: str, nee
     department = department_id,
     is_multipart = is_multipart,
     need_processing = need_processing,
-    file_upload_from_chat = file_upload_from_chat
+    file_upload_from_chat = file_upload_from_chat,
+    status = 'PARTIAL_UPLOADING' if is_partial else 'CHUNK_UPLOADING'
   )
   db.session.add(resource)
   db.session.commit()  
@@ -46,10 +48,6 @@ def start_chunk_upload(auth_data, company_id, meta: str, department_id: str, nee
   
   # For traditional uploads through the server
   else:
-    storage_client = utils.get_storage_client()
-    bucket_name = utils.get_eino_storage_bucket_name()
-    key = utils.get_resource_storage_key(resource)
-    
     if is_multipart:
       # Create a resumable upload session
       session_uri = utils.create_resumable_upload_session(resource)
@@ -59,7 +57,6 @@ def start_chunk_upload(auth_data, company_id, meta: str, department_id: str, nee
   return { **metadata, 'id': f"{resource.id}" }
 
 def upload_chunk_data(resource_id: str):
-  data = request.data
   resource = Resource.query.filter_by(id=resource_id, is_deleted=False).first()
   if resource is None:
     raise Exception('Resource not found')
@@ -69,28 +66,14 @@ def upload_chunk_data(resource_id: str):
   chunk_id = f"{uuid.uuid4()}" 
   part = { 'ETag': None }
 
-  storage_client = utils.get_storage_client()
-  bucket_name = utils.get_eino_storage_bucket_name()
-  bucket = storage_client.bucket(bucket_name)
-  key = utils.get_resource_storage_key(resource)
   file_size = 0
   
   if resource.is_multipart:
     chunk_key = ''
-    file_size = utils.get_chunk_file_size(chunk_id)
-    
-    # For GCS, we append to the upload
-    blob = bucket.blob(key)
-    
-    # If it's the first chunk, we need to create a new upload
-    if resource.chunks_uploaded == 0:
-      with io.BytesIO(data) as f:
-        blob.upload_from_file(f, size=len(data), content_type=resource.type)
-    else:
-      # Append the chunk to the existing object using a resumable upload
-      with io.BytesIO(data) as f:
-        blob.upload_from_file(f, size=len(data), content_type=resource.type)
+    # Stream the body straight into the resumable session saved at upload start
+    file_size = utils.append_to_resumable_upload(resource, request.stream)
   else:
+    data = request.data
     utils.create_chunk_file(f"{chunk_id}", data)
     try:
       chunk_key = utils.save_chunk_to_storage(resource_id, f"{chunk_id}")
@@ -105,10 +88,12 @@ def upload_chunk_data(resource_id: str):
     chunk_index = len(resource.chunks.all()) + 1,
     data_key = chunk_key,
     tag=part.get('ETag'),
+    chunk_size = file_size,
     resource = resource
   )
 
-  resource.offset += file_size
+  if not resource.is_multipart:
+    resource.offset += file_size
   resource.chunks_uploaded += 1
   db.session.add_all([chunk, resource])
   db.session.commit()
@@ -118,34 +103,22 @@ def upload_chunk_data(resource_id: str):
   chunk_id = chunk.id
   chunk_index = resource.chunks_uploaded
   
-  if resource.offset >= resource.size:
+  if resource.offset >= resource.size and resource.status == 'PARTIAL_UPLOADING':
+    # Partial uploads are only processed once the client concatenates them into a final upload
+    resource.status = 'PARTIAL_FINISHED'
+    resource.is_completed = True
+    db.session.add(resource)
+    db.session.commit()
+  elif resource.offset >= resource.size:
     resource.status = 'UPLOAD_FINISHED'
     resource.is_completed = True
-
-    if resource.is_multipart:
-      file_size = resource.size % current_app.config['MULTIPART_FILESIZE']
-
     resource.offset = resource.size
 
     db.session.add_all([chunk, resource])
     db.session.commit()
 
     if resource.is_multipart:
-      if current_app.config.get('USE_PUBSUB_FOR_MEDIA_PROCESSING', False):
-        # Publish a message to process the file
-        pubsub_utils.publish_file_processing_task(resource.id)
-      else:
-        # Process locally
-        try:
-          file = utils.get_signed_url(key)
-          resource = utils.save_preview_image(resource, file)
-        
-          if utils.is_processing_needed(resource.type, resource.need_processing):
-            threading.Thread(target=utils.convert_to_mp4, args=(resource,)).start()
-        except Exception as ex:
-          print("Exception in save preview: ", ex)
-        finally:
-          delete_chunk_upload(resource.id)
+      resource = multipart_upload_finished(resource)
     else:
       is_video = utils.is_video_file(resource.type)
       need_processing = utils.is_processing_needed(resource.type, resource.need_processing)
@@ -167,6 +140,98 @@ def upload_chunk_data(resource_id: str):
     'offset': resource.offset
   }
 
+def multipart_upload_finished(resource: Resource):
+  """Kicks off preview and conversion once a multipart upload's GCS object is complete."""
+  if current_app.config.get('USE_PUBSUB_FOR_MEDIA_PROCESSING', False):
+    # Publish a message to process the file
+    pubsub_utils.publish_file_processing_task(resource.id)
+  else:
+    # Process locally
+    try:
+      # A seek through the signed URL, the conversion job reads the source from the media cache
+      file = utils.get_signed_url(utils.get_resource_storage_key(resource))
+      resource = utils.save_preview_image(resource, file)
+    
+      if utils.is_processing_needed(resource.type, resource.need_processing):
+        transcoding.submit_transcode(utils.convert_to_mp4, resource)
+    except Exception as ex:
+      print("Exception in save preview: ", ex)
+    finally:
+      delete_chunk_upload(resource.id)
+
+  return resource
+
+def start_concatenated_upload(auth_data, company_id, meta: str, department_id: str, need_processing: bool = False, file_upload_from_chat: bool = False, upload_concat: str = ''):
+  """
+  Creates a TUS `final` upload from previously finished partial uploads.
+
+  The partial objects are stitched together server-side with GCS compose, so
+  none of the uploaded bytes pass through this service.
+  """
+  metadata = utils.get_metadata(meta or '')
+  partial_urls = upload_concat.split(';', 1)[1].split() if ';' in upload_concat else []
+  partial_ids = [url.rstrip('/').split('/')[-1] for url in partial_urls]
+  if not partial_ids:
+    raise Exception('No partial uploads given for concatenation')
+
+  partials = []
+  for partial_id in partial_ids:
+    partial = Resource.query.filter_by(id=partial_id, is_deleted=False).first()
+    if partial is None or partial.status != 'PARTIAL_FINISHED' or partial.created_by != auth_data['user']['uuid'] or partial.company != company_id:
+      raise Exception(f'Partial upload {partial_id} is not finished or not found')
+    partials.append(partial)
+
+  size = sum(int(partial.size) for partial in partials)
+  resource = Resource(
+    name=metadata.get('filename'),
+    type=metadata.get('filetype'),
+    directory=metadata.get('filedirectory'),
+    size=size,
+    offset=size,
+    chunks=[],
+    created_by = auth_data['user']['uuid'],
+    company = company_id,
+    company_user = auth_data['company_user']['id'],
+    department = department_id,
+    is_multipart = True,
+    need_processing = need_processing,
+    file_upload_from_chat = file_upload_from_chat,
+    chunks_uploaded = len(partials)
+  )
+  db.session.add(resource)
+  db.session.commit()
+
+  bucket = utils.get_bucket(utils.get_eino_storage_bucket_name())
+  sources = [bucket.blob(utils.get_upload_storage_key(partial)) for partial in partials]
+  destination = bucket.blob(utils.get_resource_storage_key(resource))
+  try:
+    utils.compose_blobs(bucket, sources, destination, content_type=resource.type)
+  except Exception:
+    # No object was written, so the final upload is dropped and the partials stay for a retry
+    resource.status = 'UPLOAD_FAILED'
+    resource.is_deleted = True
+    db.session.add(resource)
+    db.session.commit()
+    raise
+
+  for partial, source in zip(partials, sources):
+    try:
+      source.delete()
+    except Exception as ex:
+      logging.error(f"Failed to delete partial upload object {source.name}: {ex}")
+    utils.delete_chunks(partial)
+
+  resource.status = 'UPLOAD_FINISHED'
+  resource.is_completed = True
+  db.session.add(resource)
+  db.session.commit()
+
+  resource_id = resource.id
+  resource = multipart_upload_finished(resource)
+  utils.save_resource_to_db(resource, need_auth=True, fileUploadFromChat=file_upload_from_chat)
+
+  return { **metadata, 'id': f"{resource_id}" }
+
 def complete_direct_upload(resource_id: str):
   """Completes a direct upload from browser to GCS."""
   resource = Resource.query.filter_by(id=resource_id, is_deleted=False).first()
@@ -195,7 +260,7 @@ def complete_direct_upload(resource_id: str):
       resource = utils.save_preview_image(resource, file)
     
       if utils.is_processing_needed(resource.type, resource.need_processing):
-        threading.Thread(target=utils.convert_to_mp4, args=(resource,)).start()
+        transcoding.submit_transcode(utils.convert_to_mp4, resource)
     except Exception as ex:
       print("Exception in save preview: ", ex)
   
@@ -208,21 +273,34 @@ def complete_direct_upload(resource_id: str):
   }
 
 def chunk_upload_completed(resource: Resource, is_restart=False, need_lock=True):
+  """
+  Completes an upload, holding the resource's lock unless need_lock is False.
+
+  The lock is per resource, so unrelated uploads complete in parallel. If the
+  same resource is already being completed elsewhere this call is a no-op.
+  """
+  from main import app
+  with app.app_context():
+    if not need_lock:
+      return complete_chunk_upload(resource, is_restart)
+
+    with utils.resource_lock(resource.id, blocking=False) as locked:
+      if not locked:
+        print(f"Resource {resource.id} is already being completed, skipping")
+        return resource
+      return complete_chunk_upload(resource, is_restart)
+
+def complete_chunk_upload(resource: Resource, is_restart=False):
   from main import app
   with app.app_context():
-    combined_file_name = ''
     try:
-      if need_lock:
-        app.config['CHUNK_COMPLETION_LOCK'].acquire()
-      storage_client = utils.get_storage_client()
       bucket_name = utils.get_eino_storage_bucket_name()
-      bucket = storage_client.bucket(bucket_name)
+      bucket = utils.get_bucket(bucket_name)
 
       is_video = utils.is_video_file(resource.type)
       need_processing = utils.is_processing_needed(resource.type, resource.need_processing)
 
       resource = Resource.query.filter_by(id=resource.id, is_deleted=False).first()
-      combined_file_name = f"{resource.id}-{resource.name}"
       if resource.is_multipart:
         # In GCS, we don't need to combine parts, as the object is already created
         is_video = utils.is_video_file(resource.type)
@@ -233,26 +311,27 @@ def chunk_upload_completed(resource: Resource, is_restart=False, need_lock=True)
           else:
             utils.convert_to_mp4(resource)
       else:
-        combined_file = combine_chunks(resource)
-
-        with open(combined_file_name, 'wb') as f:
-          f.write(combined_file.getbuffer())
+        # Assemble the chunks server-side; bytes are only pulled locally for the audio transcode
+        chunk_bucket = utils.get_bucket(utils.get_storage_bucket_name())
+        combined_blob = compose_chunks(resource, chunk_bucket)
+        resource_key = utils.get_resource_storage_key(resource)
 
         try:
-          resource = utils.save_preview_image(resource, combined_file)
-        except Exception as ex:
-          print("Exception in saving preview image: ", ex)
-        resource_key = utils.get_resource_storage_key(resource)
+          if not utils.is_audio_file(resource.type):
+            utils.rewrite_blob(combined_blob, bucket.blob(resource_key))
+          else:
+            utils.convert_to_mp3_file(combined_blob, bucket.blob(resource_key), resource)
+        finally:
+          try:
+            combined_blob.delete()
+          except Exception as ex:
+            logging.error(f"Failed to delete composed object {combined_blob.name}: {ex}")
 
         if not utils.is_audio_file(resource.type):
-          blob = bucket.blob(resource_key)
-          blob.upload_from_file(combined_file)
-        else:
-          mp3_audio_file = utils.convert_to_mp3_file(combined_file, resource)
-          blob = bucket.blob(resource_key)
-          blob.upload_from_file(mp3_audio_file)
-          if os.path.exists(f'{resource.id}.mp3'):
-            os.remove(f'{resource.id}.mp3')
+          try:
+            resource = utils.save_preview_image(resource, utils.get_signed_url(resource_key))
+          except Exception as ex:
+            print("Exception in saving preview image: ", ex)
 
         need_processing = utils.is_processing_needed(resource.type, resource.need_processing)
         if need_processing:
@@ -270,40 +349,43 @@ def chunk_upload_completed(resource: Resource, is_restart=False, need_lock=True)
           db.session.add(resource)
         
         db.session.commit()
-        combined_file.close()
 
       utils.save_resource_to_db(resource, need_auth=True)
 
       delete_chunk_upload(resource.id)
-      if os.path.exists(combined_file_name):
-        os.remove(combined_file_name)
     except Exception as ex: 
       logging.error(f"Error in chunk_upload complete: {ex}")
-    finally:
-      if need_lock and app.config['CHUNK_COMPLETION_LOCK'].locked():
-        app.config['CHUNK_COMPLETION_LOCK'].release()
-
-      if combined_file_name and os.path.exists(combined_file_name):
-        os.remove(combined_file_name)
 
   return resource
 
+def compose_chunks(resource: Resource, chunk_bucket):
+  """Composes the resource's chunks, in order, into one object inside the chunk bucket."""
+  chunks = resource.chunks.order_by(asc(Chunk.chunk_index)).all()
+  sources = [chunk_bucket.blob(chunk.data_key) for chunk in chunks]
+  combined_blob = chunk_bucket.blob(f"{resource.id}/combined")
+
+  return utils.compose_blobs(chunk_bucket, sources, combined_blob, content_type=resource.type)
+
 def combine_chunks(resource: Resource):
-  from main import app
+  """
+  Assembles the resource's chunks into a file-like object for local processing.
 
-  combined_file = io.BytesIO()
+  Chunks are downloaded in order with the next few prefetched concurrently, and
+  written to a spooled temp file that moves to disk past CHUNK_ASSEMBLY_MEMORY_LIMIT,
+  so memory stays bounded whatever the file size.
+  """
+  from main import app
 
   with app.app_context():
+    combined_file = tempfile.SpooledTemporaryFile(max_size=app.config['CHUNK_ASSEMBLY_MEMORY_LIMIT'])
     resource = Resource.query.filter_by(id=resource.id, is_deleted=False).first()
 
     chunks = resource.chunks.order_by(asc(Chunk.chunk_index)).all()
-    storage_client = utils.get_storage_client()
     bucket_name = utils.get_storage_bucket_name()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = utils.get_bucket(bucket_name)
 
-    for chunk in chunks:
-      blob = bucket.blob(chunk.data_key)
-      data = blob.download_as_bytes()
+    blobs = [bucket.blob(chunk.data_key) for chunk in chunks]
+    for data in utils.iter_blob_contents(blobs, prefetch=app.config['CHUNK_PREFETCH_COUNT']):
       combined_file.write(data)
     combined_file.seek(0)
 
@@ -331,10 +413,9 @@ def delete_chunk_upload(resource_id: str, is_abort=False):
 
     # For GCS, we can delete the object if needed
     if resource.is_multipart and is_abort:
-      storage_client = utils.get_storage_client()
       bucket_name = utils.get_eino_storage_bucket_name()
-      bucket = storage_client.bucket(bucket_name)
-      key = utils.get_resource_storage_key(resource)
+      bucket = utils.get_bucket(bucket_name)
+      key = utils.get_upload_storage_key(resource)
       blob = bucket.blob(key)
       if blob.exists():
         blob.delete()
@@ -361,20 +442,17 @@ def cleanup_and_restart_processing():
 
       resources = Resource.query.filter_by(is_deleted=False).all() or []
       for resource in resources:
-        app.config['CHUNK_COMPLETION_LOCK'].acquire()
         if resource.status in ['UPLOAD_FINISHED', 'VIDEO_PROCESSING']:
           # For Cloud Run environment, we should use Pub/Sub for async processing
           if current_app.config.get('USE_PUBSUB_FOR_MEDIA_PROCESSING', False):
             pubsub_utils.publish_file_processing_task(resource.id)
           else:
+            # chunk_upload_completed takes the resource lock itself
             threading.Thread(target=chunk_upload_completed, kwargs={'resource': resource, 'is_restart': True}).start()
         else:
-          delete_chunk_upload(resource.id)
-    
-        if app.config['CHUNK_COMPLETION_LOCK'].locked():
-          app.config['CHUNK_COMPLETION_LOCK'].release()
+          # Leave uploads that another instance is still completing alone
+          with utils.resource_lock(resource.id, blocking=False) as locked:
+            if locked:
+              delete_chunk_upload(resource.id)
   except Exception as ex:
-    logging.error(f"Exception in cleanup_and_restart_processing : {ex}")
-  finally:
-    if app.config['CHUNK_COMPLETION_LOCK'].locked():
-      app.config['CHUNK_COMPLETION_LOCK'].release()
\ No newline at end of file
+    logging.error(f"Exception in cleanup_and_restart_processing : {ex}")
\ No newline at end of file
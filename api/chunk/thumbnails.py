@@ -0,0 +1,216 @@
+"""Video poster and storyboard (scrubbing preview) generation."""
+import os
+import math
+import shutil
+import logging
+import tempfile
+import subprocess
+from flask import current_app
+from extensions import db
+from . import utils
+from . import transcoding
+
+POSTER_WIDTH = 640
+
+def get_poster_timestamp(duration):
+    """One second in, or the middle of clips shorter than two seconds."""
+    if duration and duration < 2:
+        return duration / 2
+    return 1.0
+
+def get_seek_options(timestamp):
+    """
+    Input options seeking to the keyframe at or before `timestamp`.
+
+    Before -i, -ss seeks the demuxer instead of decoding from the start, and
+    -noaccurate_seek keeps that keyframe rather than decoding up to the exact time.
+    """
+    return ['-noaccurate_seek', '-ss', f"{timestamp:.3f}"]
+
+def build_poster_command(source_file, output_image, timestamp):
+    """Builds an ffmpeg command saving one keyframe near `timestamp` as a JPEG poster."""
+    return [
+        'ffmpeg', '-y', '-v', 'error',
+        *get_seek_options(timestamp), '-i', source_file,
+        '-map', '0:v:0', '-frames:v', '1',
+        '-vf', f"scale={POSTER_WIDTH}:-2", '-q:v', '3',
+        output_image
+    ]
+
+def get_storyboard_timestamps(duration, interval, max_tiles, timestamps=None):
+    """
+    Returns the storyboard frame times: the given ones within the video, or one every `interval` seconds.
+
+    The interval grows for long videos so the sprite never exceeds `max_tiles` tiles.
+    """
+    if timestamps:
+        timestamps = sorted({float(t) for t in timestamps if float(t) >= 0 and (not duration or float(t) < duration)})
+        return timestamps[:max_tiles] or [0.0]
+    if not duration:
+        return [0.0]
+
+    interval = max(interval, duration / max_tiles)
+    return [i * interval for i in range(int(math.ceil(duration / interval)))]
+
+def get_storyboard_layout(count, columns):
+    """Returns the sprite's (columns, rows) for `count` tiles."""
+    columns = min(count, columns)
+    return columns, int(math.ceil(count / columns))
+
+def get_storyboard_batches(timestamps, columns, max_inputs):
+    """Splits the storyboard times into batches of whole sprite rows, at most `max_inputs` per ffmpeg command."""
+    size = max(columns, max_inputs // columns * columns)
+    return [timestamps[index:index + size] for index in range(0, len(timestamps), size)]
+
+def build_thumbnails_command(source_file, poster_image, sprite_image, timestamps, poster_timestamp, tile_size, columns, layout=None):
+    """
+    Builds one ffmpeg command writing the poster (unless poster_image is None) and a storyboard sprite.
+
+    Every frame is its own fast-seeked input, so ffmpeg decodes one keyframe per
+    thumbnail instead of the whole video. Each input gets a single decoder
+    thread, and callers bound the number of inputs with get_storyboard_batches(),
+    so a command never runs more than a handful of decoders or connections to
+    the source.
+    """
+    width, height = tile_size
+    frames = [poster_timestamp, *timestamps] if poster_image else list(timestamps)
+    first_tile = 1 if poster_image else 0
+    command = ['ffmpeg', '-y', '-v', 'error']
+    for timestamp in frames:
+        command += ['-threads', '1', *get_seek_options(timestamp), '-i', source_file]
+
+    filters = [f"[0:v:0]trim=end_frame=1,scale={POSTER_WIDTH}:-2[poster]"] if poster_image else []
+    for index in range(first_tile, len(frames)):
+        filters.append(
+            f"[{index}:v:0]trim=end_frame=1,"
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1[t{index}]"
+        )
+    tiles = ''.join(f"[t{index}]" for index in range(first_tile, len(frames)))
+    layout = 'x'.join(str(n) for n in layout or get_storyboard_layout(len(timestamps), columns))
+    filters.append(f"{tiles}concat=n={len(timestamps)}:v=1:a=0,tile={layout}[sprite]")
+
+    command += ['-filter_complex', ';'.join(filters)]
+    if poster_image:
+        command += ['-map', '[poster]', '-frames:v', '1', '-q:v', '3', poster_image]
+    command += ['-map', '[sprite]', '-frames:v', '1', '-q:v', '5', sprite_image]
+    return command
+
+def build_stack_command(strip_images, sprite_image):
+    """Builds an ffmpeg command stacking storyboard strips, top to bottom, into the sprite."""
+    command = ['ffmpeg', '-y', '-v', 'error']
+    for strip_image in strip_images:
+        command += ['-i', strip_image]
+    inputs = ''.join(f"[{index}:v]" for index in range(len(strip_images)))
+    return command + [
+        '-filter_complex', f"{inputs}vstack=inputs={len(strip_images)}[sprite]",
+        '-map', '[sprite]', '-frames:v', '1', '-q:v', '5', sprite_image
+    ]
+
+def run_thumbnails_command(command, resource_id):
+    process = transcoding.run_ffmpeg(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        logging.error(f"FFmpeg error for thumbnails of {resource_id}: {process.stderr.decode(errors='replace')}")
+    return process.returncode == 0
+
+def format_vtt_timestamp(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+def build_storyboard_vtt(sprite_name, timestamps, duration, tile_size, columns):
+    """Returns a WebVTT index mapping each storyboard time range to its tile of the sprite."""
+    width, height = tile_size
+    columns = get_storyboard_layout(len(timestamps), columns)[0]
+    lines = ['WEBVTT', '']
+    for index, start in enumerate(timestamps):
+        end = timestamps[index + 1] if index + 1 < len(timestamps) else max(duration or 0, start + 1)
+        x, y = (index % columns) * width, (index // columns) * height
+        lines += [
+            f"{format_vtt_timestamp(start)} --> {format_vtt_timestamp(end)}",
+            f"{sprite_name}#xywh={x},{y},{width},{height}",
+            ''
+        ]
+    return '\n'.join(lines)
+
+def generate_thumbnails(source_file, output_folder, resource, timestamps=None):
+    """
+    Saves a video's poster as its preview image and publishes its storyboard.
+
+    The storyboard is a sprite of STORYBOARD_TILE_WIDTH x STORYBOARD_TILE_HEIGHT
+    tiles with a WebVTT index (storyboard.jpg and storyboard.vtt in output_folder),
+    taken every STORYBOARD_INTERVAL seconds unless timestamps are given. Long
+    storyboards are rendered STORYBOARD_INPUTS_PER_COMMAND tiles at a time, in
+    strips of whole rows that are then stacked into the sprite.
+
+    Args:
+        source_file: Path or URL of the source video
+        output_folder: Storage prefix for the storyboard, e.g. the HLS folder
+        resource: The Resource database object
+        timestamps: Optional storyboard frame times in seconds
+
+    Returns:
+        The resource, or None if the thumbnails couldn't be generated
+    """
+    if resource.video_duration is None:
+        probe = utils.probe_media(source_file)
+        if probe:
+            utils.apply_media_probe(resource, probe)
+
+    duration = resource.video_duration
+    tile_size = (current_app.config['STORYBOARD_TILE_WIDTH'], current_app.config['STORYBOARD_TILE_HEIGHT'])
+    columns = current_app.config['STORYBOARD_COLUMNS']
+    timestamps = get_storyboard_timestamps(
+        duration,
+        current_app.config['STORYBOARD_INTERVAL'],
+        current_app.config['STORYBOARD_MAX_TILES'],
+        timestamps
+    )
+
+    work_folder = tempfile.mkdtemp(prefix='thumbnails-')
+    poster_image = os.path.join(work_folder, 'poster.jpg')
+    sprite_image = os.path.join(work_folder, 'storyboard.jpg')
+    try:
+        batches = get_storyboard_batches(timestamps, columns, current_app.config['STORYBOARD_INPUTS_PER_COMMAND'])
+        if len(batches) == 1:
+            strip_images = [sprite_image]
+        else:
+            strip_images = [os.path.join(work_folder, f"strip-{index}.png") for index in range(len(batches))]
+
+        for index, batch in enumerate(batches):
+            layout = None if len(batches) == 1 else (columns, int(math.ceil(len(batch) / columns)))
+            command = build_thumbnails_command(
+                source_file, poster_image if index == 0 else None, strip_images[index], batch,
+                get_poster_timestamp(duration), tile_size, columns, layout
+            )
+            if not run_thumbnails_command(command, resource.id):
+                return None
+        if len(batches) > 1 and not run_thumbnails_command(build_stack_command(strip_images, sprite_image), resource.id):
+            return None
+        if not os.path.exists(sprite_image):
+            logging.error(f"FFmpeg wrote no storyboard for {resource.id}")
+            return None
+
+        vtt_file = os.path.join(work_folder, 'storyboard.vtt')
+        with open(vtt_file, 'w') as f:
+            f.write(build_storyboard_vtt('storyboard.jpg', timestamps, duration, tile_size, columns))
+
+        bucket = utils.get_bucket(utils.get_eino_storage_bucket_name())
+        poster_key = f"{resource.company}/{resource.created_by}/video-preview-{resource.id}.jpg"
+        bucket.blob(poster_key).upload_from_filename(poster_image, content_type='image/jpeg')
+        # Players fetch the storyboard directly, like the HLS output next to it
+        bucket.blob(f"{output_folder}/storyboard.jpg").upload_from_filename(sprite_image, content_type='image/jpeg', predefined_acl='publicRead')
+        bucket.blob(f"{output_folder}/storyboard.vtt").upload_from_filename(vtt_file, content_type='text/vtt', predefined_acl='publicRead')
+
+        resource.preview_image = poster_key
+        resource.storyboard_url = f"https://storage.googleapis.com/{current_app.config['GCS_STORAGE_EINO_BUCKET_NAME']}/{output_folder}/storyboard.vtt"
+        db.session.add(resource)
+        db.session.commit()
+        return resource
+    except Exception as ex:
+        logging.error(f"Error generating thumbnails for {resource.id}: {ex}")
+        return None
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
@@ -0,0 +1,220 @@
+import os
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+# Process-wide transcoding scheduler, see get_transcode_scheduler()
+TRANSCODE_SCHEDULER = None
+TRANSCODE_SCHEDULER_LOCK = threading.Lock()
+
+# ffmpeg options that take no value, needed to tell option values from output paths
+FFMPEG_FLAGS = {
+    '-y', '-n', '-nostdin', '-hide_banner', '-nostats', '-stats', '-re', '-copyts',
+    '-accurate_seek', '-noaccurate_seek', '-shortest', '-vn', '-an', '-sn', '-dn'
+}
+
+def get_cpu_count():
+    """
+    Returns the number of CPUs this process may actually use.
+
+    The cgroup CPU quota (v2, then v1) wins over the affinity mask, since a
+    container usually sees every host core while only being allowed a few.
+    """
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()[:2]
+            if limit != 'max':
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+
+    if quota is not None:
+        return max(1, min(available, int(quota)))
+    return max(1, available)
+
+class TranscodeScheduler:
+    """
+    Runs a bounded number of ffmpeg jobs at once, each with a fixed thread budget.
+
+    Background work goes through submit(), which queues it on a pool of
+    max_jobs workers. Every ffmpeg invocation, queued or called inline (e.g. from
+    the Pub/Sub handler), goes through run() and takes one of max_jobs slots, so
+    the number of concurrent encoders per process never exceeds max_jobs.
+    """
+
+    def __init__(self, max_jobs, threads_per_job):
+        self.max_jobs = max_jobs
+        self.threads_per_job = threads_per_job
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='transcode')
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, func, *args, **kwargs):
+        with self.lock:
+            self.queued += 1
+            depth = self.queued
+        if depth > self.max_jobs:
+            logging.info(f"Transcode queue depth is {depth} with {self.max_jobs} workers")
+
+        def job():
+            with self.lock:
+                self.queued -= 1
+            try:
+                return func(*args, **kwargs)
+            except Exception as ex:
+                logging.error(f"Exception in transcode job {getattr(func, '__name__', func)}: {ex}")
+                raise
+
+        return self.executor.submit(job)
+
+    def with_thread_budget(self, command):
+        """
+        Applies the job's thread budget to every decoder, encoder and filter graph of an ffmpeg command.
+
+        Each input and each output gets -threads unless its own options already
+        set it, and the filter thread counts are set globally, so multi-output
+        commands can't exceed the budget with ffmpeg's automatic threading.
+        """
+        threads = str(self.threads_per_job)
+        budget = ['-threads', threads]
+        result = [command[0]]
+        for option in ('-filter_threads', '-filter_complex_threads'):
+            if option not in command:
+                result += [option, threads]
+
+        options = []
+        index = 1
+        while index < len(command):
+            token = command[index]
+            if token == '-i' or (token.startswith('-') and token != '-' and token not in FFMPEG_FLAGS):
+                if token == '-i' and '-threads' not in options:
+                    options += budget
+                options += command[index:index + 2]
+                if token == '-i':
+                    result += options
+                    options = []
+                index += 2
+            elif token in FFMPEG_FLAGS:
+                options.append(token)
+                index += 1
+            else:
+                # Anything else is an output path, taking the options collected since the last file
+                if '-threads' not in options:
+                    options += budget
+                result += options + [token]
+                options = []
+                index += 1
+        return result + options
+
+    @contextmanager
+    def slot(self):
+        """Holds one of the max_jobs encoder slots, for ffmpeg processes that can't go through run()."""
+        with self.slots:
+            with self.lock:
+                self.running += 1
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+    def run(self, command, **kwargs):
+        """subprocess.run() for an ffmpeg command, holding a transcode slot for its duration."""
+        with self.slot():
+            process = subprocess.run(self.with_thread_budget(command), **kwargs)
+        self.record(process.returncode)
+        return process
+
+    def record(self, returncode):
+        """Counts a finished ffmpeg process towards the completed or failed totals."""
+        with self.lock:
+            if returncode == 0:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_jobs': self.max_jobs,
+                'threads_per_job': self.threads_per_job,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed
+            }
+
+def get_transcode_scheduler():
+    """
+    Returns this process's transcoding scheduler, sizing it on first use.
+
+    TRANSCODE_THREADS_PER_JOB defaults to TRANSCODE_DEFAULT_THREADS capped at the
+    CPU count, and TRANSCODE_MAX_JOBS to as many such jobs as fit in the CPUs.
+    """
+    global TRANSCODE_SCHEDULER
+
+    if TRANSCODE_SCHEDULER is None:
+        with TRANSCODE_SCHEDULER_LOCK:
+            if TRANSCODE_SCHEDULER is None:
+                cpus = get_cpu_count()
+                threads_per_job = current_app.config['TRANSCODE_THREADS_PER_JOB'] or min(cpus, current_app.config['TRANSCODE_DEFAULT_THREADS'])
+                max_jobs = current_app.config['TRANSCODE_MAX_JOBS'] or max(1, cpus // threads_per_job)
+                logging.info(f"Transcoding with {max_jobs} jobs of {threads_per_job} threads on {cpus} CPUs")
+                TRANSCODE_SCHEDULER = TranscodeScheduler(max_jobs, threads_per_job)
+    return TRANSCODE_SCHEDULER
+
+def submit_transcode(func, *args, **kwargs):
+    """Queues a transcoding job (convert_to_mp4, create_stream, ...) on the scheduler."""
+    return get_transcode_scheduler().submit(func, *args, **kwargs)
+
+def run_ffmpeg(command, **kwargs):
+    """Runs an ffmpeg command within the scheduler's concurrency and thread budget."""
+    return get_transcode_scheduler().run(command, **kwargs)
+
+def transcode_slot():
+    """Context manager holding a transcode slot, see TranscodeScheduler.slot()."""
+    return get_transcode_scheduler().slot()
+
+def with_thread_budget(command):
+    """Adds the scheduler's -threads budget to an ffmpeg command."""
+    return get_transcode_scheduler().with_thread_budget(command)
+
+def record_transcode_result(returncode):
+    """Counts an ffmpeg process started under transcode_slot(), see TranscodeScheduler.record()."""
+    get_transcode_scheduler().record(returncode)
+
+def get_transcode_stats():
+    """Returns the scheduler's queue depth and counters, or None if nothing was transcoded yet."""
+    if TRANSCODE_SCHEDULER is None:
+        return None
+    return TRANSCODE_SCHEDULER.stats()
+
+def reset_transcode_scheduler():
+    """Drops the scheduler so it's sized again from the current config (used by tests)."""
+    global TRANSCODE_SCHEDULER
+
+    with TRANSCODE_SCHEDULER_LOCK:
+        scheduler, TRANSCODE_SCHEDULER = TRANSCODE_SCHEDULER, None
+    if scheduler is not None:
+        scheduler.executor.shutdown(wait=False)
@@ -6,18 +6,81 @@ import logging
 import subprocess
 import time
 import io
-import fitz
+import json
+import jwt
+import shutil
+import hashlib
 import threading
+from contextlib import contextmanager, ExitStack
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from flask import Response, current_app, request
+import google.auth
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 from google.auth.transport.requests import AuthorizedSession
 from google.oauth2 import service_account
 from extensions import db
+from sqlalchemy import text, create_engine
+from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import Session
+from . import transcoding
+from . import segment_upload
 
 
 CHUNK_FOLDER_PATH = 'chunk_files'
+# GCS only accepts non-final resumable upload ranges in multiples of 256 KiB
+RESUMABLE_UPLOAD_ALIGNMENT = 256 * 1024
+# Maximum number of source objects accepted by a single GCS compose request
+COMPOSE_MAX_SOURCES = 32
+
+# Full HLS quality ladder, trimmed to each source by get_encoding_ladder()
+HLS_QUALITY_LADDER = [
+    {'name': '360p', 'resolution': '640x360', 'bitrate': '1M', 'crf': '28', 'bandwidth': '1000000'},
+    {'name': '480p', 'resolution': '854x480', 'bitrate': '2M', 'crf': '26', 'bandwidth': '2000000'},
+    {'name': '720p', 'resolution': '1280x720', 'bitrate': '4M', 'crf': '24', 'bandwidth': '4000000'},
+    {'name': '1080p', 'resolution': '1920x1080', 'bitrate': '8M', 'crf': '22', 'bandwidth': '8000000'}
+]
+
+# Process-wide GCS client and bucket registry, see get_storage_client()
+STORAGE_CLIENTS = {}
+STORAGE_BUCKETS = {}
+STORAGE_CLIENT_LOCK = threading.Lock()
+
+# LRU cache of signed URLs, see get_signed_url()
+SIGNED_URL_CACHE = OrderedDict()
+SIGNED_URL_CACHE_LOCK = threading.Lock()
+# V4 signed URLs can live for at most 7 days
+SIGNED_URL_MAX_EXPIRATION = 7 * 24 * 3600
+
+# Service tokens minted per (company_user, company, user), see get_auth_token_from_company_user()
+SERVICE_TOKENS = {}
+SERVICE_TOKENS_IN_FLIGHT = {}
+SERVICE_TOKENS_LOCK = threading.Lock()
+SERVICE_TOKEN_SESSION = requests.Session()
+
+# In-process per-resource locks used when the database has no advisory locks, see resource_lock()
+RESOURCE_LOCKS = {}
+RESOURCE_LOCKS_LOCK = threading.Lock()
+# Unpooled engines holding advisory locks, per database URL, see get_lock_engine()
+LOCK_ENGINES = {}
+
+# Template preview images shared by every resource of a type, see get_template_preview_key()
+TEMPLATE_PREVIEW_PREFIX = 'template_previews'
+TEMPLATE_PREVIEW_KEYS = {}
+TEMPLATE_PREVIEW_LOCK = threading.Lock()
+
+# Source download counters, see get_download_stats()
+DOWNLOAD_STATS = {'downloads': 0, 'sliced': 0, 'bytes': 0, 'seconds': 0.0}
+DOWNLOAD_STATS_LOCK = threading.Lock()
+# Shared by the download threads, so every slice reuses a warm connection
+DOWNLOAD_SESSION = requests.Session()
+DOWNLOAD_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# (connect, read) seconds, the read timeout applying to every wait for more bytes
+DOWNLOAD_TIMEOUT = (10, 60)
 
 def get_random_uuid():
     return str(uuid.uuid4())
@@ -40,8 +103,9 @@ def get_upload_response(response = {}, status=200, extra_headers: dict = {}):
     headers = {
         'Access-Control-Allow-Origin': "*",
         'Access-Control-Allow-Methods': "PATCH,HEAD,GET,POST,OPTIONS",
-        'Access-Control-Expose-Headers': "Tus-Resumable,upload-length,upload-metadata,Location,Upload-Offset",
-        'Access-Control-Allow-Headers': "Tus-Resumable,upload-length,upload-metadata,Location,Upload-Offset,content-type",
+        'Access-Control-Expose-Headers': "Tus-Resumable,upload-length,upload-metadata,Location,Upload-Offset,Upload-Concat",
+        'Access-Control-Allow-Headers': "Tus-Resumable,upload-length,upload-metadata,Location,Upload-Offset,Upload-Concat,content-type",
+        'Tus-Extension': 'concatenation',
         'Cache-Control': 'no-store',
         **extra_headers
     }
@@ -57,13 +121,59 @@ def create_chunk_file(filename: str, data: str):
     with open(f"{CHUNK_FOLDER_PATH}/{filename}", 'wb') as f:
         f.write(data)
 
+def create_storage_client(credentials_path, project_id):
+    """Builds a GCS client whose HTTP session keeps a connection pool sized for our upload threads."""
+    if credentials_path:
+        credentials = service_account.Credentials.from_service_account_file(credentials_path, scopes=storage.Client.SCOPE)
+    else:
+        credentials, default_project = google.auth.default(scopes=storage.Client.SCOPE)
+        project_id = project_id or default_project
+
+    # The AuthorizedSession refreshes access tokens by itself; only the pool needs tuning
+    pool_size = current_app.config['GCS_HTTP_POOL_SIZE']
+    session = AuthorizedSession(credentials)
+    session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    return storage.Client(credentials=credentials, project=project_id, _http=session)
+
 def get_storage_client():
-    """Returns an authenticated GCS client using the service account credentials."""
+    """
+    Returns the process-wide authenticated GCS client.
+
+    Clients are cached per process and credentials file, so every call reuses
+    the same warm connection pool. The cached client is rebuilt when the service
+    account file changes on disk (key rotation) or after a fork.
+    """
     credentials_path = current_app.config.get('GCP_SERVICE_ACCOUNT_FILE')
-    if credentials_path and os.path.exists(credentials_path):
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        return storage.Client(credentials=credentials, project=current_app.config.get('GCP_PROJECT_ID'))
-    return storage.Client()
+    if not (credentials_path and os.path.exists(credentials_path)):
+        credentials_path = None
+    credentials_mtime = os.path.getmtime(credentials_path) if credentials_path else None
+    project_id = current_app.config.get('GCP_PROJECT_ID')
+    cache_key = (os.getpid(), credentials_path, project_id)
+
+    with STORAGE_CLIENT_LOCK:
+        cached = STORAGE_CLIENTS.get(cache_key)
+        if cached is None or cached[1] != credentials_mtime:
+            cached = (create_storage_client(credentials_path, project_id), credentials_mtime)
+            STORAGE_CLIENTS[cache_key] = cached
+        return cached[0]
+
+def get_bucket(bucket_name):
+    """Returns a cached bucket handle bound to the process-wide GCS client."""
+    client = get_storage_client()
+    cache_key = (id(client), bucket_name)
+
+    with STORAGE_CLIENT_LOCK:
+        bucket = STORAGE_BUCKETS.get(cache_key)
+        if bucket is None or bucket.client is not client:
+            bucket = client.bucket(bucket_name)
+            STORAGE_BUCKETS[cache_key] = bucket
+        return bucket
+
+def reset_storage_clients():
+    """Drops all cached GCS clients and bucket handles."""
+    with STORAGE_CLIENT_LOCK:
+        STORAGE_CLIENTS.clear()
+        STORAGE_BUCKETS.clear()
 
 def get_storage_bucket_name():
     """Returns the name of the GCS bucket for temporary chunk storage."""
@@ -77,12 +187,11 @@ def get_eino_storage_bucket_name():
 
 def save_chunk_to_storage(resource_id, chunk_id):
     """Uploads a chunk file to GCS bucket."""
-    storage_client = get_storage_client()
     bucket_name = get_storage_bucket_name()
     file_key = f"{resource_id}/{chunk_id}"
     local_file_path = f"{CHUNK_FOLDER_PATH}/{chunk_id}"
     
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(file_key)
     blob.upload_from_filename(local_file_path)
     
@@ -102,9 +211,8 @@ def delete_chunk_file(chunk_id):
 
 def delete_chunks(resource):
     chunks = resource.chunks
-    storage_client = get_storage_client()
     bucket_name = get_storage_bucket_name()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
 
     for chunk in chunks:
         chunk.is_deleted = True
@@ -150,10 +258,9 @@ def get_resource_storage_key(resource):
 
 def create_resumable_upload_session(resource):
     """Creates a resumable upload session to GCS."""
-    storage_client = get_storage_client()
     bucket_name = get_eino_storage_bucket_name()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(get_resource_storage_key(resource))
+    bucket = get_bucket(bucket_name)
+    blob = bucket.blob(get_upload_storage_key(resource))
     
     # Create a resumable upload session
     session_uri = blob.create_resumable_upload_session(
@@ -163,21 +270,277 @@ def create_resumable_upload_session(resource):
     
     return session_uri
 
+def is_partial_upload(resource):
+    """Checks if the resource is a TUS `partial` upload waiting to be concatenated."""
+    return resource.status in ['PARTIAL_UPLOADING', 'PARTIAL_FINISHED']
+
+def get_upload_storage_key(resource):
+    """Returns the key the upload session writes to; partial uploads get a private scratch key."""
+    if is_partial_upload(resource):
+        return f"{resource.company}/{resource.created_by}/partial-{resource.id}"
+    return get_resource_storage_key(resource)
+
+def compose_blobs(bucket, sources, destination, content_type=None):
+    """
+    Builds `destination` from `sources` in order using server-side GCS compose.
+
+    A single compose request accepts at most 32 sources, so larger lists are
+    composed level by level through temporary intermediate objects.
+
+    Args:
+        bucket: GCS bucket holding both the sources and the destination
+        sources: Ordered list of source blobs
+        destination: The blob to create
+        content_type: Optional content type for the composed object
+
+    Returns:
+        The destination blob
+    """
+    intermediates = []
+    level = 0
+    try:
+        while len(sources) > COMPOSE_MAX_SOURCES:
+            next_sources = []
+            for index in range(0, len(sources), COMPOSE_MAX_SOURCES):
+                group = sources[index:index + COMPOSE_MAX_SOURCES]
+                if len(group) == 1:
+                    next_sources.append(group[0])
+                    continue
+                intermediate = bucket.blob(f"{destination.name}.compose-{level}-{index // COMPOSE_MAX_SOURCES}")
+                intermediate.compose(group)
+                intermediates.append(intermediate)
+                next_sources.append(intermediate)
+            sources = next_sources
+            level += 1
+
+        if content_type:
+            destination.content_type = content_type
+        destination.compose(sources)
+    finally:
+        for intermediate in intermediates:
+            try:
+                intermediate.delete()
+            except Exception as ex:
+                logging.error(f"Failed to delete intermediate compose object {intermediate.name}: {ex}")
+
+    return destination
+
+def iter_blob_contents(blobs, prefetch=4):
+    """
+    Yields the contents of `blobs` in order, downloading the next few concurrently.
+
+    At most `prefetch` downloads are in flight ahead of the consumer, so memory
+    is bounded by `prefetch + 1` chunks rather than the whole file.
+    """
+    blobs = iter(blobs)
+    executor = ThreadPoolExecutor(max_workers=max(1, prefetch))
+    pending = deque()
+    try:
+        for blob in blobs:
+            pending.append(executor.submit(blob.download_as_bytes))
+            if len(pending) >= prefetch:
+                break
+
+        while pending:
+            data = pending.popleft().result()
+            next_blob = next(blobs, None)
+            if next_blob is not None:
+                pending.append(executor.submit(next_blob.download_as_bytes))
+            yield data
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def rewrite_blob(source, destination):
+    """
+    Copies `source` to `destination` with the GCS rewrite API, across buckets if needed.
+
+    Large or cross-location copies may take several rewrite calls; the token
+    returned by each call resumes the copy server-side.
+    """
+    token, bytes_rewritten, total_bytes = destination.rewrite(source)
+    while token is not None:
+        token, bytes_rewritten, total_bytes = destination.rewrite(source, token=token)
+    return destination
+
+def get_upload_tail_key(resource_id):
+    """Returns the chunk bucket key holding the unaligned tail of a resumable upload."""
+    return f"{resource_id}/upload-tail"
+
+def read_upload_slice(stream, size):
+    """Reads up to `size` bytes from a stream, returning fewer only at end of stream."""
+    data = bytearray()
+    while len(data) < size:
+        piece = stream.read(size - len(data))
+        if not piece:
+            break
+        data += piece
+    return data
+
+def put_resumable_upload_range(session_uri, data, start, total_size=None):
+    """
+    Sends one range of bytes to a GCS resumable upload session.
+
+    Args:
+        session_uri: The resumable session URI stored in Resource.upload_id
+        data: The bytes to send, starting at `start`
+        start: Object offset of the first byte in `data`
+        total_size: Full object size when this range finalizes the upload, otherwise None
+
+    Returns:
+        The number of bytes GCS has persisted for the object
+
+    If GCS persists only part of the range, the rest is sent again for as long
+    as each request makes progress.
+    """
+    data = bytes(data)
+    timeout = (10, current_app.config['RESUMABLE_UPLOAD_TIMEOUT'])
+    total = total_size if total_size is not None else '*'
+    while True:
+        end = start + len(data) - 1
+        headers = {'Content-Range': f"bytes {start}-{end}/{total}" if data else f"bytes */{total}"}
+        res = requests.put(session_uri, data=data, headers=headers, timeout=timeout)
+
+        if res.status_code in (200, 201):
+            return total_size
+        if res.status_code != 308:
+            raise Exception(f"Resumable upload failed with status {res.status_code}: {res.text}")
+
+        persisted = res.headers.get('Range')
+        persisted = int(persisted.split('-')[-1]) + 1 if persisted else 0
+        if persisted == start + len(data):
+            return persisted
+        if not start < persisted < start + len(data):
+            raise Exception(f"Resumable upload persisted {persisted} bytes, expected {start + len(data)}")
+        data = data[persisted - start:]
+        start = persisted
+
+def append_to_resumable_upload(resource, stream):
+    """
+    Streams a PATCH body into the resource's GCS resumable upload session.
+
+    The body is read in bounded slices and forwarded with matching Content-Range
+    offsets, so the object grows across PATCHes and memory stays constant. GCS only
+    accepts non-final ranges in multiples of 256 KiB, so the unaligned tail of each
+    PATCH is parked in the chunk bucket and sent ahead of the next one.
+
+    Args:
+        resource: The multipart Resource with an open session in `upload_id`
+        stream: A file-like object yielding the PATCH body
+
+    Returns:
+        The number of body bytes accepted from the client
+    """
+    alignment = RESUMABLE_UPLOAD_ALIGNMENT
+    slice_size = max(alignment, current_app.config['RESUMABLE_UPLOAD_SLICE_SIZE'] // alignment * alignment)
+    size = int(resource.size)
+    offset = resource.offset or 0
+
+    chunk_bucket = get_bucket(get_storage_bucket_name())
+    tail_blob = chunk_bucket.blob(get_upload_tail_key(resource.id))
+
+    if offset >= size:
+        return 0
+
+    persisted = offset - offset % alignment
+    buffer = bytearray(tail_blob.download_as_bytes()) if offset % alignment else bytearray()
+    pending_tail = len(buffer)
+    received = 0
+
+    try:
+        while True:
+            want = min(slice_size - len(buffer), size - persisted - len(buffer))
+            piece = read_upload_slice(stream, want) if want > 0 else b''
+            received += len(piece)
+            buffer += piece
+
+            if persisted + len(buffer) == size:
+                persisted = put_resumable_upload_range(resource.upload_id, buffer, persisted, total_size=size)
+                buffer = bytearray()
+                pending_tail = 0
+                break
+            if len(buffer) < slice_size:
+                break
+
+            persisted = put_resumable_upload_range(resource.upload_id, buffer, persisted)
+            buffer = bytearray()
+            pending_tail = 0
+
+        aligned = len(buffer) - len(buffer) % alignment
+        if aligned:
+            persisted = put_resumable_upload_range(resource.upload_id, buffer[:aligned], persisted)
+            del buffer[:aligned]
+            pending_tail = 0
+        if buffer:
+            tail_blob.upload_from_string(bytes(buffer))
+        elif persisted == size and tail_blob.exists():
+            tail_blob.delete()
+    except Exception:
+        # Only keep the offset GCS has persisted (plus a still untouched tail) so the client resumes from there
+        resource.offset = persisted + pending_tail
+        db.session.add(resource)
+        db.session.commit()
+        raise
+
+    resource.offset = persisted + len(buffer)
+    return received
+
 def get_signed_url(resource_key, expiration=3600, method='GET'):
-    """Generate a signed URL for the given resource key."""
-    storage_client = get_storage_client()
+    """
+    Generate a signed URL for the given resource key.
+
+    URLs are signed locally with the cached client's credentials, for a little
+    longer than asked (SIGNED_URL_CACHE_SLACK), and cached per (key, method,
+    expiration). A cached URL is handed out only while it still has at least
+    `expiration` seconds to live.
+    """
     bucket_name = get_eino_storage_bucket_name()
-    bucket = storage_client.bucket(bucket_name)
+    cache_key = (bucket_name, resource_key, method, expiration)
+    now = time.time()
+
+    with SIGNED_URL_CACHE_LOCK:
+        cached = SIGNED_URL_CACHE.get(cache_key)
+        if cached and cached[1] - now >= expiration:
+            SIGNED_URL_CACHE.move_to_end(cache_key)
+            return cached[0]
+
+    lifetime = min(expiration + current_app.config['SIGNED_URL_CACHE_SLACK'], SIGNED_URL_MAX_EXPIRATION)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(resource_key)
     
     url = blob.generate_signed_url(
         version="v4",
-        expiration=expiration,
+        expiration=lifetime,
         method=method
     )
+
+    with SIGNED_URL_CACHE_LOCK:
+        SIGNED_URL_CACHE[cache_key] = (url, now + lifetime)
+        SIGNED_URL_CACHE.move_to_end(cache_key)
+        while len(SIGNED_URL_CACHE) > current_app.config['SIGNED_URL_CACHE_SIZE']:
+            SIGNED_URL_CACHE.popitem(last=False)
     
     return url
 
+def is_tenant_storage_key(resource_key, company):
+    """Checks that a storage key lives under the given company's prefix, or is a shared template preview."""
+    if not company or not isinstance(resource_key, str) or '..' in resource_key:
+        return False
+    parts = resource_key.split('/')
+    if parts[0] == TEMPLATE_PREVIEW_PREFIX:
+        return len(parts) == 2
+    if parts[0] == 'hls_media':
+        parts = parts[1:]
+    return len(parts) > 1 and parts[0] == company
+
+def get_signed_urls(resource_keys, expiration=3600):
+    """Signs GET URLs for many resource keys at once, reusing cached URLs where possible."""
+    return {resource_key: get_signed_url(resource_key, expiration=expiration) for resource_key in resource_keys}
+
+def clear_signed_url_cache():
+    """Drops every cached signed URL."""
+    with SIGNED_URL_CACHE_LOCK:
+        SIGNED_URL_CACHE.clear()
+
 
 def get_extension(resource):
     """Gets the file extension from the resource."""
@@ -207,33 +570,196 @@ def is_video_file(content_type):
     """Checks if the content type is for video."""
     return content_type and 'video' in content_type
 
-def get_auth_token_from_company_user(company_user, company, user):
-    """Gets authentication token for a company user."""
+def fetch_company_user_token(company_user, company, user):
+    """
+    Mints a token for a company user through the Django API.
+
+    Returns:
+        (token_data, expires_at) where expires_at is a unix timestamp, or (None, None) on failure
+    """
     data = {
         'company_user': company_user,
         'user': user,
         'company': company
     }
-    res = requests.post(f"{current_app.config['DJANGO_BASE_URL']}/api/v2/company/get_company_user_token/", json=data)
+    res = SERVICE_TOKEN_SESSION.post(
+        f"{current_app.config['DJANGO_BASE_URL']}/api/v2/company/get_company_user_token/",
+        json=data,
+        timeout=current_app.config['SERVICE_TOKEN_REQUEST_TIMEOUT']
+    )
     
-    if res.ok:
-        return res.json()
-    else:
-        logging.error("Auth Token error during resource save")
-        return {'access_token': None}
+    if not res.ok:
+        logging.error(f"Auth Token error for company user {company_user}. Status: {res.status_code}")
+        return None, None
+
+    body = res.json()
+    token_data = body.get('data') if isinstance(body.get('data'), dict) else body
+
+    # Tokens are JWTs; read their expiry without verifying, Django is the issuer
+    try:
+        expires_at = jwt.decode(token_data.get('access_token'), options={'verify_signature': False}).get('exp')
+    except Exception:
+        expires_at = None
+    if not expires_at:
+        expires_at = time.time() + current_app.config['SERVICE_TOKEN_DEFAULT_TTL']
+
+    return token_data, expires_at
+
+def refresh_company_user_token(cache_key):
+    """Mints a token for the identity, collapsing concurrent refreshes into a single request."""
+    with SERVICE_TOKENS_LOCK:
+        in_flight = SERVICE_TOKENS_IN_FLIGHT.get(cache_key)
+        is_leader = in_flight is None
+        if is_leader:
+            in_flight = threading.Event()
+            SERVICE_TOKENS_IN_FLIGHT[cache_key] = in_flight
+
+    if not is_leader:
+        in_flight.wait(current_app.config['SERVICE_TOKEN_REQUEST_TIMEOUT'])
+        with SERVICE_TOKENS_LOCK:
+            cached = SERVICE_TOKENS.get(cache_key)
+        return cached[0] if cached and cached[1] > time.time() else None
+
+    try:
+        token_data, expires_at = fetch_company_user_token(*cache_key)
+        if token_data:
+            with SERVICE_TOKENS_LOCK:
+                SERVICE_TOKENS[cache_key] = (token_data, expires_at)
+        return token_data
+    except Exception as ex:
+        logging.error(f"Exception in refresh_company_user_token: {ex}")
+        return None
+    finally:
+        with SERVICE_TOKENS_LOCK:
+            SERVICE_TOKENS_IN_FLIGHT.pop(cache_key, None)
+        in_flight.set()
+
+def refresh_company_user_token_in_background(app, cache_key):
+    """Refreshes a token that is about to expire without making the caller wait."""
+    def refresh():
+        with app.app_context():
+            refresh_company_user_token(cache_key)
+
+    with SERVICE_TOKENS_LOCK:
+        if cache_key in SERVICE_TOKENS_IN_FLIGHT:
+            return
+    threading.Thread(target=refresh, daemon=True).start()
+
+def get_auth_token_from_company_user(company_user, company, user):
+    """
+    Returns the token data (with `access_token`) for a company user, or None.
+
+    Tokens are cached per (company_user, company, user) until SERVICE_TOKEN_EXPIRY_MARGIN
+    seconds before they expire. Within SERVICE_TOKEN_REFRESH_MARGIN of expiry the cached
+    token is still returned while a fresh one is minted in the background.
+    """
+    cache_key = (company_user, company, user)
+    now = time.time()
+
+    with SERVICE_TOKENS_LOCK:
+        cached = SERVICE_TOKENS.get(cache_key)
+
+    if cached and now < cached[1] - current_app.config['SERVICE_TOKEN_EXPIRY_MARGIN']:
+        if now >= cached[1] - current_app.config['SERVICE_TOKEN_REFRESH_MARGIN']:
+            refresh_company_user_token_in_background(current_app._get_current_object(), cache_key)
+        return cached[0]
+
+    return refresh_company_user_token(cache_key)
+
+def clear_service_tokens():
+    """Drops every cached service token."""
+    with SERVICE_TOKENS_LOCK:
+        SERVICE_TOKENS.clear()
+
+def get_advisory_lock_key(resource_id):
+    """Maps a resource id onto the signed 64-bit key space of Postgres advisory locks."""
+    digest = hashlib.blake2b(str(resource_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def get_lock_engine():
+    """
+    Returns an unpooled engine on the app's database for advisory locks.
+
+    A lock can be held for a whole transcode, so its connection must not come
+    out of the app's pool, and closing it must really disconnect, which also
+    drops any lock left on it.
+    """
+    url = db.engine.url
+    with RESOURCE_LOCKS_LOCK:
+        engine = LOCK_ENGINES.get(url)
+        if engine is None:
+            engine = LOCK_ENGINES[url] = create_engine(url, poolclass=NullPool)
+        return engine
+
+@contextmanager
+def resource_lock(resource_id, blocking=True):
+    """
+    Serializes work on a single resource across threads, workers and instances.
+
+    On Postgres this takes a session-level advisory lock on a dedicated, unpooled
+    connection (see get_lock_engine()), so it is released even if the process
+    dies. Other databases (SQLite in tests) fall back to a per-resource lock that
+    only covers the current process.
+
+    Yields:
+        True if the lock is held, False if blocking is False and it is already taken
+    """
+    if db.engine.dialect.name == 'postgresql':
+        key = get_advisory_lock_key(resource_id)
+        connection = get_lock_engine().connect()
+        try:
+            if blocking:
+                connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': key})
+                acquired = True
+            else:
+                acquired = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {'key': key}).scalar()
+            connection.commit()
+            try:
+                yield bool(acquired)
+            finally:
+                if acquired:
+                    try:
+                        connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': key})
+                        connection.commit()
+                    except Exception as ex:
+                        # Dropping the connection is the only other way to release the lock
+                        logging.error(f"Failed to release the lock on resource {resource_id}: {ex}")
+                        connection.invalidate()
+        finally:
+            connection.close()
+        return
+
+    with RESOURCE_LOCKS_LOCK:
+        entry = RESOURCE_LOCKS.setdefault(resource_id, [threading.Lock(), 0])
+        entry[1] += 1
+    acquired = entry[0].acquire(blocking)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            entry[0].release()
+        with RESOURCE_LOCKS_LOCK:
+            entry[1] -= 1
+            if entry[1] == 0:
+                RESOURCE_LOCKS.pop(resource_id, None)
 
 def save_resource_to_db(resource, need_auth=False, fileUploadFromChat=False):
     """
-    Saves a resource to the database.
+    Saves a resource to the Django database through the outbox.
+
+    The update is committed to the outbox together with the resource and
+    delivered by the background dispatcher, so callers never wait on Django.
     
     Args:
         resource: The resource object to save
-        need_auth: Whether authentication token is needed
+        need_auth: Kept for compatibility; the dispatcher always mints a token for the resource owner
         fileUploadFromChat: Whether file was uploaded from chat
     
     Returns:
-        Response data if successful, None otherwise
+        The outbox entry if queued, None otherwise
     """
+    from .outbox import enqueue_resource_update
+
     try:
         extension = get_extension(resource)
         resource_key = get_resource_storage_key(resource)
@@ -260,39 +786,13 @@ def save_resource_to_db(resource, need_auth=False, fileUploadFromChat=False):
         
         # If video has HLS streaming available, use that URL
         is_video = is_video_file(resource.type)
-        if is_video and resource.is_720p_done:
+        if is_video and (resource.hls_url or resource.is_720p_done):
             hls_folder = f"hls_media/{resource.company}/{resource.created_by}/{resource.id}"
-            gcs_url = f"https://storage.googleapis.com/{current_app.config['GCS_STORAGE_EINO_BUCKET_NAME']}/{hls_folder}/output.m3u8"
+            gcs_url = resource.hls_url or f"https://storage.googleapis.com/{current_app.config['GCS_STORAGE_EINO_BUCKET_NAME']}/{hls_folder}/output.m3u8"
             data['link_url'] = gcs_url
             data['document'] = None
         
-        # Set up headers based on authentication need
-        if need_auth:
-            user_data = get_auth_token_from_company_user(resource.company_user, resource.company, resource.created_by)
-            headers = {
-                'Authorization': f"Bearer {user_data.get('access_token')}",
-                'X-Tenant-ID': resource.company,
-                'Department-Id': resource.department
-            }
-        else:
-            headers = {
-                'Authorization': request.headers.get('Authorization'),
-                'X-Tenant-ID': request.headers.get('X-Tenant-ID'),
-                'Department-Id': resource.department
-            }
-        
-        # Make API request to save resource
-        res = requests.post(
-            f"{current_app.config['DJANGO_BASE_URL']}/api/v2/resource/save_chunk_resource/",
-            json=data,
-            headers=headers
-        )
-        
-        if res.ok:
-            return res.json()
-        else:
-            logging.error(f"Failed to save resource {resource.name} to DB. Status: {res.status_code}")
-            return None
+        return enqueue_resource_update(resource, data)
             
     except Exception as ex:
         logging.error(f"Exception in save_resource_to_db: {ex}")
@@ -367,9 +867,8 @@ def save_hls_file(event):
     from .service import delete_chunk_upload
 
     with app.app_context():
-        storage_client = get_storage_client()
         bucket_name = get_eino_storage_bucket_name()
-        bucket = storage_client.bucket(bucket_name)
+        bucket = get_bucket(bucket_name)
     
         path = event.src_path
         file_path = Path(path)
@@ -422,9 +921,8 @@ def save_stream_file(event):
             file_path = Path(path)
             
             if os.path.exists(path) and file_path.is_file() and not path.endswith('.tmp'):
-                storage_client = get_storage_client()
                 bucket_name = get_eino_storage_bucket_name()
-                bucket = storage_client.bucket(bucket_name)
+                bucket = get_bucket(bucket_name)
 
                 # Get relative path for GCS key
                 gcs_key = str(file_path.relative_to(os.getcwd()))
@@ -491,23 +989,129 @@ def is_processing_needed(type, need_processing=False):
     is_video = is_video_file(type)
     return is_video and need_processing
 
-def convert_to_mp3_file(file, resource):
-    """Converts an audio file to MP3 format."""
-    audio_command = ['ffmpeg', '-i', '-', '-vn', '-ar', '44100', '-ac', '2', '-b:a', '192k', f'{resource.id}.mp3']
-    file_memoryview = memoryview(file.getbuffer())
+def is_mp3_frame_header(header):
+    """Checks for an MPEG audio layer III frame sync."""
+    return len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0 and (header[1] >> 1) & 0x03 == 0x01
 
-    process = subprocess.Popen(
-        audio_command,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    process.communicate(input=file_memoryview)
+def is_mp3_blob(blob):
+    """
+    Sniffs whether a stored object is already MP3, skipping a leading ID3v2 tag.
 
-    mp3_file = open(f'{resource.id}.mp3', 'rb')
-    audio_bytes = io.BytesIO(mp3_file.read())
+    Reads at most two small ranges, whatever the content type the client claimed.
+    """
+    head = blob.download_as_bytes(start=0, end=9)
+    if head[:3] != b'ID3' or len(head) < 10:
+        return is_mp3_frame_header(head)
+
+    # The tag size is a 28-bit syncsafe integer, excluding the header and the optional footer
+    tag_size = 10 + ((head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | head[9] & 0x7F)
+    if head[5] & 0x10:
+        tag_size += 10
+    return is_mp3_frame_header(blob.download_as_bytes(start=tag_size, end=tag_size + 3))
+
+def feed_process(process, source, resource_id):
+    """Copies a file-like object into a process's stdin in bounded pieces, then closes it."""
+    try:
+        shutil.copyfileobj(source, process.stdin, 1024 * 1024)
+    except (BrokenPipeError, ValueError):
+        logging.error(f"ffmpeg stopped reading audio input for {resource_id}")
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+def convert_to_mp3_file(source_blob, destination_blob, resource):
+    """
+    Stores an audio object as MP3, streaming it through ffmpeg without touching local disk.
+
+    An object that already is MP3 is copied server-side. Anything else is read
+    from storage into ffmpeg's stdin by a feeder thread while ffmpeg's stdout
+    goes to a resumable upload in RESUMABLE_UPLOAD_SLICE_SIZE ranges, so memory
+    stays bounded by one slice whatever the length of the recording.
+
+    Args:
+        source_blob: The uploaded audio object
+        destination_blob: The blob to write the MP3 to
+        resource: The Resource database object
+
+    Returns:
+        The destination blob
+    """
+    if is_mp3_blob(source_blob):
+        destination_blob.content_type = 'audio/mpeg'
+        return rewrite_blob(source_blob, destination_blob)
+
+    alignment = RESUMABLE_UPLOAD_ALIGNMENT
+    slice_size = max(alignment, current_app.config['RESUMABLE_UPLOAD_SLICE_SIZE'] // alignment * alignment)
+    audio_command = ['ffmpeg', '-v', 'error', '-i', 'pipe:0', '-vn', '-ar', '44100', '-ac', '2', '-b:a', '192k', '-f', 'mp3', 'pipe:1']
+    session_uri = destination_blob.create_resumable_upload_session(content_type='audio/mpeg')
+
+    with transcoding.transcode_slot(), source_blob.open('rb', chunk_size=slice_size) as source:
+        process = subprocess.Popen(
+            transcoding.with_thread_budget(audio_command),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        feeder = threading.Thread(target=feed_process, args=(process, source, resource.id), daemon=True)
+        feeder.start()
+
+        persisted = 0
+        try:
+            while True:
+                data = read_upload_slice(process.stdout, slice_size)
+                if len(data) < slice_size:
+                    break
+                persisted = put_resumable_upload_range(session_uri, data, persisted)
+
+            if process.wait() != 0:
+                raise Exception(f"FFmpeg failed converting {resource.id} to MP3 with exit code {process.returncode}")
+            put_resumable_upload_range(session_uri, data, persisted, total_size=persisted + len(data))
+        except Exception:
+            process.kill()
+            # Drop the session so a half-written MP3 never becomes the object
+            try:
+                requests.delete(session_uri, timeout=(10, 30))
+            except Exception as ex:
+                logging.error(f"Failed to cancel the MP3 upload session of {resource.id}: {ex}")
+            raise
+        finally:
+            process.wait()
+            process.stdout.close()
+            feeder.join()
+            transcoding.record_transcode_result(process.returncode)
+
+    return destination_blob
+
+# Codecs any browser plays from an MP4 container without re-encoding
+MP4_VIDEO_CODECS = ('h264',)
+MP4_PIXEL_FORMATS = ('yuv420p', 'yuvj420p')
+MP4_AUDIO_CODECS = ('aac',)
+
+def get_mp4_conversion(probe):
+    """
+    Picks the cheapest way to turn a source into a streamable MP4.
+
+    Returns:
+        A (mode, codec options) tuple. mode is 'remux' when video and audio can be
+        stream-copied, 'audio' when only the audio needs re-encoding, and
+        'transcode' when the video does (or the source couldn't be probed).
+    """
+    transcode_audio = ['-c:a', 'aac', '-b:a', '192k', '-ac', '2']
+    video_ok = bool(probe) and probe['video_codec'] in MP4_VIDEO_CODECS and probe.get('pixel_format') in MP4_PIXEL_FORMATS
+    if not video_ok:
+        return 'transcode', [
+            '-c:v', 'libx264', '-profile:v', 'main', '-level', '4.0',
+            '-preset', 'medium', '-crf', '22',
+            *transcode_audio
+        ]
 
-    return audio_bytes
+    # Only the first video and audio streams; MOV timecode and data tracks don't fit in MP4
+    streams = ['-map', '0:v:0', '-map', '0:a:0?']
+    if probe['audio_codec'] is None or probe['audio_codec'] in MP4_AUDIO_CODECS:
+        return 'remux', streams + ['-c', 'copy']
+    return 'audio', streams + ['-c:v', 'copy', *transcode_audio]
 
 def convert_to_mp4(resource):
     """
@@ -517,20 +1121,18 @@ def convert_to_mp4(resource):
     from main import app
     from .service import delete_chunk_upload
     from . import pubsub_utils
+    from . import media_cache
    
     with app.app_context():
         try:
-            app.config['MP4_CONVERT_LOCK'].acquire()
-            
             # For Cloud environment, use Pub/Sub for async processing
             if current_app.config.get('USE_PUBSUB_FOR_MEDIA_PROCESSING', False):
                 # Publish a message to Pub/Sub for mp4 conversion
                 pubsub_utils.publish_mp4_conversion_task(resource.id)
                 return
                 
-            storage_client = get_storage_client()
             bucket_name = get_eino_storage_bucket_name()
-            bucket = storage_client.bucket(bucket_name)
+            bucket = get_bucket(bucket_name)
             resource_key = get_resource_storage_key(resource)
             
             signed_url = get_signed_url(resource_key, expiration=3600, method='GET')
@@ -542,44 +1144,77 @@ def convert_to_mp4(resource):
             res_key[-1] = output_name
             new_resource_key = '/'.join(res_key)
             
-            # Create a clean MP4 that's optimized for streaming
-            command = [
-                'ffmpeg', '-i', signed_url, 
-                '-c:v', 'libx264', '-profile:v', 'main', '-level', '4.0',
-                '-preset', 'medium', '-crf', '22', 
-                '-c:a', 'aac', '-b:a', '192k', '-ac', '2',
-                '-movflags', '+faststart',  # Important for streaming
-                output_name
-            ]
-            
-            process = subprocess.run(
-                command, 
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-
-            is_valid_file = os.path.exists(output_name) and os.stat(output_name).st_size > 0
+            # Every stage of this conversion reads one shared local copy of the source
+            with media_cache.cached_source(resource) as source_file:
+                # Stream-copy what's already browser compatible, re-encode only the rest
+                probe = probe_media(source_file)
+                if probe:
+                    apply_media_probe(resource, probe)
+                mode, codec_options = get_mp4_conversion(probe)
+                logging.info(f"Converting {resource.id} to MP4 with mode {mode}")
+
+                # With need_processing, the MP4 and the HLS ladder come out of one read and decode
+                if resource.need_processing and current_app.config.get('UNIFIED_MEDIA_PIPELINE', True) \
+                        and current_app.config.get('STREAMING_PACKAGING', 'hls') == 'hls':
+                    if generate_mp4_and_streams(resource, source_file, probe, mode, codec_options, output_filename, new_resource_key, bucket):
+                        if resource.is_multipart:
+                            delete_chunk_upload(resource.id)
+                        return
+                    logging.info(f"Encoding the MP4 and any pending HLS renditions of {resource.id} separately")
+
+                def build_command(options):
+                    # Create a clean MP4 that's optimized for streaming
+                    return [
+                        'ffmpeg', '-y', '-i', source_file,
+                        *options,
+                        '-movflags', '+faststart',  # Important for streaming
+                        output_name
+                    ]
+
+                if mode == 'transcode':
+                    process = transcoding.run_ffmpeg(
+                        build_command(codec_options),
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE
+                    )
+                else:
+                    # Copying is I/O bound, so it doesn't take a transcode slot
+                    process = subprocess.run(
+                        build_command(codec_options),
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE
+                    )
+                    if process.returncode != 0:
+                        logging.error(f"MP4 {mode} failed for {resource.id}, transcoding instead: {process.stderr.decode(errors='replace')}")
+                        process = transcoding.run_ffmpeg(
+                            build_command(get_mp4_conversion(None)[1]),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE
+                        )
+
+                is_valid_file = os.path.exists(output_name) and os.stat(output_name).st_size > 0
             
-            if is_valid_file:
-                # Upload the MP4 to GCS
-                new_blob = bucket.blob(new_resource_key)
-                new_blob.upload_from_filename(output_name)
-                os.remove(output_name)
-
-                # Update resource name to reflect MP4 conversion
-                resource.name = output_filename
-                db.session.commit()
+                if is_valid_file:
+                    # Upload the MP4 to GCS
+                    new_blob = bucket.blob(new_resource_key)
+                    new_blob.upload_from_filename(output_name)
+                    os.remove(output_name)
+
+                    # Update resource name to reflect MP4 conversion
+                    resource.name = output_filename
+                    db.session.commit()
                 
-                # If video processing is needed, generate HLS streams
-                if resource.need_processing:
-                    create_stream(signed_url, resource)
-                else:
-                    # Otherwise just save the MP4 resource
-                    save_resource_to_db(resource, True)
+                    # If video processing is needed, generate HLS streams
+                    if resource.need_processing:
+                        create_stream(source_file, resource)
+                    else:
+                        # Otherwise just save the MP4 resource
+                        save_resource_to_db(resource, True)
                     
-                # Clean up if using multipart upload
-                if resource.is_multipart:
-                    delete_chunk_upload(resource.id)
+                    # Clean up if using multipart upload
+                    if resource.is_multipart:
+                        delete_chunk_upload(resource.id)
                     
         except storage.exceptions.NotFound as e:
             logging.error(f"GCS object not found: {e}")
@@ -590,9 +1225,96 @@ def convert_to_mp4(resource):
             # Could handle specific ffmpeg errors here if needed
         except Exception as ex:
             logging.error(f"Exception in conversion to mp4: {ex}")
-        finally:
-            if app.config['MP4_CONVERT_LOCK'].locked():
-                app.config['MP4_CONVERT_LOCK'].release()
+
+def build_mp4_and_hls_command(source_file, mp4_output, hls_folder, qualities, mp4_mode, mp4_options, with_audio=True, threads=None, **packaging):
+    """
+    Builds one ffmpeg command writing a faststart MP4 and the HLS ladder from a single decode.
+
+    When the MP4 needs a full transcode it takes an unscaled branch of the ladder's
+    split filter, otherwise its streams are copied next to the decode. Each output
+    gets its own -threads budget.
+    """
+    budget = ['-threads', str(threads)] if threads else []
+    if mp4_mode == 'transcode':
+        ladder_filter = build_ladder_filter(qualities, extra_outputs=('mp4',))
+        mp4_part = ['-map', '[mp4]', '-map', '0:a:0?', *mp4_options]
+    else:
+        ladder_filter = build_ladder_filter(qualities)
+        mp4_part = list(mp4_options)
+
+    return [
+        'ffmpeg', '-y', '-i', source_file,
+        '-filter_complex', ladder_filter,
+        *mp4_part, *budget, '-movflags', '+faststart', mp4_output,
+        *build_ladder_output_options(qualities, with_audio), *budget,
+        *get_hls_muxer_options(hls_folder, qualities, with_audio, **packaging)
+    ]
+
+def generate_mp4_and_streams(resource, source_url, probe, mp4_mode, mp4_options, output_filename, output_key, bucket):
+    """
+    Produces the resource's MP4 and its pending HLS renditions in one ffmpeg run.
+
+    HLS segments are uploaded while encoding, and the MP4 is uploaded alongside the
+    remaining HLS output once ffmpeg exits.
+
+    Returns:
+        True on success or if the MP4 and every rendition already exist, False
+        if encoding failed or only the MP4 is missing, for the caller to encode
+        it on its own
+    """
+    ladder = get_encoding_ladder(probe)
+    qualities = [quality for quality in ladder if not is_quality_done(resource, quality['name'])]
+    if not qualities:
+        if bucket.blob(output_key).exists():
+            logging.info(f"MP4 and HLS renditions of {resource.id} are already done")
+            return True
+        logging.info(f"HLS renditions of {resource.id} are already done, only the MP4 is missing")
+        return False
+
+    hls_folder = f"hls_media/{resource.company}/{resource.created_by}/{resource.id}"
+    save_video_thumbnails(resource, source_url, hls_folder)
+
+    pending_names = {quality['name'] for quality in qualities}
+    mp4_output = f"{resource.id}-{output_filename}"
+    uploader = segment_upload.create_segment_uploader(
+        bucket,
+        hls_folder,
+        on_rendition_complete=lambda name: update_resource_quality_status(resource, name) if name in pending_names else None
+    )
+    try:
+        with_audio = bool(probe['audio_codec']) if probe else has_audio_stream(source_url)
+        command = build_mp4_and_hls_command(
+            source_url, mp4_output, uploader.local_folder, qualities, mp4_mode, mp4_options,
+            with_audio=with_audio,
+            threads=transcoding.get_transcode_scheduler().threads_per_job,
+            segment_type=current_app.config.get('HLS_SEGMENT_TYPE', 'mpegts'),
+            single_file=current_app.config.get('HLS_SINGLE_FILE', False)
+        )
+        returncode, stderr = segment_upload.run_ffmpeg_with_uploads(command, uploader)
+        if returncode != 0 or not os.path.exists(mp4_output):
+            logging.error(f"FFmpeg error for MP4 and HLS: {stderr.decode(errors='replace')}")
+            return False
+        # List the renditions finished by an earlier run too
+        write_master_playlist(uploader.local_folder, ladder, audio_group=with_audio)
+
+        mp4_upload = uploader.executor.submit(
+            lambda: bucket.blob(output_key).upload_from_filename(mp4_output, content_type='video/mp4')
+        )
+        uploader.finish()
+        mp4_upload.result()
+
+        resource.name = output_filename
+        resource.hls_url = f"https://storage.googleapis.com/{current_app.config['GCS_STORAGE_EINO_BUCKET_NAME']}/{hls_folder}/output.m3u8"
+        db.session.add(resource)
+        db.session.commit()
+
+        save_resource_to_db(resource, need_auth=True)
+        return True
+    finally:
+        uploader.close()
+        shutil.rmtree(uploader.local_folder, ignore_errors=True)
+        if os.path.exists(mp4_output):
+            os.remove(mp4_output)
 
 def get_default_filepreview_by_content_type(content_type):
     if content_type in [
@@ -614,6 +1336,35 @@ def get_default_filepreview_by_content_type(content_type):
     else:
         return f"{current_app.config['TEMPLATE_IMAGES_PATH']}/templates/images/no-preview.jpeg"
 
+def get_template_preview_key(preview_image):
+    """
+    Returns the shared storage key of a template preview image, uploading it on first use.
+
+    Keys are named after the image's content, so an object never changes and is
+    served as cacheable forever; an updated template gets a new key. Instances
+    that find the object already stored skip the upload.
+    """
+    with TEMPLATE_PREVIEW_LOCK:
+        key_path = TEMPLATE_PREVIEW_KEYS.get(preview_image)
+        if key_path:
+            return key_path
+
+        with open(preview_image, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:32]
+        key_path = f"{TEMPLATE_PREVIEW_PREFIX}/{digest}{os.path.splitext(preview_image)[1]}"
+
+        blob = get_bucket(get_eino_storage_bucket_name()).blob(key_path)
+        if not blob.exists():
+            blob.cache_control = 'public, max-age=31536000, immutable'
+            try:
+                blob.upload_from_filename(preview_image, predefined_acl='publicRead', if_generation_match=0)
+            except PreconditionFailed:
+                # Another instance uploaded it meanwhile
+                pass
+
+        TEMPLATE_PREVIEW_KEYS[preview_image] = key_path
+        return key_path
+
 def save_preview_image(resource, file, preview_video = True):
     """Generates and saves a preview image for the resource."""
     from main import app
@@ -636,138 +1387,202 @@ def save_preview_image(resource, file, preview_video = True):
             preview_image = get_default_filepreview_by_content_type(resource.type)
 
             if preview_image:
-                storage_client = get_storage_client()
-                bucket_name = get_eino_storage_bucket_name()
-                bucket = storage_client.bucket(bucket_name)
-                
-                extension = preview_image.split('.')[-1]
-                key_path = f"{resource.company}/{resource.created_by}/preview-{resource.id}.{extension}"
-                blob = bucket.blob(key_path)
-                blob.upload_from_filename(preview_image)
-
-                resource.preview_image = key_path
+                # Shared by every resource of this type, nothing is uploaded per resource
+                resource.preview_image = get_template_preview_key(preview_image)
                 db.session.commit()
     return resource
     
 def save_epub_preview(resource, file):
     """Generates a preview image for EPUB files."""
-    file_name = f"epub-content-{resource.id}.epub"
-    output = f"epub-preview-{resource.id}.png"
-
-    # String file parameter means the file URL is sent
-    if type(file) == str:
-        download_file(file, file_name)
-    else:
-        # Save the EPUB in local to open it with fitz library
-        with open(file_name, "wb") as f:
-            f.write(file.getbuffer())
+    return save_document_preview(resource, file, 'epub')
+
+class RangeWriter:
+    """File-like object writing sequentially from a fixed offset of an open file, so slices can be written concurrently."""
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+        return len(data)
+
+def preallocate_file(filename, size):
+    """Creates `filename` with `size` bytes reserved and returns its file descriptor."""
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # No fallocate on this platform or filesystem, a sparse file still avoids appends
+        os.ftruncate(fd, size)
+    return fd
 
-    doc = fitz.open(file_name)
-    page = doc.load_page(0)
-    pix = page.get_pixmap()
-    pix.save(output)
-    doc.close()
+def download_ranges(filename, size, fetch_range):
+    """
+    Downloads `size` bytes into `filename` with concurrent ranged reads.
 
-    with open(output, 'rb') as img_file:
-        img_bytes = img_file.read()
+    The file is preallocated and split into DOWNLOAD_SLICE_SIZE slices, which
+    DOWNLOAD_WORKERS threads write in place at their offsets.
 
-    storage_client = get_storage_client()
-    bucket_name = get_eino_storage_bucket_name()
-    bucket = storage_client.bucket(bucket_name)
-    
-    key_path = f"{resource.company}/{resource.created_by}/epub-preview-{resource.id}.png"
-    blob = bucket.blob(key_path)
-    blob.upload_from_string(img_bytes, content_type='image/png')
+    Args:
+        filename: Local file to create
+        size: Total number of bytes
+        fetch_range: Called with (start, end, writer) to write bytes start to end (inclusive) to writer
+    """
+    slice_size = current_app.config['DOWNLOAD_SLICE_SIZE']
 
-    resource.preview_image = key_path
-    db.session.commit()
+    def fetch(start):
+        end = min(start + slice_size, size) - 1
+        writer = RangeWriter(fd, start)
+        fetch_range(start, end, writer)
+        if writer.offset != end + 1:
+            raise Exception(f"Range {start}-{end} of {filename} ended at {writer.offset}")
 
+    fd = preallocate_file(filename, size)
+    executor = ThreadPoolExecutor(max_workers=current_app.config['DOWNLOAD_WORKERS'], thread_name_prefix='download')
     try:
-        if os.path.exists(output):
-            os.remove(output)
-        if os.path.exists(file_name):
-            os.remove(file_name)
-    except:
-        pass
+        for future in [executor.submit(fetch, start) for start in range(0, size, slice_size)]:
+            future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        os.close(fd)
+
+def record_download(size, elapsed, sliced):
+    """Counts a finished download towards the throughput totals."""
+    with DOWNLOAD_STATS_LOCK:
+        DOWNLOAD_STATS['downloads'] += 1
+        DOWNLOAD_STATS['sliced'] += int(sliced)
+        DOWNLOAD_STATS['bytes'] += size
+        DOWNLOAD_STATS['seconds'] += elapsed
+    logging.info(f"Downloaded {size} bytes in {elapsed:.2f}s ({size / max(elapsed, 1e-6) / 1024 ** 2:.1f} MiB/s, {'sliced' if sliced else 'single stream'})")
+
+def get_download_stats():
+    """Returns the download counters with the average throughput in MiB/s."""
+    with DOWNLOAD_STATS_LOCK:
+        stats = dict(DOWNLOAD_STATS)
+    stats['mib_per_second'] = round(stats['bytes'] / stats['seconds'] / 1024 ** 2, 2) if stats['seconds'] else None
+    return stats
+
+def get_url_size(url):
+    """Returns the size of the object behind a GET URL if the server serves byte ranges, otherwise None."""
+    # Signed URLs are only valid for their method, so probe with a one byte GET rather than a HEAD
+    with DOWNLOAD_SESSION.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code != 206:
+            return None
+        total = r.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
 
-    return resource
+def fetch_url_range(url, start, end, writer):
+    with DOWNLOAD_SESSION.get(url, headers={'Range': f"bytes={start}-{end}"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code != 206:
+            raise Exception(f"Range request for bytes {start}-{end} failed with status {r.status_code}")
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+            writer.write(chunk)
 
 def download_file(url, filename):
-    """Downloads a file from a URL to a local file."""
-    with requests.get(url, stream=True) as r:
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): 
-                f.write(chunk)
-    
+    """
+    Downloads a file from a URL to a local file.
+
+    Files larger than one DOWNLOAD_SLICE_SIZE slice are fetched with concurrent
+    ranged GETs when the server supports them, anything else in one stream.
+    """
+    started = time.perf_counter()
+    size = get_url_size(url)
+    sliced = size is not None and size > current_app.config['DOWNLOAD_SLICE_SIZE']
+    if sliced:
+        download_ranges(filename, size, lambda start, end, writer: fetch_url_range(url, start, end, writer))
+    else:
+        with DOWNLOAD_SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            r.raise_for_status()
+            with open(filename, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+                    f.write(chunk)
+    record_download(os.path.getsize(filename), time.perf_counter() - started, sliced)
+
+def download_blob(blob, filename):
+    """
+    Downloads a GCS object to a local file, with concurrent ranged reads past one DOWNLOAD_SLICE_SIZE slice.
+
+    A blob from bucket.get_blob() carries its generation, so every slice reads
+    the same version of the object even if it's replaced meanwhile.
+    """
+    started = time.perf_counter()
+    # gzip-encoded objects are decompressed by GCS and can't be read in ranges
+    sliced = blob.size is not None and blob.size > current_app.config['DOWNLOAD_SLICE_SIZE'] and blob.content_encoding != 'gzip'
+    if sliced:
+        # Slices can't be checksummed against the whole object's hash
+        download_ranges(filename, blob.size, lambda start, end, writer: blob.download_to_file(writer, start=start, end=end, checksum=None))
+    else:
+        blob.download_to_filename(filename)
+    record_download(os.path.getsize(filename), time.perf_counter() - started, sliced)
+
 def save_pdf_preview(resource, file):
     """Generates a preview image for PDF files."""
-    filename = f'pdf-file__{resource.id}-{resource.name}'
-    # String file parameter means the file URL is sent
-    if type(file) == str:
-        download_file(file, filename)
-        file = open(filename, 'rb')
-        doc = fitz.open(stream=file.read())
+    return save_document_preview(resource, file, 'pdf')
+
+def save_document_preview(resource, file, filetype):
+    """
+    Renders the first page of a PDF or EPUB in the preview process pool and saves it as the preview image.
+
+    Args:
+        resource: The Resource object from the database
+        file: The file URL, or a file object holding the document
+        filetype: 'pdf' or 'epub'
+    """
+    from . import document_preview
+
+    # String file parameter means the file URL is sent, the worker fetches what it needs itself
+    if isinstance(file, str):
+        source = file
     else:
-        doc = fitz.open(stream=file.read()) 
-    page = doc.load_page(0)
-    pix = page.get_pixmap()
-    img_bytes = pix.tobytes('png')
+        file.seek(0)
+        source = file.read()
+        file.seek(0)
+
+    img_bytes, image_format = document_preview.render_document_preview(source, filetype)
 
-    storage_client = get_storage_client()
     bucket_name = get_eino_storage_bucket_name()
-    bucket = storage_client.bucket(bucket_name)
-    
-    key_path = f"{resource.company}/{resource.created_by}/pdf-preview-{resource.id}.png"
+    bucket = get_bucket(bucket_name)
+
+    extension = 'jpg' if image_format == 'jpeg' else image_format
+    key_path = f"{resource.company}/{resource.created_by}/{filetype}-preview-{resource.id}.{extension}"
     blob = bucket.blob(key_path)
-    blob.upload_from_string(img_bytes, content_type='image/png')
+    blob.upload_from_string(img_bytes, content_type=f"image/{image_format}")
 
     resource.preview_image = key_path
     db.session.commit()
-    doc.close()
-
-    file.seek(0)
-
-    if os.path.exists(filename):
-        os.remove(filename)
     return resource
 
 def save_video_preview(resource, file):
-    """Generates a thumbnail preview image for video files."""
+    """Generates a thumbnail preview image for video files from the keyframe near one second in."""
+    from . import thumbnails
+
     try:
-        unique_filename = str(uuid.uuid4())
-        output_image = os.path.join(f'{unique_filename}.png')
-
-        if not resource.is_multipart:
-            combined_file_name = f"{resource.id}-{resource.name}"
-
-            ffmpeg_command = [
-                'ffmpeg', '-i', combined_file_name, '-ss', '00:00:01', '-frames:v', '1', 
-                '-vf', 'scale=640:-1', output_image
-            ]
-            subprocess.run(
-                ffmpeg_command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-        else:
-            ffmpeg_command = [
-                'ffmpeg', '-i', file, '-ss', '00:00:01', '-frames:v', '1', 
-                '-vf', 'scale=640:-1', output_image
-            ]
-            subprocess.run(
-                ffmpeg_command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
+        output_image = f"{uuid.uuid4()}.jpg"
+
+        # String file parameter means the file URL (or a local path) is sent
+        source_file = file if isinstance(file, str) else f"{resource.id}-{resource.name}"
+        # Seeking on the input only reads the bytes around one keyframe, even from a signed URL
+        process = transcoding.run_ffmpeg(
+            thumbnails.build_poster_command(source_file, output_image, thumbnails.get_poster_timestamp(resource.video_duration)),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        if process.returncode != 0:
+            logging.error(f"FFmpeg error for the preview of {resource.id}: {process.stderr.decode(errors='replace')}")
 
         if os.path.exists(output_image):
-            storage_client = get_storage_client()
             bucket_name = get_eino_storage_bucket_name()
-            bucket = storage_client.bucket(bucket_name)
+            bucket = get_bucket(bucket_name)
             
             key_path = f"{resource.company}/{resource.created_by}/video-preview-{resource.id}.jpg"
             blob = bucket.blob(key_path)
-            blob.upload_from_filename(output_image)
+            blob.upload_from_filename(output_image, content_type='image/jpeg')
 
             if os.path.exists(output_image):
                 os.remove(output_image)
@@ -780,23 +1595,19 @@ def save_video_preview(resource, file):
 
     return resource
 
+def save_video_thumbnails(resource, source_file, output_folder):
+    """Saves the video's poster and storyboard, or just the poster if the storyboard is disabled or fails."""
+    from . import thumbnails
+
+    try:
+        if current_app.config.get('STORYBOARD_ENABLED', True) and thumbnails.generate_thumbnails(source_file, output_folder, resource):
+            return resource
+        return save_preview_image(resource, source_file, True)
+    except Exception as ex:
+        print("Exception in saving preview image: ", ex)
+        return resource
 
 
-def get_auth_token_from_company_user(company_user: str, company: str, user: str):
-    """Gets an authentication token for a company user."""
-    data = {
-        'company_user': company_user,
-        'user': user,
-        'company': company
-    }
-    res = requests.post(f"{current_app.config['DJANGO_BASE_URL']}/api/v2/company/get_company_user_token/", json=data)
-    
-    if res.ok:
-        res = res.json()
-        return res.get('data')
-    else:
-        logging.error("Auth Token error during restart")
-        return None
 
 def get_preview_image_by_content_type(content_type):
     """Returns preview image path based on content type."""
@@ -819,69 +1630,56 @@ def get_preview_image_by_content_type(content_type):
     else:
         return f"{current_app.config['TEMPLATE_IMAGES_PATH']}/templates/images/default-preview.jpeg"
 
-def save_resource_to_db(resource):
-    """Saves a resource to the database."""
-    try:
-        # Database saving logic would go here
-        return True
-    except Exception as ex:
-        logging.error(f"Exception in save_resource_to_db: {ex}")
-        return False
-
 def create_stream(file, resource):
     """
     Creates adaptive streaming formats (HLS) for video resources.
     
     Args:
-        file: The source file path or BytesIO object
+        file: The source URL or path, or a BytesIO object of the chunks
         resource: The Resource object from the database
     """
     from main import app
     from .service import delete_chunk_upload, combine_chunks
     from .models import Resource
     from . import pubsub_utils
+    from . import adaptive_streaming
+    from . import media_cache
 
     combined_file_name = f"{uuid.uuid4()}-{resource.name}"
     try:
-        with app.app_context():
+        with app.app_context(), ExitStack() as stack:
             # Need this because of different app context
             resource = Resource.query.filter_by(id=resource.id, is_deleted=False).first()
             combined_file = combine_chunks(resource) if not isinstance(file, str) else None
             
-            # Save preview image first
             if combined_file:
-                save_preview_image(resource, combined_file, True)
                 with open(combined_file_name, 'wb') as f:
-                    f.write(combined_file.getbuffer())
+                    shutil.copyfileobj(combined_file, f, 1024 * 1024)
+                source_file = combined_file_name
             else:
-                # If file is a string (URL), download it first
-                download_file(file, combined_file_name)
-                save_preview_image(resource, combined_file_name, True)
+                # The stored object, shared with the other stages through the media cache
+                source_file = stack.enter_context(media_cache.cached_source(resource))
             
             resource_key = get_resource_storage_key(resource)
 
             logging.info(f"Creating adaptive streams for: {resource.name}")
             
-            # Define streaming quality presets
-            qualities = [
-                {'name': '360p', 'resolution': '640x360', 'bitrate': '1M', 'crf': '28', 'bandwidth': '1000000'},
-                {'name': '480p', 'resolution': '854x480', 'bitrate': '2M', 'crf': '26', 'bandwidth': '2000000'},
-                {'name': '720p', 'resolution': '1280x720', 'bitrate': '4M', 'crf': '24', 'bandwidth': '4000000'},
-                {'name': '1080p', 'resolution': '1920x1080', 'bitrate': '8M', 'crf': '22', 'bandwidth': '8000000'}
-            ]
-
-            storage_client = get_storage_client()
+            # Streaming quality presets, trimmed to the source's resolution and bitrate
+            qualities = get_resource_ladder(resource, source_file)
+
+            # Storage prefix for the HLS output, ffmpeg itself writes to a scratch folder
+            hls_folder = f"hls_media/{resource.company}/{resource.created_by}/{resource.id}"
+
+            # Poster and storyboard, after the ladder's probe has set the duration
+            save_video_thumbnails(resource, source_file, hls_folder)
+
             eino_bucket_name = get_eino_storage_bucket_name()
-            bucket = storage_client.bucket(eino_bucket_name)
+            bucket = get_bucket(eino_bucket_name)
 
             # Update the database with preview image if available
             if resource.preview_image:
                 save_resource_to_db(resource, need_auth=True)
 
-            # Create the HLS directory structure
-            hls_folder = f"hls_media/{resource.company}/{resource.created_by}/{resource.id}"
-            os.makedirs(hls_folder, exist_ok=True)
-
             if combined_file:
                 combined_file.close()
 
@@ -890,14 +1688,14 @@ def create_stream(file, resource):
                 # Publish a message to Pub/Sub for media processing
                 pubsub_utils.publish_media_processing_task(
                     resource.id, 
-                    combined_file_name, 
+                    source_file, 
                     hls_folder, 
                     qualities
                 )
                 return
             
             # Process locally if not using Pub/Sub
-            generate_hls_streams(combined_file_name, hls_folder, resource, qualities, bucket)
+            adaptive_streaming.generate_streams(source_file, hls_folder, resource, qualities, bucket)
             
     except Exception as ex:
         logging.error(f"Error creating stream: {ex}")
@@ -905,117 +1703,389 @@ def create_stream(file, resource):
         if os.path.exists(combined_file_name):
             os.remove(combined_file_name)
 
+def is_quality_done(resource, quality_name):
+    """Returns whether the resource already has the given HLS rendition."""
+    return bool(getattr(resource, f"is_{quality_name}_done", False))
+
+def probe_media(source_file):
+    """
+    Reads the duration, display size, bitrate and codecs of a media file with ffprobe.
+
+    Args:
+        source_file: Local path or URL of the media
+
+    Returns:
+        A dict with duration, width, height, bitrate, video_codec, pixel_format and
+        audio_codec (any of which may be None), or None if the file couldn't be probed
+    """
+    command = [
+        'ffprobe', '-v', 'error', '-print_format', 'json',
+        '-show_format', '-show_streams', source_file
+    ]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        logging.error(f"ffprobe failed for {source_file}: {process.stderr.decode(errors='replace')}")
+        return None
+
+    info = json.loads(process.stdout or b'{}')
+    streams = info.get('streams', [])
+    media_format = info.get('format', {})
+    video = next((s for s in streams if s.get('codec_type') == 'video' and not s.get('disposition', {}).get('attached_pic')), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+
+    width = height = None
+    if video:
+        width, height = video.get('width'), video.get('height')
+        rotation = video.get('tags', {}).get('rotate') or next(
+            (side_data.get('rotation') for side_data in video.get('side_data_list', []) if 'rotation' in side_data), 0
+        )
+        # Phones store portrait video as rotated landscape frames
+        if width and height and abs(int(float(rotation))) % 180 == 90:
+            width, height = height, width
+
+    duration = media_format.get('duration') or (video or {}).get('duration')
+    bitrate = (video or {}).get('bit_rate') or media_format.get('bit_rate')
+    return {
+        'duration': float(duration) if duration else None,
+        'width': width,
+        'height': height,
+        'bitrate': int(bitrate) if bitrate else None,
+        'video_codec': video.get('codec_name') if video else None,
+        'pixel_format': video.get('pix_fmt') if video else None,
+        'audio_codec': audio.get('codec_name') if audio else None
+    }
+
+def parse_bitrate(bitrate):
+    """Converts an ffmpeg bitrate like '4M' or '800k' to bits per second."""
+    bitrate = str(bitrate)
+    if bitrate[-1] in 'Mm':
+        return int(float(bitrate[:-1]) * 1000000)
+    if bitrate[-1] in 'Kk':
+        return int(float(bitrate[:-1]) * 1000)
+    return int(bitrate)
+
+def get_bufsize(bitrate):
+    """Returns the rate-control buffer size for a bitrate: two seconds worth."""
+    return f"{2 * parse_bitrate(bitrate) // 1000}k"
+
+def get_encoding_ladder(probe, ladder=HLS_QUALITY_LADDER):
+    """
+    Derives the renditions to encode from a source's probe.
+
+    Renditions taller than the source are skipped, each output keeps the source's
+    aspect ratio (the ladder's height applies to the shorter side, so portrait
+    video works too), and bitrates are capped at the source bitrate. A source
+    smaller than the lowest rung gets that one rendition at its own size.
+
+    Args:
+        probe: Result of probe_media(), or None to use the full ladder
+        ladder: Quality presets to choose from, lowest first
+    """
+    if not probe or not probe.get('width') or not probe.get('height'):
+        return [dict(quality) for quality in ladder]
+
+    width, height = probe['width'], probe['height']
+    short_side = min(width, height)
+    source_bitrate = probe.get('bitrate')
+
+    renditions = []
+    for quality in ladder:
+        target = int(quality['resolution'].split('x')[1])
+        if target > short_side and renditions:
+            break
+        target = min(target, short_side)
+        scale = target / short_side
+        # libx264 needs even dimensions
+        out_width = max(2, int(round(width * scale / 2)) * 2)
+        out_height = max(2, int(round(height * scale / 2)) * 2)
+
+        bitrate = parse_bitrate(quality['bitrate'])
+        if source_bitrate:
+            bitrate = min(bitrate, source_bitrate)
+
+        renditions.append({
+            **quality,
+            'resolution': f"{out_width}x{out_height}",
+            'bitrate': f"{bitrate // 1000}k",
+            'bandwidth': str(bitrate)
+        })
+    return renditions
+
+def apply_media_probe(resource, probe):
+    """Records a probe_media() result in the resource's video_* and audio_codec columns."""
+    resource.video_duration = probe['duration']
+    resource.video_width = probe['width']
+    resource.video_height = probe['height']
+    resource.video_bitrate = probe['bitrate']
+    resource.video_codec = probe['video_codec']
+    resource.audio_codec = probe['audio_codec']
+
+def get_resource_ladder(resource, source_file):
+    """
+    Probes the resource's source, stores the result on the resource and returns its ladder.
+
+    Falls back to the full ladder if the source can't be probed.
+    """
+    probe = probe_media(source_file)
+    if probe:
+        apply_media_probe(resource, probe)
+        db.session.add(resource)
+        db.session.commit()
+    return get_encoding_ladder(probe)
+
+def has_audio_stream(source_file):
+    """Returns whether the source has at least one audio stream, according to ffprobe."""
+    probe = probe_media(source_file)
+    return bool(probe and probe['audio_codec'])
+
+def get_hls_packaging_options(output_folder, output_name, segment_type='mpegts', single_file=False):
+    """
+    Returns the ffmpeg HLS muxer options for how a rendition's media is packaged.
+
+    Args:
+        output_folder: Local folder ffmpeg writes to
+        output_name: Rendition file name prefix, e.g. output_%v
+        segment_type: 'mpegts' for .ts segments or 'fmp4' for fragmented MP4
+        single_file: Write one media file per rendition, addressed with
+            #EXT-X-BYTERANGE, instead of one object per segment
+    """
+    extension = 'm4s' if segment_type == 'fmp4' else 'ts'
+    if single_file:
+        extension = 'mp4' if segment_type == 'fmp4' else 'ts'
+        options = ['-hls_flags', 'single_file', '-hls_segment_filename', f"{output_folder}/{output_name}.{extension}"]
+    else:
+        options = ['-hls_segment_filename', f"{output_folder}/{output_name}_%03d.{extension}"]
+
+    options = ['-hls_segment_type', segment_type] + options
+    if segment_type == 'fmp4':
+        options += ['-hls_fmp4_init_filename', f"{output_name}_init.mp4"]
+    return options
+
+def build_hls_command(source_file, output_folder, qualities, with_audio=True, segment_type='mpegts', single_file=False):
+    """
+    Builds one ffmpeg command encoding every quality from a single decode.
+
+    The decoded video is split and scaled once per rendition, audio is encoded once
+    into a shared audio group, and ffmpeg writes the variant and master playlists.
+    See get_hls_packaging_options() for segment_type and single_file.
+    """
+    return build_ladder_encode_command(source_file, qualities, with_audio) + get_hls_muxer_options(
+        output_folder, qualities, with_audio, segment_type, single_file
+    )
+
+def get_hls_muxer_options(output_folder, qualities, with_audio=True, segment_type='mpegts', single_file=False):
+    """Returns the HLS output options for a ladder encoded by build_ladder_output_options()."""
+    stream_map = [
+        f"v:{i},agroup:audio,name:{quality['name']}" if with_audio else f"v:{i},name:{quality['name']}"
+        for i, quality in enumerate(qualities)
+    ]
+    if with_audio:
+        stream_map.append('a:0,agroup:audio,name:audio')
+
+    return [
+        '-f', 'hls', '-hls_time', '4', '-hls_playlist_type', 'vod',
+        *get_hls_packaging_options(output_folder, 'output_%v', segment_type, single_file),
+        '-master_pl_name', 'output.m3u8',
+        '-var_stream_map', ' '.join(stream_map),
+        f"{output_folder}/output_%v.m3u8"
+    ]
+
+def build_ladder_encode_command(source_file, qualities, with_audio=True):
+    """
+    Builds the decode and encode part of an ffmpeg command for a whole ladder, without the muxer.
+
+    The source is decoded once and split and scaled into one video stream per
+    quality, in ladder order, followed by one shared AAC audio stream. Keyframes
+    are aligned across renditions so they can be switched between per segment.
+    """
+    return [
+        'ffmpeg', '-y', '-i', source_file,
+        '-filter_complex', build_ladder_filter(qualities)
+    ] + build_ladder_output_options(qualities, with_audio)
+
+def build_ladder_filter(qualities, extra_outputs=()):
+    """
+    Builds the filter graph splitting the decoded video into one scaled stream per quality.
+
+    The scaled streams are labelled [v0], [v1], ... in ladder order. Each name in
+    extra_outputs gets an unscaled copy labelled [name], for other outputs of the
+    same command.
+    """
+    splits = ''.join(f"[s{i}]" for i in range(len(qualities))) + ''.join(f"[{name}]" for name in extra_outputs)
+    scales = ';'.join(
+        f"[s{i}]scale={quality['resolution'].replace('x', ':')}[v{i}]"
+        for i, quality in enumerate(qualities)
+    )
+    return f"[0:v]split={len(qualities) + len(extra_outputs)}{splits};{scales}"
+
+def build_ladder_output_options(qualities, with_audio=True):
+    """Returns the stream mapping and encoder options of a ladder output, see build_ladder_filter()."""
+    command = []
+    for i, quality in enumerate(qualities):
+        bitrate = quality['bitrate']
+        command += [
+            '-map', f"[v{i}]",
+            f"-c:v:{i}", 'libx264', f"-crf:v:{i}", quality['crf'],
+            f"-b:v:{i}", bitrate, f"-maxrate:v:{i}", bitrate,
+            f"-bufsize:v:{i}", get_bufsize(bitrate)
+        ]
+
+    command += [
+        '-profile:v', 'main', '-level', '4.0', '-preset', 'medium',
+        '-sc_threshold', '0', '-g', '48', '-keyint_min', '48'
+    ]
+    if with_audio:
+        command += ['-map', '0:a:0?', '-c:a', 'aac', '-b:a', '128k', '-ac', '2']
+    return command
+
+def write_master_playlist(output_folder, qualities, audio_group=False):
+    """
+    Writes output.m3u8 listing every given rendition, whichever job encoded it.
+
+    ffmpeg's own master playlist only lists the renditions of its run, so a
+    resumed job would drop the ones finished earlier.
+
+    Args:
+        output_folder: Local folder the master playlist is written to
+        qualities: The finished renditions, in ladder order
+        audio_group: Whether the renditions share the output_audio.m3u8 audio
+            rendition, as written by build_hls_command()
+    """
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    if audio_group:
+        lines.append('#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="audio",DEFAULT=YES,AUTOSELECT=YES,URI="output_audio.m3u8"')
+    for quality in qualities:
+        audio = ',AUDIO="audio"' if audio_group else ''
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={quality['bandwidth']},RESOLUTION={quality['resolution']},NAME=\"{quality['name']}\"{audio}")
+        lines.append(f"output_{quality['name']}.m3u8")
+    with open(os.path.join(output_folder, 'output.m3u8'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def build_hls_rendition_command(source_file, output_folder, quality, segment_type='mpegts', single_file=False):
+    """Builds the ffmpeg command encoding a single quality, with its own decode and audio encode."""
+    output_name = f"output_{quality['name']}"
+    return [
+        'ffmpeg', '-y', '-i', source_file,
+        '-c:v', 'libx264', '-profile:v', 'main', '-level', '4.0',
+        '-preset', 'medium', '-crf', quality['crf'],
+        '-sc_threshold', '0', '-g', '48', '-keyint_min', '48',
+        '-hls_time', '4', '-hls_playlist_type', 'vod',
+        '-b:v', quality['bitrate'], '-maxrate', quality['bitrate'],
+        '-bufsize', get_bufsize(quality['bitrate']),
+        '-c:a', 'aac', '-b:a', '128k', '-ac', '2',
+        '-s', quality['resolution'],
+        *get_hls_packaging_options(output_folder, output_name, segment_type, single_file),
+        f"{output_folder}/{output_name}.m3u8"
+    ]
+
+def encode_hls_renditions(source_file, output_folder, qualities, with_audio=None, uploader=None, **packaging):
+    """
+    Encodes all qualities in one ffmpeg run. Returns the qualities that were produced.
+
+    with_audio is probed from the source when not given. With an uploader, segments
+    are uploaded while ffmpeg is still encoding. packaging is passed on to
+    get_hls_packaging_options().
+    """
+    if with_audio is None:
+        with_audio = has_audio_stream(source_file)
+    command = build_hls_command(source_file, output_folder, qualities, with_audio=with_audio, **packaging)
+    returncode, stderr = segment_upload.run_ffmpeg_with_uploads(command, uploader)
+    if returncode != 0:
+        logging.error(f"FFmpeg error for HLS renditions: {stderr.decode(errors='replace')}")
+        return []
+    return qualities
+
+def encode_hls_renditions_separately(source_file, output_folder, qualities, uploader=None, **packaging):
+    """
+    Encodes each quality in its own ffmpeg run and writes the master playlist by hand.
+
+    Returns:
+        The qualities that were produced
+    """
+    generated = []
+    master_playlist = "#EXTM3U\n#EXT-X-VERSION:3\n"
+
+    for quality in qualities:
+        quality_name = quality['name']
+        logging.info(f"Generating {quality_name} HLS stream")
+        returncode, stderr = segment_upload.run_ffmpeg_with_uploads(
+            build_hls_rendition_command(source_file, output_folder, quality, **packaging),
+            uploader
+        )
+        if returncode != 0:
+            logging.error(f"FFmpeg error for {quality_name}: {stderr.decode(errors='replace')}")
+            continue
+
+        master_playlist += f"#EXT-X-STREAM-INF:BANDWIDTH={quality['bandwidth']},RESOLUTION={quality['resolution']},NAME=\"{quality_name}\"\n"
+        master_playlist += f"output_{quality_name}.m3u8\n"
+        generated.append(quality)
+
+        if uploader:
+            uploader.scan(final=True)
+            uploader.complete_rendition(quality_name)
+
+    if generated:
+        with open(f"{output_folder}/output.m3u8", 'w') as f:
+            f.write(master_playlist)
+    return generated
+
 def generate_hls_streams(source_file, output_folder, resource, qualities, bucket):
     """
     Generates HLS streams at different quality levels using FFmpeg.
-    
+
+    With HLS_SINGLE_DECODE the source is decoded once and fanned out to every
+    rendition, otherwise each quality is encoded by its own ffmpeg run. Either way
+    ffmpeg writes to a scratch folder and segments are uploaded as they finish.
+
     Args:
         source_file: Path to the source video file
-        output_folder: Directory to store HLS segments
+        output_folder: Storage prefix for the HLS playlists and segments
         resource: The Resource database object
         qualities: List of quality presets (resolution, bitrate)
         bucket: GCS bucket object for uploads
     """
-    # Create master playlist content
-    master_playlist = "#EXTM3U\n#EXT-X-VERSION:3\n"
-    
-    for quality in qualities:
-        quality_name = quality['name']
-        output_name = f"output_{quality_name}"
-        
-        # Skip already processed qualities
-        if quality_name == '360p' and resource.is_360p_done:
-            continue
-        if quality_name == '480p' and resource.is_480p_done:
-            continue
-        if quality_name == '720p' and resource.is_720p_done:
-            continue
-        if quality_name == '1080p' and resource.is_1080p_done:
-            continue
-        
-        segment_path = f"{output_folder}/{output_name}.m3u8"
-        os.makedirs(os.path.dirname(segment_path), exist_ok=True)
-        
-        # Improved FFmpeg command with better encoding parameters
-        command = [
-            'ffmpeg', '-i', source_file,
-            '-c:v', 'libx264', '-profile:v', 'main', '-level', '4.0',
-            '-preset', 'medium', '-crf', quality['crf'], 
-            '-sc_threshold', '0', '-g', '48', '-keyint_min', '48',
-            '-hls_time', '4', '-hls_playlist_type', 'vod',
-            '-b:v', quality['bitrate'], '-maxrate', quality['bitrate'], 
-            '-bufsize', str(int(quality['bitrate'].replace('M', '')) * 2) + 'M',
-            '-c:a', 'aac', '-b:a', '128k', '-ac', '2',
-            '-s', quality['resolution'], 
-            '-hls_segment_filename', f"{output_folder}/{output_name}_%03d.ts",
-            segment_path
-        ]
-        
-        try:
-            logging.info(f"Generating {quality_name} HLS stream")
-            process = subprocess.Popen(
-                command,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            stdout, stderr = process.communicate()
-            
-            if process.returncode != 0:
-                logging.error(f"FFmpeg error for {quality_name}: {stderr.decode()}")
-                continue
-                
-            # Add entry to master playlist
-            master_playlist += f"#EXT-X-STREAM-INF:BANDWIDTH={quality['bandwidth']},RESOLUTION={quality['resolution']},NAME=\"{quality_name}\"\n"
-            master_playlist += f"{output_name}.m3u8\n"
-            
-            # Upload segment playlist to GCS
-            blob = bucket.blob(f"{output_folder}/{output_name}.m3u8")
-            blob.upload_from_filename(segment_path)
-            blob.make_public()
-            
-            # Upload all segment files
-            segment_files = [f for f in os.listdir(output_folder) if f.startswith(f"{output_name}_") and f.endswith(".ts")]
-            for segment in segment_files:
-                segment_path = f"{output_folder}/{segment}"
-                blob = bucket.blob(f"{output_folder}/{segment}")
-                blob.upload_from_filename(segment_path)
-                blob.make_public()
-                
-                # Clean up local segment file after upload
-                if os.path.exists(segment_path):
-                    os.remove(segment_path)
-            
-            # Update resource status based on quality
-            update_resource_quality_status(resource, quality_name)
-            
-        except Exception as ex:
-            logging.error(f"Error generating {quality_name} stream: {ex}")
-    
-            
-            
-       
-    
-    # Upload master playlist
-        master_playlist_path = f"{output_folder}/output.m3u8"
-        with open(master_playlist_path, 'w') as f:
-            
-            
-            f.write(master_playlist)
-    
-        master_blob = bucket.blob(f"{output_folder}/output.m3u8")
-        master_blob.upload_from_filename(master_playlist_path)
-        master_blob.make_public()
-    
-    # Clean up master playlist file
-        if os.path.exists(master_playlist_path):
-            
-           os.remove(master_playlist_path)
-    
-    # Update resource link URL to point to the master playlist
+    pending = [quality for quality in qualities if not is_quality_done(resource, quality['name'])]
+    if not pending:
+        return
+
+    pending_names = {quality['name'] for quality in pending}
+    uploader = segment_upload.create_segment_uploader(
+        bucket,
+        output_folder,
+        on_rendition_complete=lambda name: update_resource_quality_status(resource, name) if name in pending_names else None
+    )
+    packaging = {
+        'segment_type': current_app.config.get('HLS_SEGMENT_TYPE', 'mpegts'),
+        'single_file': current_app.config.get('HLS_SINGLE_FILE', False)
+    }
+    try:
+        single_decode = current_app.config.get('HLS_SINGLE_DECODE', True)
+        with_audio = False
+        if single_decode:
+            # The source was probed already if the ladder came from get_resource_ladder()
+            with_audio = bool(resource.audio_codec) if resource.video_codec else has_audio_stream(source_file)
+            generated = encode_hls_renditions(source_file, uploader.local_folder, pending, with_audio=with_audio, uploader=uploader, **packaging)
+        else:
+            generated = encode_hls_renditions_separately(source_file, uploader.local_folder, pending, uploader=uploader, **packaging)
+
+        if not generated:
+            return
+
+        # List the renditions finished by an earlier run too
+        finished = [quality for quality in qualities if quality in generated or is_quality_done(resource, quality['name'])]
+        write_master_playlist(uploader.local_folder, finished, audio_group=with_audio)
+        uploader.finish()
+
+        # Update resource link URL to point to the master playlist
         hls_url = f"https://storage.googleapis.com/{current_app.config['GCS_STORAGE_EINO_BUCKET_NAME']}/{output_folder}/output.m3u8"
         resource.link_url = hls_url
+        resource.hls_url = hls_url
         db.session.commit()
-    
-    # Save resource to DB with updated streaming URL
-        save_resource_to_db(resource, need_auth=True)     
+
+        # Save resource to DB with updated streaming URL
+        save_resource_to_db(resource, need_auth=True)
+    except Exception as ex:
+        logging.error(f"Error generating HLS streams: {ex}")
+    finally:
+        uploader.close()
+        shutil.rmtree(uploader.local_folder, ignore_errors=True)
@@ -5,7 +5,9 @@ from flask import request, jsonify, current_app
 from . import utils
 from . import service
 from . import pubsub_utils
+from . import transcoding
 from . import adaptive_streaming
+from . import thumbnails
 from decorators.authorize import token_required
 from .models import Resource
 from extensions import db
@@ -19,8 +21,10 @@ def start_chunk_upload(auth_data):
     need_processing = request.args.get('need_processing') == 'true'
     file_upload_from_chat = request.headers.get('fileuploadedfromchat')
     direct_upload = request.args.get('direct_upload') == 'true'
+    upload_concat = request.headers.get('Upload-Concat', '')
     
-    if not meta:
+    # TUS partial uploads don't need to carry metadata, the final upload does
+    if not meta and upload_concat != 'partial':
         return jsonify({}), 400
     
     if file_upload_from_chat == "false":
@@ -29,19 +33,28 @@ def start_chunk_upload(auth_data):
         file_upload_from_chat = True
     else:
         file_upload_from_chat = False 
-    
-    if not meta:
-        return jsonify({}), 400
 
-    response = service.start_chunk_upload(
-        auth_data, 
-        company_id, 
-        meta, 
-        department_id, 
-        need_processing, 
-        file_upload_from_chat,
-        direct_upload
-    )
+    if upload_concat.startswith('final'):
+        response = service.start_concatenated_upload(
+            auth_data,
+            company_id,
+            meta,
+            department_id,
+            need_processing,
+            file_upload_from_chat,
+            upload_concat
+        )
+    else:
+        response = service.start_chunk_upload(
+            auth_data, 
+            company_id, 
+            meta, 
+            department_id, 
+            need_processing, 
+            file_upload_from_chat,
+            direct_upload,
+            upload_concat == 'partial'
+        )
 
     return utils.get_upload_response(response=json.dumps(response), status=201, extra_headers={ 'Location': response.get('id') })
 
@@ -109,12 +122,11 @@ def pubsub_handler():
             return jsonify({"status": "missing_parameters"}), 400
         
         # Process the media
-        storage_client = utils.get_storage_client()
         bucket_name = utils.get_eino_storage_bucket_name()
-        bucket = storage_client.bucket(bucket_name)
+        bucket = utils.get_bucket(bucket_name)
         
-        # Generate HLS streams
-        utils.generate_hls_streams(file_path, output_folder, resource, qualities, bucket)
+        # Generate the streams with the configured packaging
+        adaptive_streaming.generate_streams(file_path, output_folder, resource, qualities, bucket)
     
     elif task_type == 'generate_dash':
         # Generate MPEG-DASH streaming assets
@@ -124,33 +136,20 @@ def pubsub_handler():
         if not all([file_path, output_folder]):
             return jsonify({"status": "missing_parameters"}), 400
         
-        # Generate DASH manifest and segments
-        dash_manifest = adaptive_streaming.generate_dash_manifest(file_path, output_folder, resource, [
-            {'name': '360p', 'resolution': '640x360', 'bitrate': '1M'},
-            {'name': '480p', 'resolution': '854x480', 'bitrate': '2M'},
-            {'name': '720p', 'resolution': '1280x720', 'bitrate': '4M'},
-            {'name': '1080p', 'resolution': '1920x1080', 'bitrate': '8M'},
-        ])
+        # DASH shares its CMAF segments with HLS, so both are published from one encode
+        qualities = utils.get_resource_ladder(resource, file_path)
+        bucket = utils.get_bucket(utils.get_eino_storage_bucket_name())
+        adaptive_streaming.generate_cmaf_streams(file_path, output_folder, resource, qualities, bucket)
+    
+    elif task_type == 'generate_thumbnails':
+        # Poster and scrubbing storyboard
+        file_path = data.get('file_path')
+        output_folder = data.get('output_folder')
+        
+        if not all([file_path, output_folder]):
+            return jsonify({"status": "missing_parameters"}), 400
         
-        # Upload DASH assets to GCS
-        if dash_manifest:
-            storage_client = utils.get_storage_client()
-            bucket_name = utils.get_eino_storage_bucket_name()
-            bucket = storage_client.bucket(bucket_name)
-            
-            # Upload all DASH files to GCS
-            adaptive_streaming.upload_streaming_assets(
-                os.path.dirname(dash_manifest),
-                output_folder,
-                bucket
-            )
-            
-            # Update resource with DASH URL
-            dash_url = f"https://storage.googleapis.com/{bucket_name}/{output_folder}/manifest.mpd"
-            resource.dash_url = dash_url
-            db.session.commit()
-            
-            # Save resource to DB with updated URL
+        if thumbnails.generate_thumbnails(file_path, output_folder, resource, data.get('timestamps')):
             utils.save_resource_to_db(resource, need_auth=True)
     
     else:
@@ -158,6 +157,32 @@ def pubsub_handler():
     
     return jsonify({"status": "success"}), 200
 
+@token_required
+def get_signed_urls(auth_data):
+    """
+    Signs GET URLs for many storage keys in one request, e.g. for gallery thumbnails.
+    Only keys that belong to the caller's tenant are signed.
+    """
+    data = request.get_json(silent=True) or {}
+    keys = data.get('keys')
+    expiration = data.get('expiration', 3600)
+    company_id = request.headers.get('X-Tenant-ID')
+
+    if not isinstance(keys, list) or not keys:
+        return jsonify({"error": "No keys provided"}), 400
+    if len(keys) > current_app.config['SIGNED_URL_BULK_LIMIT']:
+        return jsonify({"error": f"At most {current_app.config['SIGNED_URL_BULK_LIMIT']} keys can be signed at once"}), 400
+    if not isinstance(expiration, int) or not 0 < expiration <= 7 * 24 * 3600:
+        return jsonify({"error": "Invalid expiration"}), 400
+
+    allowed_keys = [key for key in keys if utils.is_tenant_storage_key(key, company_id)]
+    denied_keys = [key for key in keys if key not in allowed_keys]
+
+    return jsonify({
+        "urls": utils.get_signed_urls(allowed_keys, expiration=expiration),
+        "denied": denied_keys
+    }), 200
+
 @token_required
 def get_streaming_url(auth_data, resource_id: str):
     """Get streaming URLs for a resource."""
@@ -233,14 +258,6 @@ def start_adaptive_streaming_job(auth_data, resource_id: str):
     # Define output folder
     output_folder = f"hls_media/{resource.company}/{resource.created_by}/{resource.id}"
     
-    # Define quality variants
-    qualities = [
-        {'name': '360p', 'resolution': '640x360', 'bitrate': '1M', 'crf': '28', 'bandwidth': '1000000'},
-        {'name': '480p', 'resolution': '854x480', 'bitrate': '2M', 'crf': '26', 'bandwidth': '2000000'},
-        {'name': '720p', 'resolution': '1280x720', 'bitrate': '4M', 'crf': '24', 'bandwidth': '4000000'},
-        {'name': '1080p', 'resolution': '1920x1080', 'bitrate': '8M', 'crf': '22', 'bandwidth': '8000000'}
-    ]
-    
     # Reset quality flags if re-processing
     resource.is_360p_done = False
     resource.is_480p_done = False
@@ -251,6 +268,8 @@ def start_adaptive_streaming_job(auth_data, resource_id: str):
     
     # Submit job
     if current_app.config.get('USE_PUBSUB_FOR_MEDIA_PROCESSING', False):
+        # Quality variants for the source, create_stream derives them itself otherwise
+        qualities = utils.get_resource_ladder(resource, signed_url)
         message_id = pubsub_utils.publish_media_processing_task(
             resource.id, 
             signed_url, 
@@ -264,10 +283,7 @@ def start_adaptive_streaming_job(auth_data, resource_id: str):
         }), 202
     else:
         # Process immediately
-        threading.Thread(
-            target=utils.create_stream,
-            args=(signed_url, resource)
-        ).start()
+        transcoding.submit_transcode(utils.create_stream, signed_url, resource)
         
         return jsonify({
             "status": "processing_started",
@@ -37,7 +37,7 @@ def create_app(env: str = 'DEV'):
 
 def import_db_models():
     # These are just imported so that, flask migration will take these tables during migration
-    from api.chunk.models import Resource, Chunk
+    from api.chunk.models import Resource, Chunk, ResourceOutbox
 
 def observe_watchdog_events(app):
     from api.chunk.utils import save_hls_file, save_stream_file
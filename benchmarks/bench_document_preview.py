@@ -0,0 +1,143 @@
+"""
+Benchmark for the document preview process pool.
+
+Renders the first page of every document in a corpus twice: inline in worker
+threads of this process (how save_pdf_preview and save_epub_preview used to
+run, with fitz's default 1x PNG) and through the PreviewRenderer process pool
+at PREVIEW_WIDTH.
+
+Besides wall time, it reports the worst delay seen by a ticker thread that
+wakes up every millisecond. That's how long a web worker's other requests can
+be stalled by the renders, since PyMuPDF holds the GIL while it renders.
+
+Without a corpus folder, sample PDFs are generated: text-heavy documents and
+large vector drawings of several sizes.
+
+Usage:
+    python benchmarks/bench_document_preview.py [corpus_folder] [concurrency]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+from flask import Flask
+
+from config import Config
+from api.chunk import document_preview
+
+
+def generate_corpus(folder):
+    for pages in (1, 50, 400):
+        doc = fitz.open()
+        for number in range(pages):
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 560, 800), f"Page {number} " + 'lorem ipsum dolor sit amet ' * 120)
+        doc.save(os.path.join(folder, f"text-{pages}.pdf"))
+        doc.close()
+
+    for lines in (2000, 20000):
+        doc = fitz.open()
+        page = doc.new_page(width=2000, height=2000)
+        shape = page.new_shape()
+        for i in range(lines):
+            shape.draw_line((i % 2000, 0), (2000 - i % 2000, 2000))
+        shape.finish(width=0.3)
+        shape.commit()
+        doc.save(os.path.join(folder, f"drawing-{lines}.pdf"))
+        doc.close()
+
+
+def load_corpus(folder):
+    documents = []
+    for name in sorted(os.listdir(folder)):
+        filetype = os.path.splitext(name)[1].lstrip('.').lower()
+        if filetype in ('pdf', 'epub'):
+            with open(os.path.join(folder, name), 'rb') as f:
+                documents.append((name, f.read(), filetype))
+    return documents
+
+
+def render_inline(data, filetype):
+    doc = fitz.open(stream=data, filetype=filetype)
+    page = doc.load_page(0)
+    image = page.get_pixmap().tobytes('png')
+    doc.close()
+    return image
+
+
+class Ticker:
+    """Measures the longest gap between 1 ms sleeps of a background thread."""
+
+    def __init__(self):
+        self.worst = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        last = time.perf_counter()
+        while self.running:
+            time.sleep(0.001)
+            now = time.perf_counter()
+            self.worst = max(self.worst, now - last)
+            last = now
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.worst
+
+
+def timed(label, documents, concurrency, render):
+    ticker = Ticker()
+    latencies = []
+
+    def run(document):
+        start = time.perf_counter()
+        render(document)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, documents))
+    elapsed = time.perf_counter() - start
+    stall = ticker.stop()
+
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"{label:<24} {elapsed:7.2f} s total  p95 {p95 * 1000:8.1f} ms  worst stall {stall * 1000:8.1f} ms")
+    return elapsed
+
+
+def main():
+    corpus = sys.argv[1] if len(sys.argv) > 1 else None
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not corpus:
+            corpus = tmp
+            generate_corpus(corpus)
+        documents = load_corpus(corpus)
+        print(f"{len(documents)} documents, {concurrency} concurrent renders, {app.config['PREVIEW_MAX_WORKERS']} preview workers")
+
+        with app.app_context():
+            timed('inline (threads)', documents, concurrency, lambda d: render_inline(d[1], d[2]))
+            renderer = document_preview.get_preview_renderer()
+            width = app.config['PREVIEW_WIDTH']
+            # Start the pool's workers before timing, as a running service would have
+            renderer.render(documents[0][1], documents[0][2], width)
+            timed('process pool', documents, concurrency, lambda d: renderer.render(d[1], d[2], width))
+            document_preview.reset_preview_renderer()
+
+
+if __name__ == '__main__':
+    main()
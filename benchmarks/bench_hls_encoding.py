@@ -0,0 +1,75 @@
+"""
+Benchmark for single-decode HLS encoding.
+
+Encodes the same source into the standard quality ladder twice: once with the
+per-rendition loop (one ffmpeg run, decode and audio encode per quality) and once
+with the single-decode command that splits the decoded frames across renditions.
+
+Without a source file, a synthetic 1080p clip with audio is generated with lavfi.
+Requires ffmpeg and ffprobe on PATH.
+
+Usage:
+    python benchmarks/bench_hls_encoding.py [source_file] [duration_seconds]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from config import Config
+from api.chunk import utils
+
+def generate_source(path, duration):
+    subprocess.run([
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f"testsrc2=size=1920x1080:rate=30:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac', '-shortest', path
+    ], check=True)
+
+
+def timed(label, func, output_folder):
+    os.makedirs(output_folder, exist_ok=True)
+    start = time.perf_counter()
+    generated = func(output_folder)
+    elapsed = time.perf_counter() - start
+    cpu = sum(os.times()[2:4])
+    print(f"{label:<28} {elapsed:8.2f} s wall  {len(generated)} renditions")
+    shutil.rmtree(output_folder)
+    return elapsed, cpu
+
+
+def main():
+    duration = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+
+    with tempfile.TemporaryDirectory() as tmp, app.app_context():
+        source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tmp, 'source.mp4')
+        if len(sys.argv) <= 1:
+            generate_source(source, duration)
+
+        loop, loop_cpu = timed(
+            'per-rendition loop',
+            lambda folder: utils.encode_hls_renditions_separately(source, folder, utils.HLS_QUALITY_LADDER),
+            os.path.join(tmp, 'loop')
+        )
+        single, single_cpu = timed(
+            'single decode',
+            lambda folder: utils.encode_hls_renditions(source, folder, utils.HLS_QUALITY_LADDER),
+            os.path.join(tmp, 'single')
+        )
+
+    print(f"wall speedup: {loop / single:.2f}x")
+    print(f"ffmpeg CPU: {loop_cpu:.1f} s vs {single_cpu - loop_cpu:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark for sliced source downloads.
+
+Downloads the same object twice: once with the single-stream 8 KB loop
+download_file() used to run, and once with the current download_file(), which
+fetches slices of DOWNLOAD_SLICE_SIZE with DOWNLOAD_WORKERS concurrent ranged GETs.
+
+Offline, a local HTTP server with Range support serves a random file, throttled
+per connection (BENCH_STREAM_MBPS, default 50 MB/s) to stand in for the
+per-stream limit of a real object store. Set BENCH_URL to a signed GCS URL to
+measure against the real thing instead.
+
+Usage:
+    python benchmarks/bench_source_download.py [size_mb]
+"""
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from config import Config
+from api.chunk import utils
+
+
+def make_handler(path, bytes_per_second):
+    size = os.path.getsize(path)
+
+    class RangeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+                self.send_response(206)
+                self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+            else:
+                start, end = 0, size - 1
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    data = f.read(min(remaining, 256 * 1024))
+                    self.wfile.write(data)
+                    remaining -= len(data)
+                    time.sleep(len(data) / bytes_per_second)
+
+    return RangeHandler
+
+
+def legacy_download(url, filename):
+    with requests.get(url, stream=True) as r:
+        with open(filename, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=8192):
+                f.write(chunk)
+
+
+def timed(label, func, url, filename):
+    start = time.perf_counter()
+    func(url, filename)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(filename)
+    print(f"{label:<28} {elapsed:8.2f} s  {size / elapsed / 1024 ** 2:8.1f} MiB/s")
+    os.remove(filename)
+    return elapsed
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    url = os.environ.get('BENCH_URL')
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = None
+        if not url:
+            source = os.path.join(tmp, 'source.bin')
+            with open(source, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            bytes_per_second = float(os.environ.get('BENCH_STREAM_MBPS', '50')) * 1024 ** 2
+            server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(source, bytes_per_second))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            # Plain http, so give the download session the same pool as https
+            utils.DOWNLOAD_SESSION.mount('http://', utils.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+            url = f"http://127.0.0.1:{server.server_address[1]}/source.bin"
+
+        filename = os.path.join(tmp, 'download.bin')
+        with app.app_context():
+            print(f"slices of {app.config['DOWNLOAD_SLICE_SIZE'] // 1024 ** 2} MiB, {app.config['DOWNLOAD_WORKERS']} workers")
+            single = timed('single stream, 8 KB chunks', legacy_download, url, filename)
+            sliced = timed('sliced download_file()', utils.download_file, url, filename)
+
+        if server:
+            server.shutdown()
+
+    print(f"speedup: {single / sliced:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark for the process-wide GCS client registry.
+
+Compares building a fresh storage client on every call (what every helper in
+api/chunk/utils.py used to do) against the cached client from get_storage_client().
+
+Offline, a throwaway service-account key is generated so only the local cost of
+reading credentials and constructing the client is measured. Set BENCH_GCS_BUCKET
+(with real credentials in GCP_SERVICE_ACCOUNT_FILE or ADC) to also time a metadata
+request per call, which includes the TLS handshake a cold client pays.
+
+Usage:
+    python benchmarks/bench_storage_client.py [iterations]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from config import Config
+from api.chunk import utils
+
+
+def write_fake_service_account(path):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    ).decode()
+    with open(path, 'w') as f:
+        json.dump({
+            'type': 'service_account',
+            'project_id': 'bench-project',
+            'private_key_id': 'bench',
+            'private_key': pem,
+            'client_email': 'bench@bench-project.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': 'https://oauth2.googleapis.com/token'
+        }, f)
+
+
+def timed(label, iterations, func):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {elapsed * 1000 / iterations:9.3f} ms/call  ({iterations} calls)")
+    return elapsed
+
+
+def cold_call(touch_bucket):
+    utils.reset_storage_clients()
+    client = utils.get_storage_client()
+    if touch_bucket:
+        client.bucket(touch_bucket).reload()
+
+
+def warm_call(touch_bucket):
+    bucket = utils.get_bucket(touch_bucket or 'bench-bucket')
+    if touch_bucket:
+        bucket.reload()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    touch_bucket = os.environ.get('BENCH_GCS_BUCKET')
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not touch_bucket:
+            credentials_path = os.path.join(tmp, 'service-account.json')
+            write_fake_service_account(credentials_path)
+            app.config['GCP_SERVICE_ACCOUNT_FILE'] = credentials_path
+
+        with app.app_context():
+            utils.get_storage_client()
+            cold = timed('new client per call', iterations, lambda: cold_call(touch_bucket))
+            utils.reset_storage_clients()
+            warm = timed('cached client + bucket', iterations, lambda: warm_call(touch_bucket))
+
+    print(f"speedup: {cold / warm:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
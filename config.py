@@ -1,5 +1,4 @@
 import os
-from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
 class Config(object):
@@ -32,13 +31,93 @@ class Config(object):
   }
   SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+  # Size of the keep-alive connection pool shared by all GCS calls in a process
+  GCS_HTTP_POOL_SIZE = int(os.environ.get('GCS_HTTP_POOL_SIZE', '32'))
+
+  # Signed URL cache: URLs are signed this much longer than requested so they can be reused
+  SIGNED_URL_CACHE_SLACK = int(os.environ.get('SIGNED_URL_CACHE_SLACK', '900'))
+  SIGNED_URL_CACHE_SIZE = int(os.environ.get('SIGNED_URL_CACHE_SIZE', '10000'))
+  SIGNED_URL_BULK_LIMIT = int(os.environ.get('SIGNED_URL_BULK_LIMIT', '500'))
+
+  # Permission lookups against the Django API
+  PERMISSIONS_CACHE_TTL = int(os.environ.get('PERMISSIONS_CACHE_TTL', '30'))
+  PERMISSIONS_NEGATIVE_CACHE_TTL = int(os.environ.get('PERMISSIONS_NEGATIVE_CACHE_TTL', '5'))
+  PERMISSIONS_CACHE_SIZE = int(os.environ.get('PERMISSIONS_CACHE_SIZE', '10000'))
+  PERMISSIONS_REQUEST_TIMEOUT = int(os.environ.get('PERMISSIONS_REQUEST_TIMEOUT', '5'))
+  PERMISSIONS_HTTP_POOL_SIZE = int(os.environ.get('PERMISSIONS_HTTP_POOL_SIZE', '16'))
+
+  # Outbox for save_chunk_resource callbacks to the Django API
+  OUTBOX_DISPATCHER_ENABLED = os.environ.get('OUTBOX_DISPATCHER_ENABLED', 'true').lower() == 'true'
+  OUTBOX_POLL_INTERVAL = int(os.environ.get('OUTBOX_POLL_INTERVAL', '5'))
+  OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+  OUTBOX_BATCH_DELIVERY = os.environ.get('OUTBOX_BATCH_DELIVERY', 'false').lower() == 'true'  # Django accepts arrays
+  OUTBOX_REQUEST_TIMEOUT = int(os.environ.get('OUTBOX_REQUEST_TIMEOUT', '10'))
+  OUTBOX_CLAIM_TIMEOUT = int(os.environ.get('OUTBOX_CLAIM_TIMEOUT', '300'))  # seconds before a claimed entry can be retried elsewhere
+  OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '10'))
+  OUTBOX_RETRY_BASE_DELAY = int(os.environ.get('OUTBOX_RETRY_BASE_DELAY', '5'))
+  OUTBOX_RETRY_MAX_DELAY = int(os.environ.get('OUTBOX_RETRY_MAX_DELAY', '600'))
+
+  # Service tokens minted for background callbacks to the Django API
+  SERVICE_TOKEN_DEFAULT_TTL = int(os.environ.get('SERVICE_TOKEN_DEFAULT_TTL', '300'))  # when the token has no exp claim
+  SERVICE_TOKEN_REFRESH_MARGIN = int(os.environ.get('SERVICE_TOKEN_REFRESH_MARGIN', '120'))
+  SERVICE_TOKEN_EXPIRY_MARGIN = int(os.environ.get('SERVICE_TOKEN_EXPIRY_MARGIN', '30'))
+  SERVICE_TOKEN_REQUEST_TIMEOUT = int(os.environ.get('SERVICE_TOKEN_REQUEST_TIMEOUT', '10'))
+
+  # Transcoding: 0 sizes jobs from the cgroup CPU quota, see api/chunk/transcoding.py
+  TRANSCODE_MAX_JOBS = int(os.environ.get('TRANSCODE_MAX_JOBS', '0'))
+  TRANSCODE_THREADS_PER_JOB = int(os.environ.get('TRANSCODE_THREADS_PER_JOB', '0'))
+  TRANSCODE_DEFAULT_THREADS = int(os.environ.get('TRANSCODE_DEFAULT_THREADS', '4'))
+
+  # Decode HLS sources once and fan out to every rendition, instead of one ffmpeg run per quality
+  HLS_SINGLE_DECODE = os.environ.get('HLS_SINGLE_DECODE', 'true').lower() == 'true'
+
+  # Encode the MP4 and the HLS ladder of videos that need processing in one ffmpeg run
+  UNIFIED_MEDIA_PIPELINE = os.environ.get('UNIFIED_MEDIA_PIPELINE', 'true').lower() == 'true'
+
+  # Streaming packaging: 'hls', or 'cmaf' for fMP4 segments shared by HLS and DASH
+  STREAMING_PACKAGING = os.environ.get('STREAMING_PACKAGING', 'hls')
+
+  # HLS packaging: 'mpegts' or 'fmp4' segments, and optionally one byte-range addressed file per rendition
+  HLS_SEGMENT_TYPE = os.environ.get('HLS_SEGMENT_TYPE', 'mpegts')
+  HLS_SINGLE_FILE = os.environ.get('HLS_SINGLE_FILE', 'false').lower() == 'true'
+
+  # HLS segments are uploaded while ffmpeg encodes, ffmpeg pauses past HLS_UPLOAD_MAX_PENDING queued segments
+  HLS_UPLOAD_WORKERS = int(os.environ.get('HLS_UPLOAD_WORKERS', '8'))
+  HLS_UPLOAD_MAX_PENDING = int(os.environ.get('HLS_UPLOAD_MAX_PENDING', '32'))
+  HLS_UPLOAD_POLL_INTERVAL = float(os.environ.get('HLS_UPLOAD_POLL_INTERVAL', '0.5'))
+
+  # Local copies of source media shared by the preview, probe and transcode stages, evicted LRU past the limit
+  MEDIA_CACHE_FOLDER = os.environ.get('MEDIA_CACHE_FOLDER', os.path.join(os.getcwd(), 'media_cache'))
+  MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', str(20 * 1024 ** 3)))
+  # Source objects past one slice are downloaded with this many concurrent ranged reads
+  DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '8'))
+  DOWNLOAD_SLICE_SIZE = int(os.environ.get('DOWNLOAD_SLICE_SIZE', str(32 * 1024 * 1024)))
+
+  # PDF/EPUB first-page previews, rendered in a pool of worker processes with per-worker memory and per-render time limits
+  PREVIEW_MAX_WORKERS = int(os.environ.get('PREVIEW_MAX_WORKERS', '2'))
+  PREVIEW_MAX_MEMORY = int(os.environ.get('PREVIEW_MAX_MEMORY', str(1024 ** 3)))
+  PREVIEW_TIMEOUT = float(os.environ.get('PREVIEW_TIMEOUT', '30'))
+  PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', '640'))
+  PREVIEW_IMAGE_FORMAT = os.environ.get('PREVIEW_IMAGE_FORMAT', 'jpeg')
+  PREVIEW_IMAGE_QUALITY = int(os.environ.get('PREVIEW_IMAGE_QUALITY', '80'))
+
+  # Video scrubbing storyboard: a sprite of tiles every STORYBOARD_INTERVAL seconds with a WebVTT index
+  STORYBOARD_ENABLED = os.environ.get('STORYBOARD_ENABLED', 'true').lower() == 'true'
+  STORYBOARD_INTERVAL = float(os.environ.get('STORYBOARD_INTERVAL', '10'))
+  STORYBOARD_MAX_TILES = int(os.environ.get('STORYBOARD_MAX_TILES', '100'))
+  STORYBOARD_COLUMNS = int(os.environ.get('STORYBOARD_COLUMNS', '10'))
+  STORYBOARD_TILE_WIDTH = int(os.environ.get('STORYBOARD_TILE_WIDTH', '160'))
+  STORYBOARD_TILE_HEIGHT = int(os.environ.get('STORYBOARD_TILE_HEIGHT', '90'))
+  STORYBOARD_INPUTS_PER_COMMAND = int(os.environ.get('STORYBOARD_INPUTS_PER_COMMAND', '20'))  # rounded down to whole rows
+
   # Thread Configuration
   THREAD_MAX_WORKERS = int(os.environ.get('THREAD_MAX_WORKERS', '4'))
-  THREAD_POOL_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get('THREAD_MAX_WORKERS', '4')))
-  CHUNK_COMPLETION_LOCK = Lock()
   FILE_SAVE_LOCK = Lock()
   MULTIPART_FILESIZE = int(os.environ.get('MULTIPART_FILESIZE', '10485760'))  # 10MB
-  MP4_CONVERT_LOCK = Lock()
+  CHUNK_PREFETCH_COUNT = int(os.environ.get('CHUNK_PREFETCH_COUNT', '4'))
+  CHUNK_ASSEMBLY_MEMORY_LIMIT = int(os.environ.get('CHUNK_ASSEMBLY_MEMORY_LIMIT', '67108864'))  # 64MB, spills to disk beyond
+  RESUMABLE_UPLOAD_SLICE_SIZE = int(os.environ.get('RESUMABLE_UPLOAD_SLICE_SIZE', '8388608'))  # 8MB, rounded down to 256KB
+  RESUMABLE_UPLOAD_TIMEOUT = int(os.environ.get('RESUMABLE_UPLOAD_TIMEOUT', '120'))  # seconds to wait for GCS to answer a range
 
   WATCHDOG_FOLDER = os.path.join(os.getcwd(), 'hls_media')
 
@@ -1,10 +1,22 @@
+import copy
 import requests
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 import jwt
+from requests.adapters import HTTPAdapter
 from flask import request, abort
 from flask import current_app
 from api.chunk import models
 
+# Permission lookups cached per (tenant, user uuid), see get_company_user_permissions()
+PERMISSIONS_CACHE = OrderedDict()
+PERMISSIONS_IN_FLIGHT = {}
+PERMISSIONS_CACHE_STATS = {'hits': 0, 'misses': 0}
+PERMISSIONS_CACHE_LOCK = threading.Lock()
+PERMISSIONS_SESSION = None
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -51,11 +63,88 @@ def token_required(f):
 
     return decorated
 
-def get_company_user_permissions(company_id, user_id):
+def get_permissions_session():
+    """Returns the keep-alive HTTP session shared by all permission lookups in this process."""
+    global PERMISSIONS_SESSION
+    with PERMISSIONS_CACHE_LOCK:
+        if PERMISSIONS_SESSION is None:
+            pool_size = current_app.config['PERMISSIONS_HTTP_POOL_SIZE']
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            PERMISSIONS_SESSION = session
+        return PERMISSIONS_SESSION
+
+def fetch_company_user_permissions(company_id, user_id):
+    """Asks the Django API for the user's permissions; returns (permissions, is_ok)."""
     try:
-        url = f"{current_app.config['DJANGO_BASE_URL']}/api/v2/company/get_company_user_permissions/?company_id={company_id}&user_id={user_id}"
-        res = requests.get(url)
-        res = res.json()
-        return res
+        url = f"{current_app.config['DJANGO_BASE_URL']}/api/v2/company/get_company_user_permissions/"
+        res = get_permissions_session().get(
+            url,
+            params={'company_id': company_id, 'user_id': user_id},
+            timeout=current_app.config['PERMISSIONS_REQUEST_TIMEOUT']
+        )
+        return res.json(), res.ok
     except Exception as ex:
-        return None
\ No newline at end of file
+        return None, False
+
+def get_company_user_permissions(company_id, user_id):
+    """
+    Returns the user's permissions in the company, cached for PERMISSIONS_CACHE_TTL seconds.
+
+    Failed lookups are cached for the shorter PERMISSIONS_NEGATIVE_CACHE_TTL, and
+    concurrent misses for the same (tenant, user) share a single request to Django.
+    Every caller gets its own copy, so handlers may modify it. A full cache drops
+    expired entries, then the oldest ones.
+    """
+    cache_key = (company_id, user_id)
+
+    with PERMISSIONS_CACHE_LOCK:
+        cached = PERMISSIONS_CACHE.get(cache_key)
+        if cached and cached[1] > time.monotonic():
+            PERMISSIONS_CACHE_STATS['hits'] += 1
+            return copy.deepcopy(cached[0])
+
+        PERMISSIONS_CACHE_STATS['misses'] += 1
+        in_flight = PERMISSIONS_IN_FLIGHT.get(cache_key)
+        is_leader = in_flight is None
+        if is_leader:
+            in_flight = threading.Event()
+            PERMISSIONS_IN_FLIGHT[cache_key] = in_flight
+
+    if not is_leader:
+        in_flight.wait(current_app.config['PERMISSIONS_REQUEST_TIMEOUT'])
+        with PERMISSIONS_CACHE_LOCK:
+            cached = PERMISSIONS_CACHE.get(cache_key)
+        return copy.deepcopy(cached[0]) if cached else None
+
+    try:
+        permissions, is_ok = fetch_company_user_permissions(company_id, user_id)
+        ttl = current_app.config['PERMISSIONS_CACHE_TTL'] if is_ok else current_app.config['PERMISSIONS_NEGATIVE_CACHE_TTL']
+        with PERMISSIONS_CACHE_LOCK:
+            now = time.monotonic()
+            max_size = current_app.config['PERMISSIONS_CACHE_SIZE']
+            if len(PERMISSIONS_CACHE) >= max_size:
+                for key in [key for key, value in PERMISSIONS_CACHE.items() if value[1] <= now]:
+                    del PERMISSIONS_CACHE[key]
+                while len(PERMISSIONS_CACHE) >= max_size:
+                    PERMISSIONS_CACHE.popitem(last=False)
+            PERMISSIONS_CACHE[cache_key] = (permissions, now + ttl)
+            PERMISSIONS_CACHE.move_to_end(cache_key)
+    finally:
+        with PERMISSIONS_CACHE_LOCK:
+            PERMISSIONS_IN_FLIGHT.pop(cache_key, None)
+        in_flight.set()
+
+    return copy.deepcopy(permissions)
+
+def get_permissions_cache_stats():
+    """Returns the permission cache hit and miss counters."""
+    with PERMISSIONS_CACHE_LOCK:
+        return {**PERMISSIONS_CACHE_STATS, 'size': len(PERMISSIONS_CACHE)}
+
+def clear_permissions_cache():
+    """Drops all cached permissions and resets the counters."""
+    with PERMISSIONS_CACHE_LOCK:
+        PERMISSIONS_CACHE.clear()
+        PERMISSIONS_CACHE_STATS.update({'hits': 0, 'misses': 0})
\ No newline at end of file
@@ -1,23 +1,56 @@
 import os
-from app import create_app
-from api.chunk.service import cleanup_and_restart_processing
-from config import Config
+import sys
 import threading
 
 # Get the PORT from the environment (for Cloud Run)
 port = int(os.environ.get('PORT', 8181))
 
-# Determine environment from the environment variable
-environment = os.environ.get('FLASK_ENV', Config.environment)
+# The app is created on first access, not on import: preview workers import this
+# module too (as __mp_main__ under `python main.py`) and must not load the app
+APP = None
+APP_LOCK = threading.Lock()
 
-app = create_app(environment)
+def get_app():
+    """Returns this process's app, creating it and starting the outbox dispatcher on first use."""
+    global APP
+
+    if APP is None:
+        with APP_LOCK:
+            if APP is None:
+                from app import create_app
+                from api.chunk.outbox import start_outbox_dispatcher
+                from config import Config
+
+                # Determine environment from the environment variable
+                environment = os.environ.get('FLASK_ENV', Config.environment)
+
+                app = create_app(environment)
+                app.add_url_rule('/health', 'health_check', health_check, methods=['GET'])
+                app.teardown_request(session_clear)
+
+                # Deliver any Django callbacks left in the outbox by a previous instance
+                start_outbox_dispatcher(app)
+                APP = app
+    return APP
+
+def __getattr__(name):
+    # `from main import app` and WSGI servers loading `main:app` create the app here
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-@app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for Cloud Run."""
-    return {'status': 'healthy'}, 200
+    from api.chunk.transcoding import get_transcode_stats
+    from api.chunk.utils import get_download_stats
+    from decorators.authorize import get_permissions_cache_stats
+    return {
+        'status': 'healthy',
+        'transcoding': get_transcode_stats(),
+        'downloads': get_download_stats(),
+        'permissions_cache': get_permissions_cache_stats()
+    }, 200
 
-@app.teardown_request
 def session_clear(exception=None):
     from extensions import db
     db.session.remove()
@@ -25,13 +58,19 @@ def session_clear(exception=None):
         db.session.rollback()
 
 if __name__ == '__main__':
+    # So `from main import app` elsewhere gets this app instead of importing the script a second time
+    sys.modules.setdefault('main', sys.modules[__name__])
+    from api.chunk.service import cleanup_and_restart_processing
+
+    app = get_app()
+
     # Only do cleanup in non-Cloud Run environments
     # In Cloud Run, each instance is ephemeral, so cleanup is unnecessary
     is_cloud_run = os.environ.get('K_SERVICE', '') != ''
-    
+
     if not is_cloud_run:
         # Start cleanup thread for non-Cloud Run environments
         threading.Thread(target=cleanup_and_restart_processing).start()
 
     # Run the app
-    app.run(host='0.0.0.0', port=port, use_reloader=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, use_reloader=False)
@@ -0,0 +1,201 @@
+"""
+Document preview rendering run inside the preview pool's worker processes.
+
+Kept outside the api package and free of Flask and app imports, so the
+forkserver can preload it without creating the app or starting its threads.
+"""
+import io
+import os
+import re
+import tempfile
+import resource as process_limits
+import fitz
+import requests
+
+# Remote PDFs are read in blocks of this size, see RangeReader
+RANGE_BLOCK_SIZE = 256 * 1024
+# Bytes read before the main xref of a linearized PDF, where the page tree and other document-level objects usually are
+LINEARIZED_TAIL_SIZE = 2 * 1024 * 1024
+LINEARIZATION_DICT_PATTERN = re.compile(rb'\d+\s+\d+\s+obj\s*<<(.*?)>>', re.S)
+LINEARIZATION_ENTRY_PATTERN = re.compile(rb'/([LOET])\s+(\d+)')
+
+def start_worker(max_bytes, pids):
+    """Pool initializer reporting the worker's PID to the pool's owner, then capping its memory, see limit_worker_memory()."""
+    pids.put(os.getpid())
+    limit_worker_memory(max_bytes)
+
+def limit_worker_memory(max_bytes):
+    """
+    Pool initializer capping how much memory the worker can add to what it inherited.
+
+    A hostile document then fails to allocate inside MuPDF instead of exhausting
+    the host. The limit is on address space, which bounds RSS from above.
+    """
+    if max_bytes:
+        with open('/proc/self/statm') as f:
+            inherited = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        limit = inherited + max_bytes
+        process_limits.setrlimit(process_limits.RLIMIT_AS, (limit, limit))
+
+def read_document(source):
+    """Returns the document bytes, fetching them if `source` is a URL."""
+    if isinstance(source, str):
+        response = requests.get(source, timeout=60)
+        response.raise_for_status()
+        return response.content
+    return source
+
+def encode_image(pix, image_format, quality):
+    """Encodes a pixmap as WebP when Pillow is installed and asked for, JPEG otherwise."""
+    if image_format == 'webp':
+        try:
+            from PIL import Image
+        except ImportError:
+            pass
+        else:
+            buffer = io.BytesIO()
+            Image.frombytes('RGB', (pix.width, pix.height), pix.samples).save(buffer, 'WEBP', quality=quality)
+            return buffer.getvalue(), 'webp'
+    return pix.tobytes('jpeg', jpg_quality=quality), 'jpeg'
+
+class RangeReader:
+    """
+    Lazily fetched, cached byte-range view of a remote object, read with HTTP Range requests.
+
+    Bytes are fetched in RANGE_BLOCK_SIZE blocks, each at most once, with
+    consecutive missing blocks coalesced into one request.
+    """
+
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+        self.blocks = {}
+        self.size = None
+        self.fetched = 0
+
+    def fetch(self, first, last):
+        start = first * RANGE_BLOCK_SIZE
+        end = (last + 1) * RANGE_BLOCK_SIZE - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        response = self.session.get(self.url, headers={'Range': f"bytes={start}-{end}"}, timeout=60)
+        if response.status_code != 206:
+            raise ValueError(f"Range request failed with status {response.status_code}")
+        if self.size is None:
+            self.size = int(response.headers['Content-Range'].rsplit('/', 1)[-1])
+
+        data = response.content
+        self.fetched += len(data)
+        for index in range(first, last + 1):
+            offset = (index - first) * RANGE_BLOCK_SIZE
+            self.blocks[index] = data[offset:offset + RANGE_BLOCK_SIZE]
+
+    def read(self, start, end):
+        """Returns the bytes from start up to end (exclusive), fetching the blocks not read yet."""
+        first, last = start // RANGE_BLOCK_SIZE, (end - 1) // RANGE_BLOCK_SIZE
+        missing = [index for index in range(first, last + 1) if index not in self.blocks]
+        while missing:
+            run_end = 0
+            while run_end + 1 < len(missing) and missing[run_end + 1] == missing[run_end] + 1:
+                run_end += 1
+            self.fetch(missing[0], missing[run_end])
+            missing = missing[run_end + 1:]
+
+        data = b''.join(self.blocks[index] for index in range(first, last + 1))
+        offset = first * RANGE_BLOCK_SIZE
+        return data[start - offset:end - offset]
+
+def get_linearization(head):
+    """Returns the /L (file length), /O (first page object), /E (end of first page) and /T (main xref offset) of a linearized PDF, or None."""
+    match = LINEARIZATION_DICT_PATTERN.search(head[:1024])
+    if not match or b'/Linearized' not in match.group(1):
+        return None
+    entries = {key.decode(): int(value) for key, value in LINEARIZATION_ENTRY_PATTERN.findall(match.group(1))}
+    return entries if {'L', 'O', 'E', 'T'} <= set(entries) else None
+
+def restrict_page_tree(doc, first_page):
+    """
+    Replaces the page tree root, in memory, with one holding only the first page.
+
+    MuPDF resolves every page object when it looks a page up, and in a
+    linearized file all but the first are in the part that wasn't fetched.
+    Attributes the pages inherit from the root are kept.
+    """
+    kind, value = doc.xref_get_key(doc.pdf_catalog(), 'Pages')
+    if kind != 'xref':
+        raise ValueError("The catalog has no page tree")
+    pages = int(value.split()[0])
+
+    inherited = ''
+    for key in ('MediaBox', 'CropBox', 'Resources', 'Rotate'):
+        kind, value = doc.xref_get_key(pages, key)
+        if kind != 'null':
+            inherited += f" /{key} {value}"
+    doc.update_object(pages, f"<< /Type /Pages /Kids [{first_page} 0 R] /Count 1{inherited} >>")
+
+def render_page(doc, width, image_format, quality):
+    page = doc.load_page(0)
+    zoom = width / page.rect.width if page.rect.width else 1
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return encode_image(pix, image_format, quality)
+
+def render_linearized_first_page(url, width, image_format, quality):
+    """
+    Renders page one of a remote linearized PDF from only the parts it needs.
+
+    Those are the first-page section at the start of the file, and the main
+    xref with the LINEARIZED_TAIL_SIZE bytes before it. They are written into a
+    sparse file the size of the document, so the rest of it takes neither
+    memory nor disk.
+
+    Returns:
+        The image and its format, or None if the PDF isn't linearized, was
+        updated after linearization, or MuPDF found bytes missing, in which case
+        the whole file has to be fetched
+    """
+    with requests.Session() as session:
+        reader = RangeReader(url, session)
+        linearization = get_linearization(reader.read(0, 1024))
+        if not linearization or linearization['L'] != reader.size or not 0 < linearization['E'] <= linearization['T'] < reader.size:
+            return None
+
+        with tempfile.TemporaryDirectory(prefix='preview-') as folder:
+            path = os.path.join(folder, 'document.pdf')
+            with open(path, 'wb') as f:
+                f.truncate(reader.size)
+                for start, end in ((0, linearization['E']), (max(linearization['E'], linearization['T'] - LINEARIZED_TAIL_SIZE), reader.size)):
+                    f.seek(start)
+                    f.write(reader.read(start, end))
+
+            doc = fitz.open(path, filetype='pdf')
+            try:
+                restrict_page_tree(doc, linearization['O'])
+                image = render_page(doc, width, image_format, quality)
+                # A lookup that landed in a gap makes MuPDF rebuild the xref by scanning the file
+                return None if doc.is_repaired else image
+            finally:
+                doc.close()
+
+def render_first_page(source, filetype, width, image_format, quality):
+    """
+    Renders page one of a document, scaled to `width` pixels. Runs in a pool worker.
+
+    A PDF behind a URL is first tried with range reads, see render_linearized_first_page().
+
+    Returns:
+        The image bytes and their format, 'jpeg' or 'webp'
+    """
+    if isinstance(source, str) and filetype == 'pdf':
+        try:
+            image = render_linearized_first_page(source, width, image_format, quality)
+            if image:
+                return image
+        except Exception:
+            # No range support, or MuPDF couldn't make sense of the partial file
+            pass
+
+    doc = fitz.open(stream=read_document(source), filetype=filetype)
+    try:
+        return render_page(doc, width, image_format, quality)
+    finally:
+        doc.close()
@@ -12,11 +12,23 @@ from config import Config
 from api.chunk.utils import (
     get_metadata, 
     get_storage_client, 
+    reset_storage_clients,
     get_resource_storage_key,
     create_resumable_upload_session,
     get_signed_url,
+    clear_signed_url_cache,
+    is_tenant_storage_key,
     save_chunk_to_storage,
-    is_processing_needed
+    is_processing_needed,
+    append_to_resumable_upload,
+    put_resumable_upload_range,
+    compose_blobs,
+    rewrite_blob,
+    iter_blob_contents,
+    build_hls_command,
+    probe_media,
+    get_encoding_ladder,
+    download_file
 )
 from api.chunk.service import (
     start_chunk_upload,
@@ -25,11 +37,22 @@ from api.chunk.service import (
     resume_chunk_upload,
     delete_chunk_upload
 )
+from api.chunk.segment_upload import SegmentUploader
+from api.chunk.media_cache import MediaCache
+from api.chunk.document_preview import PreviewRenderer
+from api.chunk.transcoding import TranscodeScheduler, get_cpu_count, reset_transcode_scheduler
 from api.chunk.pubsub_utils import (
     publish_message,
     publish_file_processing_task
 )
-from api.chunk.models import Resource, Chunk
+from api.chunk.models import Resource, Chunk, ResourceOutbox
+from api.chunk.utils import save_resource_to_db, get_auth_token_from_company_user, clear_service_tokens, resource_lock, RESOURCE_LOCKS
+from api.chunk.outbox import dispatch_outbox_batch
+from decorators.authorize import (
+    get_company_user_permissions,
+    get_permissions_cache_stats,
+    clear_permissions_cache
+)
 from extensions import db
 
 class TestConfig(Config):
@@ -45,6 +68,7 @@ class TestConfig(Config):
     SECRET_KEY = "test-key"
     DJANGO_BASE_URL = "http://localhost:8000"
     WATCHDOG_FOLDER = tempfile.mkdtemp()
+    OUTBOX_DISPATCHER_ENABLED = False
 
 class EinoGCPTestCase(unittest.TestCase):
     def setUp(self):
@@ -52,6 +76,11 @@ class EinoGCPTestCase(unittest.TestCase):
         self.app = create_app('TESTING')
         self.app.config.from_object(TestConfig)
         self.client = self.app.test_client()
+        reset_storage_clients()
+        clear_signed_url_cache()
+        clear_permissions_cache()
+        clear_service_tokens()
+        reset_transcode_scheduler()
         
         # Create all database tables
         with self.app.app_context():
@@ -69,21 +98,32 @@ class EinoGCPTestCase(unittest.TestCase):
             db.session.remove()
             db.drop_all()
             
+    @patch('api.chunk.utils.google.auth.default')
     @patch('api.chunk.utils.storage.Client')
-    def test_get_storage_client(self, mock_client):
+    def test_get_storage_client(self, mock_client, mock_default):
         """Test the get_storage_client function."""
+        mock_default.return_value = (MagicMock(), 'default-project')
         with self.app.app_context():
             # Test without credentials file
             client = get_storage_client()
             mock_client.assert_called_once()
+            # The pooled session goes through the constructor
+            self.assertEqual(mock_client.call_args.kwargs['project'], self.app.config.get('GCP_PROJECT_ID') or 'default-project')
+            self.assertEqual(mock_client.call_args.kwargs['_http'].adapters['https://']._pool_maxsize, self.app.config['GCS_HTTP_POOL_SIZE'])
+
+            # Test that the client is reused across calls
+            self.assertIs(get_storage_client(), client)
+            mock_client.assert_called_once()
             
             # Test with credentials file
             mock_client.reset_mock()
             with patch('os.path.exists', return_value=True), \
+                 patch('os.path.getmtime', return_value=1.0), \
                  patch('google.oauth2.service_account.Credentials.from_service_account_file') as mock_creds:
                 self.app.config['GCP_SERVICE_ACCOUNT_FILE'] = 'fake-credentials.json'
                 client = get_storage_client()
-                mock_creds.assert_called_once_with('fake-credentials.json')
+                get_storage_client()
+                mock_creds.assert_called_once_with('fake-credentials.json', scopes=mock_client.SCOPE)
                 mock_client.assert_called_once()
     
     def test_get_metadata(self):
@@ -157,9 +197,13 @@ class EinoGCPTestCase(unittest.TestCase):
             mock_bucket.blob.assert_called_once_with("test/key.mp4")
             mock_blob.generate_signed_url.assert_called_once_with(
                 version="v4",
-                expiration=1800,
+                expiration=1800 + self.app.config['SIGNED_URL_CACHE_SLACK'],
                 method="PUT"
             )
+
+            # A second request within the cached URL's lifetime is not signed again
+            self.assertEqual(get_signed_url("test/key.mp4", expiration=1800, method="PUT"), result)
+            mock_blob.generate_signed_url.assert_called_once()
     
     def test_get_resource_storage_key(self):
         """Test generation of resource storage keys."""
@@ -179,6 +223,86 @@ class EinoGCPTestCase(unittest.TestCase):
         key = get_resource_storage_key(resource)
         self.assertEqual(key, "hls_media/company1/user1/test-id/test-id-document.pdf")
     
+    def test_is_tenant_storage_key(self):
+        """Test that bulk signing only accepts keys under the caller's company."""
+        self.assertTrue(is_tenant_storage_key("company1/user1/preview-1.jpeg", "company1"))
+        self.assertTrue(is_tenant_storage_key("hls_media/company1/user1/id/output.m3u8", "company1"))
+        self.assertFalse(is_tenant_storage_key("company2/user1/preview-1.jpeg", "company1"))
+        self.assertFalse(is_tenant_storage_key("company1/../company2/file", "company1"))
+        self.assertFalse(is_tenant_storage_key("company1/user1/file", None))
+        self.assertTrue(is_tenant_storage_key("template_previews/0123abcd.jpeg", "company1"))
+        self.assertFalse(is_tenant_storage_key("template_previews/../company2/file", "company1"))
+
+    @patch('api.chunk.utils.get_bucket')
+    def test_template_previews_are_shared(self, mock_get_bucket):
+        """Test that template previews are uploaded once to a content-addressed key and shared by resources."""
+        from api.chunk.utils import get_template_preview_key, TEMPLATE_PREVIEW_KEYS
+        TEMPLATE_PREVIEW_KEYS.clear()
+        blob = MagicMock()
+        blob.exists.return_value = False
+        mock_get_bucket.return_value.blob.return_value = blob
+        preview_image = f"{os.getcwd()}/templates/images/doc-preview.jpeg"
+
+        with self.app.app_context():
+            keys = [get_template_preview_key(preview_image) for _ in range(2)]
+
+        self.assertEqual(keys[0], keys[1])
+        self.assertRegex(keys[0], r'^template_previews/[0-9a-f]{32}\.jpeg$')
+        blob.upload_from_filename.assert_called_once()
+        self.assertEqual(blob.upload_from_filename.call_args.kwargs['if_generation_match'], 0)
+        TEMPLATE_PREVIEW_KEYS.clear()
+
+    @patch('api.chunk.utils.requests.delete')
+    @patch('api.chunk.utils.put_resumable_upload_range')
+    @patch('api.chunk.utils.transcoding')
+    def test_convert_to_mp3_streams_to_resumable_upload(self, mock_transcoding, mock_put_range, mock_delete):
+        """Test that audio is piped through the encoder into aligned resumable ranges, and MP3 is copied as is."""
+        from contextlib import nullcontext
+        from api.chunk.utils import convert_to_mp3_file
+        mock_transcoding.transcode_slot.return_value = nullcontext()
+        # cat stands in for ffmpeg, echoing its stdin to stdout
+        mock_transcoding.with_thread_budget.return_value = ['cat']
+        mock_put_range.side_effect = lambda uri, data, start, total_size=None: total_size or start + len(data)
+        self.app.config['RESUMABLE_UPLOAD_SLICE_SIZE'] = 256 * 1024
+        audio = b'RIFF' + os.urandom(600 * 1024 - 4)
+
+        source = MagicMock()
+        source.download_as_bytes.return_value = audio[:10]
+        source.open.return_value = io.BytesIO(audio)
+        destination = MagicMock()
+        destination.create_resumable_upload_session.return_value = 'session-uri'
+        resource = Resource(id='audio-1', name='talk.wav', type='audio/wav')
+
+        with self.app.app_context():
+            convert_to_mp3_file(source, destination, resource)
+
+        ranges = [(c.args[2], len(c.args[1]), c.kwargs.get('total_size')) for c in mock_put_range.call_args_list]
+        self.assertEqual(ranges, [(0, 256 * 1024, None), (256 * 1024, 256 * 1024, None), (512 * 1024, 88 * 1024, 600 * 1024)])
+        self.assertEqual(b''.join(bytes(c.args[1]) for c in mock_put_range.call_args_list), audio)
+        destination.create_resumable_upload_session.assert_called_once_with(content_type='audio/mpeg')
+        mock_transcoding.record_transcode_result.assert_called_once_with(0)
+        mock_delete.assert_not_called()
+
+        # A failed upload cancels the session, and a failing cancel doesn't hide the upload error
+        mock_put_range.side_effect = Exception('upload failed')
+        mock_delete.side_effect = Exception('cancel failed')
+        source.open.return_value = io.BytesIO(audio)
+        with self.app.app_context(), self.assertRaisesRegex(Exception, 'upload failed'):
+            convert_to_mp3_file(source, destination, resource)
+        self.assertEqual(mock_delete.call_args.kwargs['timeout'], (10, 30))
+        mock_put_range.side_effect = lambda uri, data, start, total_size=None: total_size or start + len(data)
+
+        # An ID3 tag followed by an MPEG layer III frame is stored without transcoding
+        mp3 = MagicMock()
+        mp3.download_as_bytes.side_effect = [b'ID3\x04\x00\x00\x00\x00\x00\x0a', b'\xff\xfb\x90\x00']
+        mp3_destination = MagicMock()
+        mp3_destination.rewrite.return_value = (None, 100, 100)
+        with self.app.app_context():
+            convert_to_mp3_file(mp3, mp3_destination, resource)
+        self.assertEqual(mp3.download_as_bytes.call_args_list[1].kwargs, {'start': 20, 'end': 23})
+        mp3_destination.rewrite.assert_called_once_with(mp3)
+        mp3.open.assert_not_called()
+
     def test_is_processing_needed(self):
         """Test if processing is needed for different file types."""
         # Video file with processing
@@ -190,6 +314,109 @@ class EinoGCPTestCase(unittest.TestCase):
         # Non-video file
         self.assertFalse(is_processing_needed("application/pdf", True))
     
+    @patch('api.chunk.utils.requests.put')
+    @patch('api.chunk.utils.get_storage_client')
+    def test_append_to_resumable_upload(self, mock_get_client, mock_put):
+        """Test that PATCH bodies are streamed to the resumable session in aligned ranges."""
+        with self.app.app_context():
+            self.app.config['RESUMABLE_UPLOAD_SLICE_SIZE'] = 256 * 1024
+            resource = Resource(
+                id="test-resource-id",
+                size=1024 * 1024,
+                offset=0,
+                upload_id="https://storage.googleapis.com/resumable-upload-url"
+            )
+
+            mock_tail_blob = MagicMock()
+            mock_get_client.return_value.bucket.return_value.blob.return_value = mock_tail_blob
+            mock_put.return_value = MagicMock(status_code=308, headers={'Range': f"bytes=0-{256 * 1024 - 1}"})
+
+            # 300KB body: one aligned 256KB range goes to GCS, the rest is parked as the tail
+            received = append_to_resumable_upload(resource, io.BytesIO(b'x' * 300 * 1024))
+
+            self.assertEqual(received, 300 * 1024)
+            self.assertEqual(resource.offset, 300 * 1024)
+            mock_put.assert_called_once()
+            self.assertEqual(mock_put.call_args.kwargs['headers']['Content-Range'], f"bytes 0-{256 * 1024 - 1}/*")
+            mock_tail_blob.upload_from_string.assert_called_once_with(b'x' * 44 * 1024)
+            self.assertEqual(mock_put.call_args.kwargs['timeout'], (10, self.app.config['RESUMABLE_UPLOAD_TIMEOUT']))
+
+            # A range GCS persisted only part of is completed by sending the rest
+            mock_put.reset_mock()
+            mock_put.side_effect = [
+                MagicMock(status_code=308, headers={'Range': f"bytes=0-{100 * 1024 - 1}"}),
+                MagicMock(status_code=308, headers={'Range': f"bytes=0-{256 * 1024 - 1}"})
+            ]
+            self.assertEqual(put_resumable_upload_range(resource.upload_id, b'y' * 256 * 1024, 0), 256 * 1024)
+            self.assertEqual(mock_put.call_args.kwargs['headers']['Content-Range'], f"bytes {100 * 1024}-{256 * 1024 - 1}/*")
+            self.assertEqual(len(mock_put.call_args.kwargs['data']), 156 * 1024)
+
+    @patch('api.chunk.service.utils.compose_blobs')
+    @patch('api.chunk.service.utils.get_bucket')
+    def test_concatenated_upload_checks_partials_and_drops_failed_compose(self, mock_get_bucket, mock_compose):
+        """Test that only the tenant's own finished partials are concatenated, and a failed compose leaves no live resource."""
+        from api.chunk.service import start_concatenated_upload
+        with self.app.app_context():
+            db.session.add(Resource(id='partial-1', name='a.mp4', type='video/mp4', company='company1', created_by='user1',
+                                    size=1024, status='PARTIAL_FINISHED'))
+            db.session.commit()
+            auth_data = {'user': {'uuid': 'user1'}, 'company_user': {'id': 'cu1'}}
+
+            # Another tenant can't claim the partial, even with the same user id
+            with self.assertRaises(Exception):
+                start_concatenated_upload(auth_data, 'company2', '', 'dept1', upload_concat='final;/upload/partial-1')
+            mock_compose.assert_not_called()
+
+            mock_compose.side_effect = Exception('compose failed')
+            with self.assertRaises(Exception):
+                start_concatenated_upload(auth_data, 'company1', '', 'dept1', upload_concat='final;/upload/partial-1')
+            final = Resource.query.filter(Resource.id != 'partial-1').one()
+            self.assertTrue(final.is_deleted)
+            self.assertEqual(final.status, 'UPLOAD_FAILED')
+            self.assertEqual(db.session.get(Resource, 'partial-1').status, 'PARTIAL_FINISHED')
+
+    def test_compose_blobs_multi_level(self):
+        """Test that more than 32 sources are composed through intermediate objects."""
+        mock_bucket = MagicMock()
+        sources = [MagicMock(name=f"part-{i}") for i in range(70)]
+        destination = MagicMock()
+        destination.name = "company1/user1/final"
+
+        compose_blobs(mock_bucket, sources, destination, content_type="video/mp4")
+
+        # 70 sources -> 3 intermediates (32 + 32 + 6) -> final compose of 3
+        intermediates = [call.args[0] for call in mock_bucket.blob.call_args_list]
+        self.assertEqual(len(intermediates), 3)
+        final_sources = destination.compose.call_args.args[0]
+        self.assertEqual(len(final_sources), 3)
+        self.assertEqual(destination.content_type, "video/mp4")
+        mock_bucket.blob.return_value.compose.assert_any_call(sources[:32])
+        self.assertEqual(mock_bucket.blob.return_value.delete.call_count, 3)
+
+    def test_rewrite_blob_follows_token(self):
+        """Test that cross-bucket rewrites are resumed until GCS stops returning a token."""
+        source = MagicMock()
+        destination = MagicMock()
+        destination.rewrite.side_effect = [("token-1", 100, 300), ("token-2", 200, 300), (None, 300, 300)]
+
+        result = rewrite_blob(source, destination)
+
+        self.assertIs(result, destination)
+        self.assertEqual(destination.rewrite.call_count, 3)
+        destination.rewrite.assert_called_with(source, token="token-2")
+
+    def test_iter_blob_contents_keeps_order(self):
+        """Test that prefetched chunk downloads are yielded in chunk order."""
+        blobs = []
+        for i in range(10):
+            blob = MagicMock()
+            blob.download_as_bytes.return_value = f"chunk-{i};".encode()
+            blobs.append(blob)
+
+        data = b''.join(iter_blob_contents(blobs, prefetch=3))
+
+        self.assertEqual(data, b''.join(f"chunk-{i};".encode() for i in range(10)))
+
     @patch('api.chunk.service.utils.create_resumable_upload_session')
     @patch('api.chunk.service.utils.get_storage_client')
     @patch('flask.request')
@@ -236,6 +463,720 @@ class EinoGCPTestCase(unittest.TestCase):
             self.assertEqual(resource.created_by, 'test-user')
             self.assertEqual(resource.upload_id, "https://storage.googleapis.com/resumable-upload-url")
     
+    @patch('decorators.authorize.fetch_company_user_permissions')
+    def test_company_user_permissions_cache(self, mock_fetch):
+        """Test that permission lookups are cached, including failed lookups."""
+        with self.app.app_context():
+            mock_fetch.return_value = ({'id': 'company-user', 'permissions': ['CREATE_RESOURCES']}, True)
+
+            first = get_company_user_permissions('company1', 'user1')
+            second = get_company_user_permissions('company1', 'user1')
+
+            self.assertEqual(first, second)
+            mock_fetch.assert_called_once_with('company1', 'user1')
+            stats = get_permissions_cache_stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+            # Failed lookups are cached too, just for a shorter time
+            mock_fetch.return_value = (None, False)
+            self.assertIsNone(get_company_user_permissions('company1', 'user2'))
+            self.assertIsNone(get_company_user_permissions('company1', 'user2'))
+            self.assertEqual(mock_fetch.call_count, 2)
+
+            # Each caller gets its own copy of the cached permissions
+            first['permissions'].append('DELETE_RESOURCES')
+            self.assertEqual(get_company_user_permissions('company1', 'user1')['permissions'], ['CREATE_RESOURCES'])
+
+            # A full cache evicts the oldest entry instead of everything
+            self.app.config['PERMISSIONS_CACHE_SIZE'] = 2
+            mock_fetch.return_value = ({'permissions': []}, True)
+            get_company_user_permissions('company1', 'user3')
+            self.assertEqual(get_permissions_cache_stats()['size'], 2)
+            get_company_user_permissions('company1', 'user2')
+            self.assertEqual(mock_fetch.call_count, 3)
+            get_company_user_permissions('company1', 'user1')
+            self.assertEqual(mock_fetch.call_count, 4)
+
+            # The counters are reported on /health
+            from main import health_check
+            self.assertEqual(health_check()[0]['permissions_cache'], get_permissions_cache_stats())
+
+    @patch('api.chunk.utils.get_auth_token_from_company_user')
+    @patch('api.chunk.outbox.OUTBOX_SESSION')
+    def test_outbox_coalesces_and_retries(self, mock_session, mock_get_token):
+        """Test that queued Django callbacks are coalesced per resource and retried on failure."""
+        with self.app.app_context():
+            mock_get_token.return_value = {'access_token': 'service-token'}
+            resource = Resource(
+                id="test-resource-id",
+                name="test.pdf",
+                type="application/pdf",
+                company="company1",
+                created_by="user1",
+                size=1024
+            )
+            db.session.add(resource)
+            db.session.commit()
+
+            save_resource_to_db(resource, need_auth=True)
+            resource.preview_image = "company1/user1/pdf-preview-test-resource-id.png"
+            save_resource_to_db(resource, need_auth=True)
+            # The newer snapshot supersedes the pending one
+            self.assertEqual(ResourceOutbox.query.count(), 1)
+
+            # Django is down: the newest snapshot stays queued with a backoff
+            mock_session.post.return_value = MagicMock(ok=False, status_code=502)
+            dispatch_outbox_batch()
+            entry = ResourceOutbox.query.one()
+            self.assertEqual(entry.attempts, 1)
+            self.assertEqual(entry.status, 'PENDING')
+            self.assertEqual(dispatch_outbox_batch(), 0)
+
+            # Once due again and delivered, the entry leaves the outbox
+            entry.next_attempt_at = entry.created_at
+            db.session.commit()
+            mock_session.post.reset_mock()
+            mock_session.post.return_value = MagicMock(ok=True)
+            dispatch_outbox_batch()
+            mock_session.post.assert_called_once()
+            self.assertEqual(mock_session.post.call_args.kwargs['json']['preview_image'], resource.preview_image)
+            self.assertEqual(ResourceOutbox.query.count(), 0)
+
+    @patch('api.chunk.utils.get_auth_token_from_company_user')
+    @patch('api.chunk.outbox.OUTBOX_SESSION')
+    def test_outbox_never_delivers_stale_snapshots(self, mock_session, mock_get_token):
+        """Test that a snapshot retried after a newer one was queued is dropped, and in-flight resources wait."""
+        from datetime import datetime, timedelta
+        with self.app.app_context():
+            mock_get_token.return_value = {'access_token': 'service-token'}
+            now = datetime.utcnow()
+            # An older snapshot put back for a retry, a newer one queued meanwhile
+            db.session.add(ResourceOutbox(resource_id='r1', payload='{"name": "old"}', status='PENDING',
+                                          created_at=now - timedelta(minutes=5), next_attempt_at=now - timedelta(seconds=1)))
+            db.session.add(ResourceOutbox(resource_id='r1', payload='{"name": "new"}', status='PENDING',
+                                          created_at=now - timedelta(minutes=1), next_attempt_at=now - timedelta(seconds=1)))
+            # r2 has a snapshot being delivered by another dispatcher
+            db.session.add(ResourceOutbox(resource_id='r2', payload='{"name": "sending"}', status='DELIVERING',
+                                          created_at=now - timedelta(minutes=5), next_attempt_at=now + timedelta(minutes=5)))
+            db.session.add(ResourceOutbox(resource_id='r2', payload='{"name": "waiting"}', status='PENDING',
+                                          created_at=now - timedelta(minutes=1), next_attempt_at=now - timedelta(seconds=1)))
+            db.session.commit()
+
+            mock_session.post.return_value = MagicMock(ok=True)
+            self.assertEqual(dispatch_outbox_batch(), 2)
+            mock_session.post.assert_called_once()
+            self.assertEqual(mock_session.post.call_args.kwargs['json'], {'name': 'new'})
+            self.assertEqual(sorted(e.payload for e in ResourceOutbox.query.all()), ['{"name": "sending"}', '{"name": "waiting"}'])
+
+    @patch('api.chunk.utils.get_auth_token_from_company_user')
+    @patch('api.chunk.outbox.OUTBOX_SESSION')
+    def test_outbox_drops_failed_snapshot_after_newer_delivery(self, mock_session, mock_get_token):
+        """Test that an older snapshot waiting out a retry backoff is never sent after a newer one was delivered."""
+        from datetime import datetime, timedelta
+        with self.app.app_context():
+            mock_get_token.return_value = {'access_token': 'service-token'}
+            now = datetime.utcnow()
+            # The old snapshot failed and waits for its retry, the new one is due
+            db.session.add(ResourceOutbox(resource_id='r1', payload='{"name": "old"}', status='PENDING', attempts=1,
+                                          created_at=now - timedelta(minutes=5), next_attempt_at=now + timedelta(minutes=5)))
+            db.session.add(ResourceOutbox(resource_id='r1', payload='{"name": "new"}', status='PENDING',
+                                          created_at=now - timedelta(minutes=1), next_attempt_at=now - timedelta(seconds=1)))
+            db.session.commit()
+
+            mock_session.post.return_value = MagicMock(ok=True)
+            dispatch_outbox_batch()
+            mock_session.post.assert_called_once()
+            self.assertEqual(mock_session.post.call_args.kwargs['json'], {'name': 'new'})
+            self.assertEqual(ResourceOutbox.query.count(), 0)
+
+            # A snapshot that fails after a newer one was queued isn't retried
+            old = ResourceOutbox(resource_id='r2', payload='{"name": "old"}', status='PENDING',
+                                 created_at=now - timedelta(minutes=5), next_attempt_at=now - timedelta(seconds=1))
+            db.session.add(old)
+            db.session.commit()
+
+            def post(url, json=None, headers=None, timeout=None):
+                db.session.add(ResourceOutbox(resource_id='r2', payload='{"name": "new"}', status='PENDING',
+                                              created_at=now - timedelta(minutes=1), next_attempt_at=now + timedelta(seconds=30)))
+                return MagicMock(ok=False, status_code=502)
+
+            mock_session.post.side_effect = post
+            dispatch_outbox_batch()
+            self.assertEqual([e.payload for e in ResourceOutbox.query.all()], ['{"name": "new"}'])
+
+    @patch('api.chunk.utils.SERVICE_TOKEN_SESSION')
+    def test_service_token_is_cached_until_expiry(self, mock_session):
+        """Test that minted service tokens are reused until shortly before they expire."""
+        import jwt, time
+        with self.app.app_context():
+            token = jwt.encode({'exp': int(time.time()) + 3600}, self.app.config['SECRET_KEY'] * 4, algorithm='HS256')
+            mock_session.post.return_value = MagicMock(ok=True, json=lambda: {'data': {'access_token': token}})
+
+            first = get_auth_token_from_company_user('company-user', 'company1', 'user1')
+            second = get_auth_token_from_company_user('company-user', 'company1', 'user1')
+
+            self.assertEqual(first['access_token'], token)
+            self.assertIs(first, second)
+            mock_session.post.assert_called_once()
+
+            # An expired token is minted again
+            expired = jwt.encode({'exp': int(time.time()) + 5}, self.app.config['SECRET_KEY'] * 4, algorithm='HS256')
+            mock_session.post.return_value = MagicMock(ok=True, json=lambda: {'data': {'access_token': expired}})
+            get_auth_token_from_company_user('company-user', 'company1', 'user2')
+            get_auth_token_from_company_user('company-user', 'company1', 'user2')
+            self.assertEqual(mock_session.post.call_count, 3)
+
+    @patch('api.chunk.service.complete_chunk_upload')
+    def test_resource_lock_excludes_duplicate_completion(self, mock_complete):
+        """Test that completions of the same resource are excluded while others proceed."""
+        from api.chunk.service import chunk_upload_completed
+        with self.app.app_context():
+            resource = MagicMock(id='resource1')
+            other = MagicMock(id='resource2')
+            mock_complete.side_effect = lambda res, is_restart: res
+
+            with resource_lock('resource1') as locked:
+                self.assertTrue(locked)
+                with resource_lock('resource1', blocking=False) as duplicate:
+                    self.assertFalse(duplicate)
+
+                # A duplicate completion is skipped, an unrelated one goes ahead
+                self.assertIs(chunk_upload_completed(resource), resource)
+                chunk_upload_completed(other)
+                mock_complete.assert_called_once_with(other, False)
+
+            chunk_upload_completed(resource)
+            self.assertEqual(mock_complete.call_count, 2)
+            self.assertEqual(RESOURCE_LOCKS, {})
+
+    @patch('api.chunk.utils.get_lock_engine')
+    @patch('api.chunk.utils.db')
+    def test_advisory_lock_drops_connection_when_unlock_fails(self, mock_db, mock_get_lock_engine):
+        """Test that advisory locks use their own engine, and a failed unlock discards the connection."""
+        mock_db.engine.dialect.name = 'postgresql'
+        connection = mock_get_lock_engine.return_value.connect.return_value
+        connection.execute.side_effect = [MagicMock(), Exception('connection reset')]
+
+        with resource_lock('resource1') as locked:
+            self.assertTrue(locked)
+
+        mock_db.engine.connect.assert_not_called()
+        connection.invalidate.assert_called_once()
+        connection.close.assert_called_once()
+
+    @patch('api.chunk.transcoding.subprocess.run')
+    def test_transcode_scheduler_bounds_jobs(self, mock_run):
+        """Test that ffmpeg runs are capped at max_jobs and get a -threads budget."""
+        import threading, time
+        scheduler = TranscodeScheduler(max_jobs=2, threads_per_job=3)
+        active, peak = [0], [0]
+        lock = threading.Lock()
+
+        def run(command, **kwargs):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return MagicMock(returncode=0)
+        mock_run.side_effect = run
+
+        futures = [scheduler.submit(scheduler.run, ['ffmpeg', '-i', 'in.mov', 'out.mp4']) for _ in range(6)]
+        for future in futures:
+            future.result()
+
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(mock_run.call_args[0][0], [
+            'ffmpeg', '-filter_threads', '3', '-filter_complex_threads', '3',
+            '-threads', '3', '-i', 'in.mov', '-threads', '3', 'out.mp4'
+        ])
+        # Every input and output of a multi-output command is budgeted, explicit budgets are kept
+        command = scheduler.with_thread_budget([
+            'ffmpeg', '-y', '-noaccurate_seek', '-ss', '1', '-i', 'a.mp4', '-threads', '1', '-i', 'b.mp4',
+            '-map', '0:v', '-q:v', '3', 'poster.jpg', '-map', '1:v', '-threads', '1', 'tile.jpg'
+        ])
+        self.assertEqual(command[5:], [
+            '-y', '-noaccurate_seek', '-ss', '1', '-threads', '3', '-i', 'a.mp4', '-threads', '1', '-i', 'b.mp4',
+            '-map', '0:v', '-q:v', '3', '-threads', '3', 'poster.jpg', '-map', '1:v', '-threads', '1', 'tile.jpg'
+        ])
+        self.assertEqual(scheduler.stats()['completed'], 6)
+        self.assertEqual(scheduler.stats()['queued'], 0)
+        scheduler.executor.shutdown()
+
+    def test_cpu_count_follows_cgroup_quota(self):
+        """Test that the cgroup v2 CPU quota caps the CPU count."""
+        with patch('builtins.open', mock_open(read_data='200000 100000\n')), \
+             patch('api.chunk.transcoding.os.sched_getaffinity', return_value=set(range(16))):
+            self.assertEqual(get_cpu_count(), 2)
+        with patch('builtins.open', mock_open(read_data='max 100000\n')), \
+             patch('api.chunk.transcoding.os.sched_getaffinity', return_value=set(range(16))):
+            self.assertEqual(get_cpu_count(), 16)
+
+    def test_build_hls_command_decodes_once(self):
+        """Test that all renditions share one decode and one audio encode."""
+        qualities = [
+            {'name': '360p', 'resolution': '640x360', 'bitrate': '1M', 'crf': '28', 'bandwidth': '1000000'},
+            {'name': '720p', 'resolution': '1280x720', 'bitrate': '4M', 'crf': '24', 'bandwidth': '4000000'}
+        ]
+        command = build_hls_command('source.mp4', 'hls', qualities)
+
+        self.assertEqual(command.count('-i'), 1)
+        self.assertIn('[0:v]split=2[s0][s1];[s0]scale=640:360[v0];[s1]scale=1280:720[v1]', command)
+        self.assertEqual(command.count('0:a:0?'), 1)
+        self.assertEqual(command[command.index('-var_stream_map') + 1],
+                         'v:0,agroup:audio,name:360p v:1,agroup:audio,name:720p a:0,agroup:audio,name:audio')
+        self.assertEqual(command[command.index('-master_pl_name') + 1], 'output.m3u8')
+        self.assertEqual(command[-1], 'hls/output_%v.m3u8')
+
+        silent = build_hls_command('source.mp4', 'hls', qualities, with_audio=False)
+        self.assertNotIn('0:a:0?', silent)
+        self.assertEqual(silent[silent.index('-var_stream_map') + 1], 'v:0,name:360p v:1,name:720p')
+
+    def test_mp4_and_hls_from_one_decode(self):
+        """Test that the MP4 and the HLS ladder are written by one command reading the source once."""
+        from api.chunk.utils import build_mp4_and_hls_command, get_mp4_conversion
+        qualities = [{'name': '360p', 'resolution': '640x360', 'bitrate': '1M', 'crf': '28', 'bandwidth': '1000000'}]
+
+        mode, options = get_mp4_conversion({'video_codec': 'hevc', 'pixel_format': 'yuv420p', 'audio_codec': 'aac'})
+        command = build_mp4_and_hls_command('source.mov', 'out.mp4', 'hls', qualities, mode, options, threads=4)
+        self.assertEqual(command.count('-i'), 1)
+        self.assertIn('[0:v]split=2[s0][mp4];[s0]scale=640:360[v0]', command)
+        self.assertEqual(command[command.index('-map') + 1], '[mp4]')
+        self.assertLess(command.index('out.mp4'), command.index('[v0]'))
+        self.assertEqual(command.count('-threads'), 2)
+        self.assertEqual(command[-1], 'hls/output_%v.m3u8')
+
+        mode, options = get_mp4_conversion({'video_codec': 'h264', 'pixel_format': 'yuv420p', 'audio_codec': 'aac'})
+        command = build_mp4_and_hls_command('source.mov', 'out.mp4', 'hls', qualities, mode, options)
+        self.assertIn('[0:v]split=1[s0];[s0]scale=640:360[v0]', command)
+        self.assertEqual(command[command.index('out.mp4') - 3:command.index('out.mp4')], ['copy', '-movflags', '+faststart'])
+
+    def test_master_playlist_lists_the_whole_ladder(self):
+        """Test that the master playlist is written for every finished rendition with the shared audio group."""
+        from api.chunk.utils import write_master_playlist
+        qualities = [
+            {'name': '360p', 'resolution': '640x360', 'bandwidth': '1000000'},
+            {'name': '720p', 'resolution': '1280x720', 'bandwidth': '4000000'}
+        ]
+        folder = tempfile.mkdtemp()
+        write_master_playlist(folder, qualities, audio_group=True)
+        with open(os.path.join(folder, 'output.m3u8')) as f:
+            lines = f.read().splitlines()
+        os.remove(os.path.join(folder, 'output.m3u8'))
+        os.rmdir(folder)
+
+        self.assertIn('URI="output_audio.m3u8"', lines[2])
+        self.assertEqual(lines[3], '#EXT-X-STREAM-INF:BANDWIDTH=1000000,RESOLUTION=640x360,NAME="360p",AUDIO="audio"')
+        self.assertEqual(lines[4::2], ['output_360p.m3u8', 'output_720p.m3u8'])
+
+    @patch('api.chunk.utils.save_video_thumbnails')
+    def test_mp4_and_hls_skips_finished_resources(self, mock_thumbnails):
+        """Test that a resource with every rendition and the MP4 done isn't encoded again."""
+        from api.chunk.utils import generate_mp4_and_streams
+        probe = {'duration': 10.0, 'width': 1280, 'height': 720, 'bitrate': 4000000,
+                 'video_codec': 'h264', 'pixel_format': 'yuv420p', 'audio_codec': 'aac'}
+        resource = MagicMock(id='video-1')
+        bucket = MagicMock()
+
+        bucket.blob.return_value.exists.return_value = True
+        self.assertTrue(generate_mp4_and_streams(resource, 'source.mp4', probe, 'remux', [], 'out.mp4', 'key/out.mp4', bucket))
+        # Without the MP4, the caller encodes it on its own
+        bucket.blob.return_value.exists.return_value = False
+        self.assertFalse(generate_mp4_and_streams(resource, 'source.mp4', probe, 'remux', [], 'out.mp4', 'key/out.mp4', bucket))
+        mock_thumbnails.assert_not_called()
+
+    def test_hls_single_file_packaging(self):
+        """Test that single-file renditions are written as one byte-range addressed file and uploaded whole."""
+        qualities = [{'name': '360p', 'resolution': '640x360', 'bitrate': '1M', 'crf': '28', 'bandwidth': '1000000'}]
+        command = build_hls_command('source.mp4', 'hls', qualities, segment_type='fmp4', single_file=True)
+        self.assertEqual(command[command.index('-hls_flags') + 1], 'single_file')
+        self.assertEqual(command[command.index('-hls_segment_filename') + 1], 'hls/output_%v.mp4')
+        self.assertEqual(command[command.index('-hls_fmp4_init_filename') + 1], 'output_%v_init.mp4')
+
+        local_folder = tempfile.mkdtemp()
+        for name in ['output_360p.mp4', 'output_360p_init.mp4', 'output_360p.m3u8', 'output.m3u8']:
+            with open(os.path.join(local_folder, name), 'w') as f:
+                f.write(name)
+        uploaded = []
+        bucket = MagicMock()
+        bucket.blob.side_effect = lambda key: MagicMock(upload_from_filename=lambda path, **kwargs: uploaded.append(key.split('/')[-1]))
+
+        uploader = SegmentUploader(bucket, local_folder, 'hls')
+        uploader.scan()
+        self.assertEqual(uploaded, [])
+        uploader.finish()
+        uploader.close()
+
+        self.assertEqual(sorted(uploaded[:2]), ['output_360p.mp4', 'output_360p_init.mp4'])
+        self.assertEqual(uploaded[2:], ['output_360p.m3u8', 'output.m3u8'])
+        os.rmdir(local_folder)
+
+    @patch('api.chunk.utils.subprocess.run')
+    def test_probe_media(self, mock_run):
+        """Test reading display size, bitrate and codecs from ffprobe output."""
+        mock_run.return_value = MagicMock(returncode=0, stdout=json.dumps({
+            'streams': [
+                {'codec_type': 'video', 'codec_name': 'hevc', 'width': 1920, 'height': 1080,
+                 'bit_rate': '3000000', 'side_data_list': [{'rotation': -90}]},
+                {'codec_type': 'audio', 'codec_name': 'aac'}
+            ],
+            'format': {'duration': '12.5', 'bit_rate': '3200000'}
+        }).encode())
+
+        probe = probe_media('phone.mov')
+
+        self.assertEqual(probe, {
+            'duration': 12.5, 'width': 1080, 'height': 1920, 'bitrate': 3000000,
+            'video_codec': 'hevc', 'pixel_format': None, 'audio_codec': 'aac'
+        })
+
+    def test_mp4_conversion_mode(self):
+        """Test that compatible sources are remuxed and only incompatible streams re-encoded."""
+        from api.chunk.utils import get_mp4_conversion
+        h264 = {'video_codec': 'h264', 'pixel_format': 'yuv420p', 'audio_codec': 'aac'}
+
+        mode, options = get_mp4_conversion(h264)
+        self.assertEqual(mode, 'remux')
+        self.assertEqual(options[-2:], ['-c', 'copy'])
+        self.assertEqual(get_mp4_conversion({**h264, 'audio_codec': None})[0], 'remux')
+
+        mode, options = get_mp4_conversion({**h264, 'audio_codec': 'pcm_s16le'})
+        self.assertEqual(mode, 'audio')
+        self.assertEqual(options[options.index('-c:v') + 1], 'copy')
+        self.assertEqual(options[options.index('-c:a') + 1], 'aac')
+
+        self.assertEqual(get_mp4_conversion({**h264, 'pixel_format': 'yuv420p10le'})[0], 'transcode')
+        self.assertEqual(get_mp4_conversion({**h264, 'video_codec': 'hevc'})[0], 'transcode')
+        self.assertEqual(get_mp4_conversion(None)[0], 'transcode')
+
+    def test_encoding_ladder_follows_source(self):
+        """Test that the ladder never upscales, keeps the aspect ratio and caps bitrates."""
+        ladder = get_encoding_ladder({'width': 854, 'height': 480, 'bitrate': 1500000})
+        self.assertEqual([q['name'] for q in ladder], ['360p', '480p'])
+        self.assertEqual(ladder[0]['resolution'], '640x360')
+        self.assertEqual([q['bitrate'] for q in ladder], ['1000k', '1500k'])
+
+        portrait = get_encoding_ladder({'width': 720, 'height': 1280, 'bitrate': None})
+        self.assertEqual([q['resolution'] for q in portrait], ['360x640', '480x854', '720x1280'])
+
+        tiny = get_encoding_ladder({'width': 320, 'height': 240, 'bitrate': 400000})
+        self.assertEqual([(q['name'], q['resolution'], q['bitrate']) for q in tiny], [('360p', '320x240', '400k')])
+
+        self.assertEqual(len(get_encoding_ladder(None)), 4)
+
+    def test_segment_uploader_ships_finished_segments(self):
+        """Test that segments upload as soon as they're finished, playlists after them and the master last."""
+        local_folder = tempfile.mkdtemp()
+        for name in ['output_360p_000.ts', 'output_360p_001.ts', 'output_audio_000.ts', 'output_360p.m3u8', 'output_audio.m3u8', 'output.m3u8']:
+            with open(os.path.join(local_folder, name), 'w') as f:
+                f.write(name)
+
+        uploaded = []
+        bucket = MagicMock()
+        bucket.blob.side_effect = lambda key: MagicMock(upload_from_filename=lambda path, **kwargs: uploaded.append((key, kwargs)))
+        completed = []
+        uploader = SegmentUploader(bucket, local_folder, 'hls/resource1', on_rendition_complete=completed.append)
+
+        # The newest segment of each rendition may still be open in ffmpeg
+        uploader.scan()
+        uploader.close()
+        self.assertEqual([key for key, _ in uploaded], ['hls/resource1/output_360p_000.ts'])
+        self.assertEqual(uploaded[0][1], {'content_type': 'video/mp2t', 'predefined_acl': 'publicRead'})
+        self.assertFalse(os.path.exists(os.path.join(local_folder, 'output_360p_000.ts')))
+
+        uploader = SegmentUploader(bucket, local_folder, 'hls/resource1', on_rendition_complete=completed.append)
+        uploader.submitted.add('output_360p_000.ts')
+        uploader.finish()
+        uploader.close()
+
+        keys = [key.split('/')[-1] for key, _ in uploaded]
+        self.assertEqual(keys[-1], 'output.m3u8')
+        self.assertLess(keys.index('output_360p_001.ts'), keys.index('output_360p.m3u8'))
+        self.assertLess(keys.index('output_audio_000.ts'), keys.index('output_audio.m3u8'))
+        self.assertEqual(sorted(completed), ['360p', 'audio'])
+        self.assertEqual(os.listdir(local_folder), [])
+        os.rmdir(local_folder)
+
+    def test_media_cache_evicts_unpinned_lru(self):
+        """Test that the media cache downloads once, keeps pinned entries and evicts the least recently used."""
+        folder = tempfile.mkdtemp()
+        cache = MediaCache(folder, max_bytes=10)
+        fetched = []
+
+        def fetch(content):
+            def download(path):
+                fetched.append(content)
+                with open(path, 'w') as f:
+                    f.write(content)
+            return download
+
+        with cache.acquire('a.mp4', fetch('aaaa')) as path:
+            with open(path) as f:
+                self.assertEqual(f.read(), 'aaaa')
+            # A second stage of the same job reuses the local copy
+            with cache.acquire('a.mp4', fetch('xxxx')) as again:
+                self.assertEqual(again, path)
+        with cache.acquire('b.mp4', fetch('bbbb')):
+            pass
+        with cache.acquire('a.mp4', fetch('xxxx')):
+            pass
+        self.assertEqual(fetched, ['aaaa', 'bbbb'])
+
+        # Over the limit, b is the least recently used, while a stays because it's pinned
+        with cache.acquire('a.mp4', fetch('xxxx')):
+            with cache.acquire('c.mp4', fetch('cccc')):
+                self.assertEqual(sorted(os.listdir(folder)), ['a.mp4', 'c.mp4'])
+                # Pinned entries may keep the cache over its limit
+                with cache.acquire('d.mp4', fetch('dddd')):
+                    self.assertEqual(cache.size(), 12)
+        self.assertLessEqual(cache.size(), 10)
+
+        # A failed download leaves nothing behind
+        def fail(path):
+            open(path, 'w').close()
+            raise IOError('download failed')
+        with self.assertRaises(IOError):
+            with cache.acquire('e.mp4', fail):
+                pass
+        self.assertNotIn('e.mp4', os.listdir(folder))
+        self.assertFalse([name for name in os.listdir(folder) if name.endswith('.partial')])
+
+        # The limit covers the whole folder, including entries other workers cached
+        other = MediaCache(folder, max_bytes=10)
+        self.assertEqual(other.size(), cache.size())
+        with other.acquire('f.mp4', fetch('ffff')):
+            pass
+        self.assertLessEqual(cache.size(), 10)
+        self.assertIn('f.mp4', os.listdir(folder))
+
+        # Another worker sharing the folder can't evict an entry pinned here, and drops abandoned partials
+        open(os.path.join(folder, 'z.mp4.abc.partial'), 'w').close()
+        with cache.acquire('a.mp4', fetch('xxxx')) as path:
+            other = MediaCache(folder, max_bytes=0)
+            self.assertFalse([name for name in os.listdir(folder) if name.endswith('.partial')])
+            other.evict()
+            self.assertTrue(os.path.exists(path))
+        other.evict()
+        self.assertFalse(os.path.exists(path))
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+
+    def test_download_file_uses_ranged_slices(self):
+        """Test that large files are downloaded as concurrent byte ranges into place."""
+        content = bytes(range(256)) * 40
+        requested = []
+        timeouts = set()
+
+        def get(url, headers=None, stream=False, timeout=None):
+            timeouts.add(timeout)
+            response = MagicMock()
+            response.__enter__.return_value = response
+            start, end = (int(x) for x in headers['Range'][len('bytes='):].split('-'))
+            requested.append((start, end))
+            response.status_code = 206
+            response.headers = {'Content-Range': f"bytes {start}-{end}/{len(content)}"}
+            response.iter_content.return_value = [content[start:end + 1][i:i + 100] for i in range(0, end - start + 1, 100)]
+            return response
+
+        self.app.config['DOWNLOAD_SLICE_SIZE'] = 1000
+        filename = os.path.join(tempfile.mkdtemp(), 'source.mp4')
+        with self.app.app_context(), patch('api.chunk.utils.DOWNLOAD_SESSION') as session:
+            session.get.side_effect = get
+            download_file('https://storage.example/source.mp4', filename)
+
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # One probe, then 11 slices with the last one short
+        self.assertEqual(requested[0], (0, 0))
+        self.assertEqual(sorted(requested[1:]), [(start, min(start + 1000, len(content)) - 1) for start in range(0, len(content), 1000)])
+        # No request can hang on a stalled connection
+        self.assertEqual(timeouts, {(10, 60)})
+        os.remove(filename)
+        os.rmdir(os.path.dirname(filename))
+
+    def test_thumbnails_seek_inputs_and_index_storyboard(self):
+        """Test that thumbnails seek on the input and the storyboard index points at each tile."""
+        from api.chunk.thumbnails import (
+            build_poster_command, build_thumbnails_command, build_stack_command, build_storyboard_vtt,
+            get_storyboard_timestamps, get_storyboard_batches
+        )
+        from api.chunk.utils import save_video_preview
+        poster = build_poster_command('source.mp4', 'poster.jpg', 1.0)
+        self.assertLess(poster.index('-ss'), poster.index('-i'))
+
+        timestamps = get_storyboard_timestamps(25, 10, 100)
+        self.assertEqual(timestamps, [0, 10, 20])
+        self.assertEqual(len(get_storyboard_timestamps(3600, 10, 100)), 100)
+        self.assertEqual(get_storyboard_timestamps(25, 10, 100, [30, 5, 5, 0]), [0.0, 5.0])
+
+        command = build_thumbnails_command('source.mp4', 'poster.jpg', 'sprite.jpg', timestamps, 1.0, (160, 90), 2)
+        # One fast-seeked input per frame: the poster, then each tile
+        inputs = [i for i, arg in enumerate(command) if arg == '-i']
+        self.assertEqual(len(inputs), 4)
+        self.assertEqual([command[i + 1] for i in inputs], ['source.mp4'] * 4)
+        self.assertEqual([command[i - 1] for i in inputs], ['1.000', '0.000', '10.000', '20.000'])
+        self.assertIn('tile=2x2[sprite]', command[command.index('-filter_complex') + 1])
+        self.assertEqual(command[-1], 'sprite.jpg')
+        # Each decoder is single-threaded
+        self.assertEqual([command[i - 5:i - 3] for i in inputs], [['-threads', '1']] * 4)
+
+        # Long storyboards are split into strips of whole rows, the poster only in the first
+        batches = get_storyboard_batches(get_storyboard_timestamps(3600, 10, 100), 10, 25)
+        self.assertEqual([len(batch) for batch in batches], [20] * 5)
+        strip = build_thumbnails_command('source.mp4', None, 'strip-1.png', batches[1], 1.0, (160, 90), 10, (10, 2))
+        self.assertEqual(strip.count('-i'), 20)
+        self.assertNotIn('[poster]', strip)
+        self.assertIn('tile=10x2[sprite]', strip[strip.index('-filter_complex') + 1])
+        stack = build_stack_command(['strip-0.png', 'strip-1.png'], 'sprite.jpg')
+        self.assertIn('[0:v][1:v]vstack=inputs=2[sprite]', stack)
+
+        # The poster-only preview runs on the transcode scheduler like every other ffmpeg job
+        with self.app.app_context(), patch('api.chunk.transcoding.run_ffmpeg', return_value=MagicMock(returncode=0)) as run_ffmpeg:
+            save_video_preview(MagicMock(id='r1', video_duration=25), 'https://storage.example/source.mp4')
+        self.assertEqual(run_ffmpeg.call_args.args[0][:-1], build_poster_command('https://storage.example/source.mp4', 'x', 1.0)[:-1])
+
+        vtt = build_storyboard_vtt('storyboard.jpg', timestamps, 25, (160, 90), 2).split('\n')
+        self.assertEqual(vtt[0], 'WEBVTT')
+        self.assertEqual(vtt[2:4], ['00:00:00.000 --> 00:00:10.000', 'storyboard.jpg#xywh=0,0,160,90'])
+        self.assertEqual(vtt[8:10], ['00:00:20.000 --> 00:00:25.000', 'storyboard.jpg#xywh=0,90,160,90'])
+
+    def test_preview_renderer_renders_in_worker_process(self):
+        """Test that document previews render out of process at the target width, and hung renders are cut off."""
+        import fitz
+        doc = fitz.open()
+        doc.new_page(width=600, height=800).insert_text((72, 72), 'Preview')
+        data = doc.tobytes()
+        doc.close()
+
+        renderer = PreviewRenderer(max_workers=1, max_memory=512 * 1024 ** 2, timeout=60)
+        try:
+            image, image_format = renderer.render(data, 'pdf', 300)
+            self.assertEqual(image_format, 'jpeg')
+            self.assertEqual(fitz.Pixmap(image).width, 300)
+
+            executor = renderer.executor
+            renderer.timeout = 0
+            with self.assertRaises(TimeoutError):
+                renderer.render(data, 'pdf', 300)
+            # The stuck pool is replaced on the next render
+            self.assertIsNone(renderer.executor)
+            renderer.timeout = 60
+            self.assertEqual(renderer.render(data, 'pdf', 300)[1], 'jpeg')
+            self.assertIsNot(renderer.executor, executor)
+
+            # Workers come from the forkserver, without the app or Flask loaded
+            self.assertFalse(renderer.executor.submit(eval, "'flask' in __import__('sys').modules").result(timeout=60))
+        finally:
+            renderer.close()
+
+    def test_main_module_is_import_safe(self):
+        """Test that importing main.py, as preview workers do with the entry script, doesn't load Flask or create the app."""
+        import subprocess
+        import sys
+        result = subprocess.run(
+            [sys.executable, '-c', "import sys, main; print('flask' in sys.modules, main.APP)"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.strip(), 'False None')
+
+    def build_linearized_pdf(self, padding):
+        """Builds a two page PDF laid out like a linearized one: page one first, page two, the page tree and xref last."""
+        font = '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'
+        page = '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 600 800] /Contents %d 0 R /Resources << /F1 7 0 R >> >>'
+        first = 'BT /F1 24 Tf 72 700 Td (First page) Tj ET'
+        second = '%' + 'x' * padding + '\nBT /F1 24 Tf 72 700 Td (Second page) Tj ET'
+        linearization = (0, 0, 0)
+        for _ in range(3):
+            data, offsets = b'%PDF-1.4\n', {}
+            objects = [
+                (10, '<< /Linearized 1 /L %d /H [0 0] /O 3 /E %d /N 2 /T %d >>' % linearization),
+                (1, '<< /Type /Catalog /Pages 2 0 R >>'), (3, page % 4), (7, font),
+                (4, f"<< /Length {len(first)} >>\nstream\n{first}\nendstream"),
+                (5, page % 6), (6, f"<< /Length {len(second)} >>\nstream\n{second}\nendstream"),
+                (2, '<< /Type /Pages /Kids [3 0 R 5 0 R] /Count 2 >>')
+            ]
+            for number, body in objects:
+                if number == 5:
+                    end_of_first_page = len(data)
+                offsets[number] = len(data)
+                data += f"{number} 0 obj\n{body}\nendobj\n".encode()
+            xref = len(data)
+            data += b'xref\n0 11\n' + b''.join(
+                b'%010d 00000 n \n' % offsets[n] if n in offsets else b'0000000000 65535 f \n' for n in range(11)
+            )
+            data += b'trailer\n<< /Size 11 /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % xref
+            linearization = (len(data), end_of_first_page, xref)
+        return data
+
+    def test_pdf_preview_reads_linearized_ranges(self):
+        """Test that a linearized PDF preview only fetches the first page and the tail, and others are fetched whole."""
+        import fitz
+        import preview_worker
+        data = self.build_linearized_pdf(6 * 1024 * 1024)
+        fetched = []
+
+        def get(url, headers=None, timeout=None):
+            start, end = (int(x) for x in headers['Range'][len('bytes='):].split('-'))
+            fetched.append(end - start + 1)
+            return MagicMock(status_code=206, headers={'Content-Range': f"bytes {start}-{end}/{len(data)}"}, content=data[start:end + 1])
+
+        session = MagicMock()
+        session.__enter__.return_value = session
+        session.get.side_effect = get
+        with patch('preview_worker.requests.Session', return_value=session), \
+                patch('preview_worker.requests.get') as full_get:
+            image, image_format = preview_worker.render_first_page('https://storage.example/doc.pdf', 'pdf', 300, 'jpeg', 80)
+        full_get.assert_not_called()
+        self.assertEqual(fitz.Pixmap(image).width, 300)
+        self.assertLess(sum(fetched), len(data) / 2)
+
+        # Not linearized: the whole document is fetched
+        doc = fitz.open()
+        doc.new_page(width=600, height=800)
+        data = doc.tobytes()
+        doc.close()
+        with patch('preview_worker.requests.Session', return_value=session), \
+                patch('preview_worker.requests.get', return_value=MagicMock(content=data)) as full_get:
+            image, image_format = preview_worker.render_first_page('https://storage.example/doc.pdf', 'pdf', 300, 'jpeg', 80)
+        full_get.assert_called_once()
+        self.assertEqual(fitz.Pixmap(image).width, 300)
+
+    def test_cmaf_streams_share_segments(self):
+        """Test that the CMAF encode emits DASH and HLS manifests over one set of segments."""
+        from api.chunk.adaptive_streaming import build_cmaf_command, CMAF_SEGMENT_PATTERN, CMAF_MANIFESTS
+        qualities = [{'name': '360p', 'resolution': '640x360', 'bitrate': '1M', 'crf': '28', 'bandwidth': '1000000'}]
+        command = build_cmaf_command('source.mp4', 'out', qualities)
+        self.assertEqual(command.count('-i'), 1)
+        self.assertEqual(command[command.index('-f') + 1], 'dash')
+        self.assertEqual(command[command.index('-hls_playlist') + 1], '1')
+        self.assertEqual(command[-1], 'out/manifest.mpd')
+
+        local_folder = tempfile.mkdtemp()
+        for name in ['chunk_0_00001.m4s', 'chunk_0_00002.m4s', 'chunk_1_00001.m4s', 'init_0.m4s', 'init_1.m4s',
+                     'media_0.m3u8', 'media_1.m3u8', 'manifest.mpd', 'output.m3u8']:
+            with open(os.path.join(local_folder, name), 'w') as f:
+                f.write(name)
+        uploaded = []
+        bucket = MagicMock()
+        bucket.blob.side_effect = lambda key: MagicMock(upload_from_filename=lambda path, **kwargs: uploaded.append(key.split('/')[-1]))
+        completed = []
+
+        uploader = SegmentUploader(bucket, local_folder, 'out', on_rendition_complete=completed.append,
+                                   segment_pattern=CMAF_SEGMENT_PATTERN, manifests=CMAF_MANIFESTS)
+        uploader.scan()
+        self.assertEqual(uploader.submitted, {'chunk_0_00001.m4s'})
+        uploader.finish()
+        uploader.close()
+
+        self.assertEqual(uploaded[-2:], ['manifest.mpd', 'output.m3u8'])
+        self.assertEqual(sorted(uploaded[:-2]), sorted(['chunk_0_00001.m4s', 'chunk_0_00002.m4s', 'chunk_1_00001.m4s',
+                                                        'init_0.m4s', 'init_1.m4s', 'media_0.m3u8', 'media_1.m3u8']))
+        self.assertGreater(uploaded.index('media_0.m3u8'), uploaded.index('chunk_0_00002.m4s'))
+        self.assertEqual(sorted(completed), ['0', '1'])
+        os.rmdir(local_folder)
+
     @patch('api.chunk.pubsub_utils.get_publisher_client')
     def test_publish_file_processing_task(self, mock_get_publisher):
         """Test publishing a file processing task to Pub/Sub."""